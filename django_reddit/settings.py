@@ -53,6 +53,7 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'reddit.instrumentation.TimingMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -90,9 +91,64 @@ DATABASES = {
     'default': {
         'ENGINE': 'django.db.backends.sqlite3',
         'NAME': BASE_DIR / 'db.sqlite3',
+        # Connections are kept open between requests instead of reconnecting every time
+        'CONN_MAX_AGE': 60,
+        'CONN_HEALTH_CHECKS': True,
+        'TEST': {
+            # A file rather than the default shared in-memory database, so tests can exercise concurrent connections
+            'NAME': BASE_DIR / 'test-db.sqlite3',
+        },
+    },
+}
+
+# Read only copy of the primary kept up to date by an external tool (e.g. Litestream), only used when
+# REDDIT_READ_REPLICA names it, see reddit/routers.py.
+if os.environ.get('REDDIT_REPLICA_DB'):
+    DATABASES['replica'] = {
+        'ENGINE': 'django.db.backends.sqlite3',
+        'NAME': os.environ['REDDIT_REPLICA_DB'],
+        'CONN_MAX_AGE': 60,
+        'CONN_HEALTH_CHECKS': True,
+        'TEST': {
+            'NAME': BASE_DIR / 'test-replica.sqlite3',
+        },
+    }
+
+DATABASE_ROUTERS = ['reddit.routers.ReplicaRouter']
+
+# Database alias PostViewSet reads from, None reads from the primary
+REDDIT_READ_REPLICA = 'replica' if os.environ.get('REDDIT_REPLICA_DB') else None
+
+# Seconds a user's reads stay on the primary after they vote or post, longer than the replica's lag
+REDDIT_REPLICA_STICKINESS = 10
+
+# Cache alias remembering who reads from the primary, it has to be shared between worker processes
+# (the checks refuse a LocMemCache when REDDIT_READ_REPLICA is set)
+REDDIT_REPLICA_CACHE = 'default'
+
+# Set on every new SQLite connection but the replica's: WAL lets readers proceed while a vote is being written, NORMAL
+# synchronous is safe with WAL, and writers wait up to busy_timeout milliseconds for the write lock.
+REDDIT_SQLITE_PRAGMAS = {'journal_mode': 'wal', 'synchronous': 'normal', 'busy_timeout': 5000}
+
+# Cache
+# https://docs.djangoproject.com/en/3.2/topics/cache/
+# Post listings are cached here (see reddit/cache.py), use a FileBasedCache (or a shared cache
+# server) to share the listing cache between worker processes
+
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
     }
 }
 
+# Write-behind vote counts (see reddit/vote_buffer.py), e.g. {'flush_interval': 0.5, 'flush_size': 500}.
+# Votes are still recorded immediately but the votes/score totals lag by up to flush_interval seconds.
+REDDIT_VOTE_WRITE_BEHIND = None
+
+# Vote rate limits (see reddit/throttling.py) per user and per post or comment, as DRF style rates. They are
+# counted in each process, set 'cache' to the name of a cache shared by the workers to count them there instead.
+REDDIT_VOTE_THROTTLE = {'user': '60/min', 'target': '1200/min', 'cache': None}
+
 
 # Password validation
 # https://docs.djangoproject.com/en/3.2/ref/settings/#auth-password-validators
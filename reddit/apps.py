@@ -4,3 +4,7 @@ from django.apps import AppConfig
 class RedditConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'reddit'
+
+    def ready(self):
+        # Connects the SQLite pragmas and query recorder receivers before the first connection is made
+        from . import instrumentation, routers
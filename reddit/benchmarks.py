@@ -0,0 +1,362 @@
+import asyncio
+import tracemalloc
+from collections import deque
+from gc import collect
+from itertools import islice
+from random import Random
+from statistics import quantiles
+from threading import Semaphore, Thread
+from time import perf_counter
+from types import SimpleNamespace
+from django.conf import settings
+from django.db import connection, transaction
+from django.db.models import Q
+from django.test import AsyncClient, Client, override_settings
+from django.utils import timezone
+from rest_framework.renderers import JSONRenderer
+from .comment_tree import CommentTree
+from .datagen import DatasetGenerator
+from .deletion import delete_comment_subtrees, delete_posts
+from .importer import PostImporter
+from .models import Comment, CommentManager, LeaderboardEntry, Post, User, VotableManager, Vote
+from .search import SEARCH_INDEXES
+from .serializers import POST_ROW_FIELDS, CommentSerializer, PostSerializer, serialize_post_rows
+from .streaming import serialize_chunks, stream_json_object
+from .throttling import VoteThrottle
+from .vote_buffer import get_vote_buffer
+from .voting import apply_votes
+
+SORTS = [VotableManager.HOT, VotableManager.NEWEST, VotableManager.OLDEST, VotableManager.TOP_ALL_TIME,
+    VotableManager.TOP_PAST_YEAR, VotableManager.TOP_PAST_MONTH, VotableManager.TOP_PAST_WEEK, VotableManager.TOP_PAST_DAY]
+# Listings are measured uncached, the cache would otherwise answer every repeated request
+UNCACHED = {'default': {'BACKEND': 'django.core.cache.backends.dummy.DummyCache'}}
+
+"""Benchmarks run by `manage.py benchmark`, each one is a generator yielding a result dict per measurement"""
+BENCHMARKS = {}
+
+def benchmark(name):
+    def register(func):
+        BENCHMARKS[name] = func
+        return func
+    return register
+
+"""Returns the mean time in microseconds of calling func once for each of the given arguments"""
+def time_per_call(func, arguments):
+    collect()
+    for argument in arguments[:10]:
+        func(argument)
+    start = perf_counter()
+    for argument in arguments:
+        func(argument)
+    return (perf_counter() - start) / len(arguments) * 1000000
+
+"""Returns the mean time in milliseconds of calling func repeat times"""
+def time_repeated(func, repeat):
+    return time_per_call(lambda _: func(), [None] * repeat) / 1000
+
+"""Bulk imports generated posts (each with comments_per_post comments) and returns them"""
+def seed_posts(count, comments_per_post=0, seed=0, prefix='bench'):
+    author, _ = User.objects.get_or_create(username=f'{prefix}_author')
+    importer = PostImporter(context={'user_id': author.id})
+    # Created in the past year of the run, so the posts fall in the top windows and their hot ranks are current
+    for data in DatasetGenerator(posts=count, comments_per_post=comments_per_post, seed=seed, now=timezone.now()):
+        importer.add(data)
+    importer.flush()
+    LeaderboardEntry.refresh()
+    return Post.objects.filter(user=author)
+
+def create_users(count, prefix='bench'):
+    User.objects.bulk_create([User(username=f'{prefix}_{i}') for i in range(count)], batch_size=1000)
+    return list(User.objects.filter(username__startswith=f'{prefix}_').values_list('id', flat=True))
+
+@benchmark('vote-lookup')
+def vote_lookup(scales=(10000, 100000, 1000000), lookups=1000, seed=0):
+    random = Random(seed)
+    user_ids = create_users(1000)
+    inserted = 0
+    for scale in sorted(scales):
+        # Every user votes once on consecutive targets, so the table holds exactly `scale` unique votes
+        votes = (Vote(user_id=user_ids[i % len(user_ids)], target_type=Post.type_code, target=i // len(user_ids), type='u') for i in range(inserted, scale))
+        # bulk_create() turns its argument into a list, chunks keep the large scales from holding every vote at once
+        while chunk := list(islice(votes, 5000)):
+            Vote.objects.bulk_create(chunk)
+        inserted = scale
+        samples = [(random.randrange(scale), random.random() < 0.5) for _ in range(lookups)]
+        users = {user.id: user for user in User.objects.filter(id__in=user_ids)}
+
+        def lookup(sample):
+            index, hit = sample
+            user = users[user_ids[index % len(user_ids)]]
+            post = Post(id=index // len(user_ids) + (0 if hit else scale))
+            post.get_vote(user)
+
+        yield {'benchmark': 'vote-lookup', 'votes': scale, 'lookups': lookups, 'us_per_lookup': time_per_call(lookup, samples)}
+
+@benchmark('vote-throughput')
+def vote_throughput(scales=(2000,), workers=4, write_behind={'flush_interval': 0.1, 'flush_size': 500}):
+    for votes in scales:
+        for mode, options in (('sync', None), ('write-behind', write_behind)):
+            with override_settings(REDDIT_VOTE_WRITE_BEHIND=options):
+                author = User.objects.create(username=f'bench_author_{mode}_{votes}')
+                post = Post.objects.create(title='viral post', text='viral post', user=author)
+                user_ids = create_users(workers * 50, prefix=f'bench_{mode}_{votes}')
+                users = list(User.objects.filter(id__in=user_ids))
+                # Each worker toggles votes of its own users on the same post
+                clicks = [[(users[(i * workers + worker) % len(users)], 'u' if i % 3 else 'd') for i in range(votes // workers)] for worker in range(workers)]
+
+                def vote(clicks):
+                    instance = Post.objects.get(id=post.id)
+                    try:
+                        for user, type in clicks:
+                            instance.vote(user, type)
+                    finally:
+                        connection.close()
+
+                threads = [Thread(target=vote, args=(worker_clicks,)) for worker_clicks in clicks]
+                start = perf_counter()
+                for thread in threads:
+                    thread.start()
+                for thread in threads:
+                    thread.join()
+                buffer = get_vote_buffer()
+                if buffer:
+                    buffer.flush()
+                elapsed = perf_counter() - start
+                consistent = not Post.objects.filter(id=post.id).with_inconsistent_vote_counts().exists()
+            yield {'benchmark': 'vote-throughput', 'mode': mode, 'votes': votes // workers * workers, 'workers': workers, 'votes_per_second': votes // workers * workers / elapsed, 'consistent': consistent}
+
+@benchmark('vote-batch')
+def vote_batch(scales=(10, 50), batches=20, seed=0):
+    random = Random(seed)
+    posts = list(seed_posts(500, seed=seed, prefix='bench_batch').values_list('id', flat=True))
+    user = User.objects.create(username='bench_batch_voter')
+    for size in sorted(scales):
+        votes = [[('p', random.choice(posts), random.choice('ud')) for _ in range(size)] for _ in range(batches)]
+        instances = Post.objects.in_bulk(posts)
+
+        def vote_sequentially(batch):
+            with transaction.atomic():
+                for _, id, type in batch:
+                    instances[id].vote(user, type)
+
+        for mode, func in (('sequential', vote_sequentially), ('batch', lambda batch: apply_votes(user, batch))):
+            yield {'benchmark': 'vote-batch', 'batch_size': size, 'mode': mode, 'us_per_vote': time_per_call(func, votes) / size}
+
+@benchmark('vote-throttle')
+def vote_throttle(scales=(1000, 100000), calls=100000, seed=0):
+    random = Random(seed)
+    throttle = VoteThrottle()
+    view = SimpleNamespace(get_vote_targets=lambda request: [('p', request.target)])
+    for scale in sorted(scales):
+        # scale users voting on scale posts, with limits high enough that every vote is counted
+        requests = [SimpleNamespace(user=SimpleNamespace(pk=random.randrange(scale)), target=random.randrange(scale)) for _ in range(calls)]
+        for backend in (None, 'default'):
+            with override_settings(REDDIT_VOTE_THROTTLE={'user': f'{calls}/day', 'target': f'{calls}/day', 'cache': backend}):
+                yield {'benchmark': 'vote-throttle', 'keys': scale, 'backend': backend or 'memory',
+                    'us_per_request': time_per_call(lambda request: throttle.allow_request(request, view), requests)}
+
+@benchmark('db-profile')
+def db_profile(scales=(10000,), reads=500, seed=0):
+    for scale in scales:
+        posts = list(seed_posts(scale, seed=seed, prefix=f'bench_db_{scale}')[:100])
+        voters = list(User.objects.filter(id__in=create_users(50, prefix=f'bench_db_{scale}')))
+        for journal_mode in ('delete', 'wal'):
+            # New connections pick up the journal mode, the file keeps it
+            connection.close()
+            with override_settings(REDDIT_SQLITE_PRAGMAS={**settings.REDDIT_SQLITE_PRAGMAS, 'journal_mode': journal_mode}):
+                connection.ensure_connection()
+                stop = False
+
+                def vote():
+                    random = Random(seed)
+                    try:
+                        while not stop:
+                            random.choice(posts).vote(random.choice(voters), random.choice('ud'))
+                    finally:
+                        connection.close()
+
+                writer = Thread(target=vote)
+                writer.start()
+                try:
+                    latencies = []
+                    for _ in range(reads):
+                        start = perf_counter()
+                        list(Post.objects.sort(type=VotableManager.HOT, use_leaderboard=False)[:25])
+                        latencies.append((perf_counter() - start) * 1000)
+                finally:
+                    stop = True
+                    writer.join()
+                percentiles = quantiles(latencies, n=100)
+                yield {'benchmark': 'db-profile', 'posts': scale, 'journal_mode': journal_mode, 'p50_ms': percentiles[49], 'p99_ms': percentiles[98], 'max_ms': max(latencies)}
+        # Opening a connection with the pragmas is what CONN_MAX_AGE saves on every request
+        def reconnect():
+            connection.close()
+            connection.ensure_connection()
+        yield {'benchmark': 'db-profile', 'posts': scale, 'connect_ms': time_repeated(reconnect, 100)}
+
+@benchmark('sort')
+def sort(scales=(10000, 100000, 1000000), repeat=20, seed=0):
+    seeded = 0
+    for scale in sorted(scales):
+        seed_posts(scale - seeded, seed=seed + seeded)
+        seeded = scale
+        for mode in SORTS:
+            yield {'benchmark': 'sort', 'posts': scale, 'sort': mode, 'ms_per_page': time_repeated(lambda: list(Post.objects.sort(type=mode)[:25]), repeat)}
+        # The window queries the leaderboards replace
+        for mode in VotableManager.TOP_WINDOWS:
+            yield {'benchmark': 'sort', 'posts': scale, 'sort': f'{mode}-exact', 'ms_per_page': time_repeated(lambda: list(Post.objects.sort(type=mode, use_leaderboard=False)[:25]), repeat)}
+
+@benchmark('search')
+def search(scales=(10000, 100000, 1000000), repeat=20, seed=0):
+    index = SEARCH_INDEXES['posts']
+    seeded = 0
+    for scale in sorted(scales):
+        seed_posts(scale - seeded, seed=seed + seeded)
+        seeded = scale
+        # Generated posts are titled post_title_<n>, so 'post' matches every one of them and the number only one
+        rare = str(scale // 2)
+        for query, text in (('rare', f'title {rare}'), ('common', 'post title')):
+            yield {'benchmark': 'search', 'posts': scale, 'query': query, 'ms_per_page': time_repeated(lambda: index.search(text, limit=26), repeat)}
+        like = Post.objects.filter(Q(title__icontains=rare) | Q(text__icontains=rare))
+        yield {'benchmark': 'search', 'posts': scale, 'query': 'rare-like', 'ms_per_page': time_repeated(lambda: list(like[:26]), repeat)}
+        yield {'benchmark': 'search', 'posts': scale, 'query': 'rebuild', 'ms_per_page': time_repeated(index.rebuild, 1)}
+
+@benchmark('list')
+def post_list(scales=(10000, 100000, 1000000), repeat=20, seed=0):
+    client = Client()
+    seeded = 0
+    for scale in sorted(scales):
+        seed_posts(scale - seeded, seed=seed + seeded)
+        seeded = scale
+        with override_settings(CACHES=UNCACHED):
+            for mode in SORTS:
+                yield {'benchmark': 'list', 'posts': scale, 'sort': mode, 'ms_per_request': time_repeated(lambda: client.get('/posts/', {'sort': mode}), repeat)}
+
+@benchmark('list-serializer')
+def list_serializer(scales=(25, 100), repeat=200, text_length=4000, seed=0):
+    posts = seed_posts(max(scales), seed=seed, prefix='bench_serializer')
+    # Listings don't show the text, but loading model instances reads it anyway
+    posts.update(text='x' * text_length)
+    for scale in sorted(scales):
+        queryset = posts.order_by('-created_on', '-id').with_user_vote(None)[:scale]
+        # all() so every call runs the query instead of reusing the queryset's result cache
+        for serializer, serialize in (('PostSerializer', lambda: PostSerializer(queryset.all(), many=True).data),
+                ('serialize_post_rows', lambda: serialize_post_rows(queryset.values(*POST_ROW_FIELDS)))):
+            yield {'benchmark': 'list-serializer', 'rows': scale, 'serializer': serializer, 'us_per_row': time_repeated(serialize, repeat) * 1000 / scale}
+
+@benchmark('retrieve')
+def retrieve(scales=(10000, 100000, 1000000), repeat=10, seed=0):
+    client = Client()
+    for scale in sorted(scales):
+        post = seed_posts(1, comments_per_post=scale, seed=seed, prefix=f'bench_{scale}').get()
+        yield {'benchmark': 'retrieve', 'comments': scale, 'ms_per_request': time_repeated(lambda: client.get(f'/posts/{post.id}/'), repeat)}
+
+"""Deletes a post with scale comments, and the subtree of its first top level comment, the usual way and
+in bulk. Each delete is rolled back so every mode deletes the same rows."""
+@benchmark('delete')
+def delete(scales=(1000, 10000), seed=0):
+    for scale in sorted(scales):
+        post = seed_posts(1, comments_per_post=scale, seed=seed, prefix=f'bench_{scale}').get()
+        root = Comment.objects.filter(post=post, parent=None).order_by('id')[:1]
+        modes = {
+            ('post', 'model'): lambda: Post.objects.get(id=post.id).delete(),
+            ('post', 'bulk'): lambda: delete_posts(Post.objects.filter(id=post.id)),
+            ('subtree', 'model'): lambda: root.get().delete(),
+            ('subtree', 'bulk'): lambda: delete_comment_subtrees(root),
+        }
+        for (target, mode), func in modes.items():
+            with transaction.atomic():
+                start = perf_counter()
+                deleted = func()[1][Comment._meta.label]
+                duration = (perf_counter() - start) * 1000
+                transaction.set_rollback(True)
+            yield {'benchmark': 'delete', 'comments': scale, 'target': target, 'mode': mode, 'deleted_comments': deleted, 'ms': duration}
+
+"""Returns the peak memory in KiB allocated while calling func, and its duration in milliseconds"""
+def trace_peak(func):
+    collect()
+    tracemalloc.start()
+    try:
+        start = perf_counter()
+        func()
+        return tracemalloc.get_traced_memory()[1] / 1024, (perf_counter() - start) * 1000
+    finally:
+        tracemalloc.stop()
+
+@benchmark('stream')
+def stream(scales=(1000, 10000, 100000), seed=0):
+    for scale in sorted(scales):
+        post = seed_posts(1, comments_per_post=scale, seed=seed, prefix=f'bench_{scale}').with_user_vote(None).get()
+        comments = Comment.objects.filter(post=post).with_user_vote(None).order_by('id')
+        data = PostSerializer(post).data
+        for mode, func in (('buffered', lambda: JSONRenderer().render({**data, 'comments': CommentSerializer(comments.all(), many=True).data})),
+                ('streamed', lambda: deque(stream_json_object(data, 'comments', serialize_chunks(comments, CommentSerializer)), maxlen=0))):
+            peak, duration = trace_peak(func)
+            yield {'benchmark': 'stream', 'comments': scale, 'mode': mode, 'peak_kib': peak, 'ms_per_response': duration}
+
+@benchmark('comment-tree')
+def comment_tree(scales=(10000, 100000, 1000000), repeat=10, seed=0):
+    for scale in sorted(scales):
+        post = seed_posts(1, comments_per_post=scale, seed=seed, prefix=f'bench_{scale}').get()
+        for sort in CommentManager.THREAD_ORDERINGS:
+            tree = CommentTree(post, CommentSerializer, sort=sort)
+            yield {'benchmark': 'comment-tree', 'comments': scale, 'sort': sort, 'ms_per_tree': time_repeated(tree.build, repeat)}
+
+def get_latency_result(latencies, elapsed):
+    percentiles = quantiles(latencies, n=100)
+    return {'requests_per_second': len(latencies) / elapsed, 'p50_ms': percentiles[49] * 1000, 'p95_ms': percentiles[94] * 1000}
+
+"""Concurrent clients against the WSGI handler, served by a fixed pool of worker threads like a threaded WSGI server"""
+def run_wsgi_clients(path, clients, requests, threads):
+    pool = Semaphore(threads)
+    latencies = []
+
+    def run_client():
+        client = Client()
+        try:
+            for _ in range(requests // clients):
+                start = perf_counter()
+                with pool:
+                    client.get(path)
+                latencies.append(perf_counter() - start)
+        finally:
+            connection.close()
+
+    workers = [Thread(target=run_client) for _ in range(clients)]
+    start = perf_counter()
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    return get_latency_result(latencies, perf_counter() - start)
+
+"""Concurrent clients against the ASGI handler, all served by one event loop"""
+def run_asgi_clients(path, clients, requests):
+    latencies = []
+
+    async def run_client():
+        client = AsyncClient()
+        for _ in range(requests // clients):
+            start = perf_counter()
+            await client.get(path)
+            latencies.append(perf_counter() - start)
+
+    async def run_clients():
+        await asyncio.gather(*(run_client() for _ in range(clients)))
+
+    start = perf_counter()
+    asyncio.run(run_clients())
+    return get_latency_result(latencies, perf_counter() - start)
+
+@benchmark('async-load')
+def async_load(scales=(1, 8, 32), posts=10000, comments=500, requests=320, threads=4, seed=0):
+    seed_posts(posts, seed=seed)
+    post = seed_posts(1, comments_per_post=comments, seed=seed, prefix='bench_detail').get()
+    endpoints = (('list', '/posts/', '/async/posts/'), ('detail', f'/posts/{post.id}/', f'/async/posts/{post.id}/'))
+    with override_settings(CACHES=UNCACHED):
+        for clients in sorted(scales):
+            for endpoint, sync_path, async_path in endpoints:
+                yield {'benchmark': 'async-load', 'endpoint': endpoint, 'clients': clients, 'server': 'wsgi',
+                    **run_wsgi_clients(sync_path, clients, requests, threads)}
+                yield {'benchmark': 'async-load', 'endpoint': endpoint, 'clients': clients, 'server': 'asgi',
+                    **run_asgi_clients(async_path, clients, requests)}
@@ -0,0 +1,83 @@
+import asyncio
+import hashlib
+import time
+from django.core.cache import cache
+
+LISTING_VERSION_KEY = 'reddit:listing-version'
+# Cached listings are recomputed after this many seconds even without votes, so hot ranks can age
+LISTING_TTL = 30
+# How long an expired entry is kept around to be served while a single worker recomputes it
+STALE_TTL = 300
+LOCK_TTL = 10
+LOCK_POLL_INTERVAL = 0.05
+
+"""The version starts from the clock so it never goes back to a used value if the key is evicted"""
+def get_listing_version():
+    version = cache.get(LISTING_VERSION_KEY)
+    if version is None:
+        cache.add(LISTING_VERSION_KEY, time.time_ns(), timeout=None)
+        version = cache.get(LISTING_VERSION_KEY)
+    return version
+
+"""Makes every cached listing unreachable, called (after commit) whenever ranking inputs change"""
+def bump_listing_version():
+    try:
+        cache.incr(LISTING_VERSION_KEY)
+    except ValueError:
+        cache.add(LISTING_VERSION_KEY, time.time_ns(), timeout=None)
+
+def get_listing_key(*parts):
+    digest = hashlib.md5(':'.join(str(part) for part in parts).encode()).hexdigest()
+    return f'reddit:listing:{get_listing_version()}:{digest}'
+
+"""Returns the cached value for key, computing it when missing or expired. Only the worker that
+acquires the key's lock recomputes, the others serve the expired value meanwhile or, if there
+is none yet, wait for the lock holder to store it."""
+def get_or_compute(key, compute, ttl=LISTING_TTL):
+    entry = cache.get(key)
+    if entry is not None and entry[0] > time.time():
+        return entry[1]
+    lock_key = f'{key}:lock'
+    if cache.add(lock_key, True, timeout=LOCK_TTL):
+        try:
+            value = compute()
+            cache.set(key, (time.time() + ttl, value), timeout=ttl + STALE_TTL)
+            return value
+        finally:
+            cache.delete(lock_key)
+    if entry is not None:
+        return entry[1]
+    deadline = time.time() + LOCK_TTL
+    while time.time() < deadline:
+        time.sleep(LOCK_POLL_INTERVAL)
+        entry = cache.get(key)
+        if entry is not None:
+            return entry[1]
+        if cache.get(lock_key) is None:
+            break
+    return compute()
+
+"""get_or_compute() for async views, compute is a coroutine function"""
+async def aget_or_compute(key, compute, ttl=LISTING_TTL):
+    entry = await cache.aget(key)
+    if entry is not None and entry[0] > time.time():
+        return entry[1]
+    lock_key = f'{key}:lock'
+    if await cache.aadd(lock_key, True, timeout=LOCK_TTL):
+        try:
+            value = await compute()
+            await cache.aset(key, (time.time() + ttl, value), timeout=ttl + STALE_TTL)
+            return value
+        finally:
+            await cache.adelete(lock_key)
+    if entry is not None:
+        return entry[1]
+    deadline = time.time() + LOCK_TTL
+    while time.time() < deadline:
+        await asyncio.sleep(LOCK_POLL_INTERVAL)
+        entry = await cache.aget(key)
+        if entry is not None:
+            return entry[1]
+        if await cache.aget(lock_key) is None:
+            break
+    return await compute()
@@ -0,0 +1,131 @@
+import json
+from base64 import urlsafe_b64decode, urlsafe_b64encode
+from binascii import Error as Base64Error
+from datetime import datetime
+from django.core.exceptions import ValidationError as DjangoValidationError
+from django.db.models import F, Window
+from django.db.models.functions import RowNumber
+from rest_framework.exceptions import ValidationError
+from .models import Comment, CommentManager
+from .pagination import get_keyset_filter
+
+"""(field name, descending) for every field a level of the tree is ordered by in the given sort"""
+def get_ordering(sort):
+    return [(name.lstrip('-'), name.startswith('-')) for name in Comment.objects.get_thread_ordering(sort)]
+
+"""Opaque "load more replies" token pointing after the last loaded child of a parent (None for top level comments),
+in the sort order of the tree. The position holds the ordering values of that child, like a KeysetPagination cursor."""
+def encode_continuation(parent_id, sort, after=None):
+    position = None
+    if after is not None:
+        values = [getattr(after, name) for name, _ in get_ordering(sort)]
+        position = [value.isoformat() if isinstance(value, datetime) else value for value in values]
+    return urlsafe_b64encode(json.dumps([parent_id, sort, position]).encode()).decode()
+
+def decode_continuation(token):
+    try:
+        parent_id, sort, position = json.loads(urlsafe_b64decode(token.encode()))
+        if not (parent_id is None or isinstance(parent_id, int)) or sort not in CommentManager.THREAD_ORDERINGS:
+            raise ValueError
+        if position is not None:
+            ordering = get_ordering(sort)
+            if not isinstance(position, list) or len(position) != len(ordering):
+                raise ValueError
+            position = [Comment._meta.get_field(name).to_python(value) for (name, _), value in zip(ordering, position)]
+    except (Base64Error, ValueError, TypeError, DjangoValidationError):
+        raise ValidationError({'continue': 'Invalid continuation token.'})
+    return parent_id, sort, position
+
+class CommentTree:
+    """Loads a bounded part of a post's comment tree one level at a time, each level is a single
+    query limited both per parent and overall, then attaches every comment to its parent in one pass.
+    Replies come in one of CommentManager.THREAD_ORDERINGS, best by default, read from the matching
+    (post, parent, ...) index so only the replies that are shown are loaded.
+    Parents whose replies weren't all loaded get a 'more' continuation token."""
+
+    MAX_DEPTH = 10
+    MAX_PAGE_SIZE = 500
+    DEFAULT_DEPTH = 5
+    DEFAULT_PAGE_SIZE = 50
+    # Replies loaded per parent below the top level
+    CHILDREN_LIMIT = 10
+    # Total comments loaded per request, shallower comments are loaded first
+    MAX_COMMENTS = 500
+
+    def __init__(self, post, serializer_class, context=None, max_depth=None, page_size=None, sort=None):
+        self.post = post
+        self.sort = sort if sort in CommentManager.THREAD_ORDERINGS else CommentManager.BEST
+        self.serializer_class = serializer_class
+        self.context = context or {}
+        self.max_depth = max(1, min(max_depth or self.DEFAULT_DEPTH, self.MAX_DEPTH))
+        self.page_size = max(1, min(page_size or self.DEFAULT_PAGE_SIZE, self.MAX_PAGE_SIZE))
+
+    """Comments with the requesting user's votes, not limited to the post so that levels below the top one are
+    read by id rather than by scanning the post's comments"""
+    def get_queryset(self):
+        request = self.context.get('request')
+        return Comment.objects.with_user_vote(request.user if request else None)
+
+    """Returns the top level comments (or the replies the token continues) with their loaded
+    replies nested under 'child_comments', and a token for the next page if there is one"""
+    def build(self, continuation=None):
+        steps = self.get_steps(continuation)
+        rows = None
+        try:
+            while True:
+                rows = list(steps.send(rows))
+        except StopIteration as result:
+            return result.value
+
+    """build() running its queries through the async ORM"""
+    async def abuild(self, continuation=None):
+        steps = self.get_steps(continuation)
+        rows = None
+        try:
+            while True:
+                rows = [row async for row in steps.send(rows)]
+        except StopIteration as result:
+            return result.value
+
+    """Generator yielding the query of each level and receiving its rows, returns what build() does"""
+    def get_steps(self, continuation):
+        parent_id, sort, after = decode_continuation(continuation) if continuation else (None, self.sort, None)
+        ordering = get_ordering(sort)
+        query = self.get_queryset().filter(post=self.post, parent_id=parent_id).order_by(*Comment.objects.get_thread_ordering(sort))
+        if after is not None:
+            query = query.filter(get_keyset_filter(ordering, after))
+        rows = yield query[:self.page_size + 1]
+        more = encode_continuation(parent_id, sort, rows[self.page_size - 1]) if len(rows) > self.page_size else None
+        nodes, loaded = {}, {}
+        roots = level = self.add_level(rows[:self.page_size], nodes, loaded)
+        budget = self.MAX_COMMENTS - len(roots)
+        order_by = [F(name).desc() if descending else F(name).asc() for name, descending in ordering]
+        for depth in range(1, self.max_depth):
+            parent_ids = [node['id'] for node in level if node['child_comment_count']]
+            if not parent_ids or budget <= 0:
+                break
+            # The first replies of every parent are picked on the sort index alone, only they are then loaded.
+            # Every parent gets its first reply before any parent gets its second, so the budget is shared fairly.
+            first_replies = Comment.objects.filter(post=self.post, parent_id__in=parent_ids).annotate(
+                position=Window(RowNumber(), partition_by=F('parent_id'), order_by=order_by)).filter(position__lte=self.CHILDREN_LIMIT)
+            query = self.get_queryset().filter(id__in=first_replies.values('id')).annotate(
+                position=Window(RowNumber(), partition_by=F('parent_id'), order_by=order_by))
+            rows = yield query.order_by('position', 'parent_id')[:budget]
+            budget -= len(rows)
+            level = self.add_level(rows, nodes, loaded)
+        for node in nodes.values():
+            children = node.get('child_comments', [])
+            if node['child_comment_count'] > len(children):
+                node['more'] = encode_continuation(node['id'], sort, loaded[children[-1]['id']] if children else None)
+        return roots, more
+
+    """Serializes the rows of a level, keeping them in loaded by id for the continuation tokens"""
+    def add_level(self, rows, nodes, loaded):
+        level = self.serializer_class(rows, many=True, context=self.context).data
+        for row in rows:
+            loaded[row.id] = row
+        for node in level:
+            nodes[node['id']] = node
+            if node['parent_id'] in nodes:
+                nodes[node['parent_id']].setdefault('child_comments', []).append(node)
+        return level
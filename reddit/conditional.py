@@ -0,0 +1,44 @@
+import hashlib
+import time
+from django.db.models import Max, OuterRef, Subquery
+from .cache import LISTING_TTL, get_listing_version
+from .models import Comment, Post
+
+# Validators for conditional GETs, computed from a couple of indexed columns and the listing
+# version so a 304 can be sent without loading or serializing the response body. They include
+# the requesting user, who sees their own votes, and the Accept header, which picks the renderer.
+
+def get_etag(request, *parts):
+    user = getattr(request, 'user', None)
+    key = ':'.join(str(part) for part in (*parts, request.get_full_path(), user.pk if user else None, request.META.get('HTTP_ACCEPT')))
+    return hashlib.md5(key.encode()).hexdigest()
+
+"""Latest change to the post and to its comments (votes, replies and edits all touch updated_on, and adding or
+deleting a comment touches the post's, so the latest time never goes back), cached on the request"""
+def get_post_versions(request, pk):
+    if not hasattr(request, 'post_versions'):
+        try:
+            post = Post.objects.filter(id=pk)
+        except (TypeError, ValueError):
+            # Not a valid id, no validators so the view answers with its 404
+            request.post_versions = None
+            return None
+        comments_updated_on = Comment.objects.filter(post=OuterRef('id')).values('post').annotate(latest=Max('updated_on')).values('latest')
+        request.post_versions = post.values_list('updated_on', 'comment_count').annotate(
+            comments_updated_on=Subquery(comments_updated_on)).first()
+    return request.post_versions
+
+def get_post_etag(request, pk=None, **kwargs):
+    versions = get_post_versions(request, pk)
+    return get_etag(request, *versions) if versions else None
+
+def get_post_last_modified(request, pk=None, **kwargs):
+    versions = get_post_versions(request, pk)
+    if not versions:
+        return None
+    updated_on, _, comments_updated_on = versions
+    return max(updated_on, comments_updated_on or updated_on)
+
+"""Listings change with the listing version and, as hot ranks and time windows age, at least once per LISTING_TTL like the cached listings"""
+def get_listing_etag(request, *args, **kwargs):
+    return get_etag(request, get_listing_version(), int(time.time() // LISTING_TTL))
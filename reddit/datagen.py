@@ -0,0 +1,74 @@
+from datetime import datetime, timedelta, timezone
+from random import Random
+
+class DatasetGenerator:
+    """Generates posts with comment trees in the nested format read by PostImporter and the loader
+    in reddit/tests.py. Objects reference their author as $user_id, or $user_<n> when there is
+    more than one user, and the same seed always produces the same dataset. Creation times go back up to a
+    year from now, a fixed date by default so the dataset doesn't depend on when it's generated either."""
+    DEFAULT_NOW = datetime(2026, 1, 1, tzinfo=timezone.utc)
+
+    def __init__(self, posts=10, comments_per_post=20, depth=10, fan_out=10, users=1, votes_per_user=0, seed=None, now=None):
+        self.posts = posts
+        self.comments_per_post = comments_per_post
+        self.depth = depth
+        self.fan_out = fan_out
+        self.users = users
+        self.votes_per_user = votes_per_user
+        self.random = Random(seed)
+        self.now = now or self.DEFAULT_NOW
+        self.total_comments = 0
+
+    def get_user(self):
+        return '$user_id' if self.users == 1 else f'$user_{self.random.randrange(self.users)}'
+
+    """Maps object index (posts and comments numbered in generation order) to the votes cast on it"""
+    def get_vote_records(self):
+        objects = self.posts * (1 + self.comments_per_post)
+        records = {}
+        for user in range(self.users):
+            placeholder = '$user_id' if self.users == 1 else f'$user_{user}'
+            for index in self.random.sample(range(objects), min(self.votes_per_user, objects)):
+                records.setdefault(index, []).append({'user_id': placeholder, 'type': 'u' if self.random.random() < 0.7 else 'd'})
+        return records
+
+    def create_votable(self, target_class, index, vote_records, **fields):
+        upvotes = self.random.randint(0, 100000)
+        downvotes = self.random.randint(0, 100000)
+        data = {
+            'target_class': target_class,
+            **fields,
+            'score': upvotes - downvotes,
+            'votes': upvotes + downvotes,
+            'user_id': self.get_user(),
+            'created_on': (self.now - timedelta(seconds=self.random.randint(0, 24*3600*366))).timestamp(),
+        }
+        if index in vote_records:
+            data['vote_records'] = vote_records[index]
+        return data
+
+    """Random tree of exactly comments_per_post comments, no deeper than depth and with at most fan_out replies per comment"""
+    def create_comments(self, index, vote_records):
+        roots, open_parents = [], [None]
+        for i in range(self.comments_per_post):
+            position = self.random.randrange(len(open_parents))
+            parent = open_parents[position]
+            comment = self.create_votable('reddit.models.Comment', index + i + 1, vote_records,
+                text=f'post_comment_{self.total_comments}', post='$root', parent='$parent' if parent else None, children=[])
+            self.total_comments += 1
+            (parent['comment']['children'] if parent else roots).append(comment)
+            if parent and len(parent['comment']['children']) >= self.fan_out:
+                open_parents[position] = open_parents[-1]
+                open_parents.pop()
+            depth = parent['depth'] + 1 if parent else 1
+            if depth < self.depth:
+                open_parents.append({'comment': comment, 'depth': depth})
+        return roots
+
+    def __iter__(self):
+        vote_records = self.get_vote_records() if self.votes_per_user else {}
+        for i in range(self.posts):
+            index = i * (1 + self.comments_per_post)
+            post = self.create_votable('reddit.models.Post', index, vote_records, title=f'post_title_{i}', text=f'post_text_{i}')
+            post['comments'] = self.create_comments(index, vote_records)
+            yield post
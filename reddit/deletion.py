@@ -0,0 +1,81 @@
+from collections import defaultdict
+from django.db import connections, router, transaction
+from django.db.models import Count, F, Sum
+from django.db.models.expressions import RawSQL
+from django.utils import timezone
+from .cache import bump_listing_version
+from .models import Comment, LeaderboardEntry, Post, User, Vote
+from .voting import group_by_value
+
+# Deleting a post or comment the usual way loads every comment below it and runs the comment signals for each,
+# a post count and a parent save per comment. These delete whole subtrees with a few statements instead, the
+# rows to delete are collected into a temporary table first so every statement reads the same set, however large.
+
+"""Fills the temporary table name with the ids selected by sql and returns a subquery reading them"""
+def collect_ids(cursor, name, sql, params):
+    cursor.execute(f'CREATE TEMP TABLE IF NOT EXISTS {name} (id INTEGER PRIMARY KEY)')
+    cursor.execute(f'DELETE FROM {name}')
+    cursor.execute(f'INSERT OR IGNORE INTO {name} (id) {sql}', params)
+    return RawSQL(f'SELECT id FROM {name}', [])
+
+"""Takes the scores of the deleted rows from their authors' karma, one update per distinct total"""
+def remove_karma(using, *querysets):
+    karma = defaultdict(int)
+    for queryset in querysets:
+        for user_id, score in queryset.order_by().values('user_id').annotate(total=Sum('score')).values_list('user_id', 'total'):
+            karma[user_id] += score
+    for change, user_ids in group_by_value({id: change for id, change in karma.items() if change}):
+        User.objects.using(using).filter(id__in=user_ids).update(karma=F('karma') - change)
+
+def delete_rows(cursor, model, ids):
+    cursor.execute(f'DELETE FROM {model._meta.db_table} WHERE id IN ({ids.sql})')
+    return cursor.rowcount
+
+"""Deletes the comments and all their replies, with the same outcome as deleting them one by one: the votes
+on them, their authors' karma, their posts' comment_count and the child_comment_count of the surviving parents,
+each changed once. Returns (number of rows deleted, {model label: number deleted}) like QuerySet.delete()."""
+def delete_comment_subtrees(comments, using=None):
+    using = using or router.db_for_write(Comment)
+    roots, params = comments.values('id').query.sql_with_params()
+    table = Comment._meta.db_table
+    with transaction.atomic(using=using), connections[using].cursor() as cursor:
+        ids = collect_ids(cursor, 'reddit_deleted_comment', f'''WITH RECURSIVE subtree(id) AS (
+                SELECT id FROM ({roots})
+                UNION SELECT {table}.id FROM {table} JOIN subtree ON {table}.parent_id = subtree.id
+            ) SELECT id FROM subtree''', params)
+        deleted = Comment.objects.using(using).filter(id__in=ids)
+        remove_karma(using, deleted)
+        post_counts = deleted.order_by().values('post_id').annotate(count=Count('id')).values_list('post_id', 'count')
+        for count, post_ids in group_by_value(dict(post_counts)):
+            Post.objects.using(using).filter(id__in=post_ids).update(comment_count=F('comment_count') - count, updated_on=timezone.now())
+        # Only the parents of the subtree roots survive, and like a reply they count as updated
+        parent_counts = deleted.exclude(parent_id__in=ids).filter(parent__isnull=False).order_by().values('parent_id').annotate(count=Count('id')).values_list('parent_id', 'count')
+        for count, parent_ids in group_by_value(dict(parent_counts)):
+            Comment.objects.using(using).filter(id__in=parent_ids).update(child_comment_count=F('child_comment_count') - count, updated_on=timezone.now())
+        votes = Vote.objects.using(using).filter(target_type=Comment.type_code, target__in=ids).delete()[0]
+        count = delete_rows(cursor, Comment, ids)
+        cursor.execute('DROP TABLE reddit_deleted_comment')
+        transaction.on_commit(bump_listing_version, using=using)
+    return count + votes, {Comment._meta.label: count, Vote._meta.label: votes}
+
+"""Deletes the posts with all their comments, leaderboard entries and the votes on them, adjusting the
+authors' karma once per author. Returns (number of rows deleted, {model label: number deleted}) like QuerySet.delete()."""
+def delete_posts(posts, using=None):
+    using = using or router.db_for_write(Post)
+    sql, params = posts.values('id').query.sql_with_params()
+    with transaction.atomic(using=using), connections[using].cursor() as cursor:
+        ids = collect_ids(cursor, 'reddit_deleted_post', sql, params)
+        comments = Comment.objects.using(using).filter(post_id__in=ids)
+        remove_karma(using, Post.objects.using(using).filter(id__in=ids), comments)
+        votes = Vote.objects.using(using).filter(target_type=Post.type_code, target__in=ids).delete()[0]
+        votes += Vote.objects.using(using).filter(target_type=Comment.type_code, target__in=comments.values('id')).delete()[0]
+        entries = LeaderboardEntry.objects.using(using).filter(post_id__in=ids).delete()[0]
+        cursor.execute(f'DELETE FROM {Comment._meta.db_table} WHERE post_id IN ({ids.sql})')
+        comment_count = cursor.rowcount
+        count = delete_rows(cursor, Post, ids)
+        cursor.execute('DROP TABLE reddit_deleted_post')
+        if entries:
+            transaction.on_commit(LeaderboardEntry.reset_thresholds, using=using)
+        transaction.on_commit(bump_listing_version, using=using)
+    counts = {Post._meta.label: count, Comment._meta.label: comment_count, Vote._meta.label: votes, LeaderboardEntry._meta.label: entries}
+    return sum(counts.values()), counts
@@ -0,0 +1,186 @@
+import json
+from collections import deque
+from datetime import datetime
+from pydoc import locate
+from django.db import transaction
+from django.utils import timezone
+from django.utils.timezone import make_aware
+from .cache import bump_listing_version
+from .models import Comment, Post, User, Votable, Vote
+
+"""Yields the elements of a top level JSON array one at a time, reading the file in blocks"""
+def iter_json_array(file, read_size=1 << 16):
+    decoder = json.JSONDecoder()
+    buffer, position = '', 0
+
+    def skip(characters):
+        nonlocal buffer, position
+        while True:
+            while position < len(buffer) and buffer[position] in characters:
+                position += 1
+            if position < len(buffer):
+                return buffer[position]
+            buffer, position = file.read(read_size), 0
+            if not buffer:
+                return None
+
+    if skip(' \t\r\n') != '[':
+        raise ValueError('Expected a JSON array')
+    position += 1
+    while True:
+        character = skip(' \t\r\n,')
+        if character == ']':
+            return
+        if character is None:
+            raise ValueError('Unterminated JSON array')
+        try:
+            value, end = decoder.raw_decode(buffer, position)
+        except json.JSONDecodeError:
+            # Growing the buffer by at least its unread length keeps large elements from being decoded over and over
+            more = file.read(max(read_size, len(buffer) - position))
+            if not more:
+                raise
+            buffer, position = buffer[position:] + more, 0
+            continue
+        yield value
+        position = end
+
+class ImportedObject:
+
+    def __init__(self, obj, children, user_votes):
+        self.obj = obj
+        self.children = children
+        self.user_votes = user_votes
+
+class PostImporter:
+    """Bulk loads posts and their comment trees from the nested JSON written by
+    tools/generate-posts-for-tests.py. Rows are inserted with bulk_create a chunk at a time, one
+    statement per tree level, without save signals: the creator votes, slugs, hot ranks and comment
+    counts those signals would produce are computed here instead, so the end state matches saving
+    every object one by one. The authors' karma grows by the imported scores."""
+
+    def __init__(self, context=None, chunk_size=10000):
+        self.context = context or {}
+        self.chunk_size = chunk_size
+        self.now = timezone.now()
+        self.pending = []
+        self.pending_objects = 0
+        self.imported = {Post: 0, Comment: 0}
+
+    def import_file(self, file):
+        for data in iter_json_array(file):
+            self.add(data)
+        self.flush()
+        return self.imported
+
+    def add(self, data):
+        self.pending.append(self.build(data))
+        if self.pending_objects >= self.chunk_size:
+            self.flush()
+
+    """Builds the tree a level at a time rather than recursively, so no thread is too deep to import"""
+    def build(self, data):
+        tree = None
+        pending = deque([(data, None)])
+        while pending:
+            data, parent = pending.popleft()
+            node, children = self.build_object(data, tree.obj if tree else None, parent.obj if parent else None)
+            if parent is None:
+                tree = node
+            else:
+                parent.children.append(node)
+                if node.obj.parent is parent.obj:
+                    parent.obj.child_comment_count += 1
+            pending.extend((child, node) for child in children)
+        return tree
+
+    """Returns the unsaved object with the data lists of its children, which build adds to it"""
+    def build_object(self, data, root, parent):
+        obj = locate(data['target_class'])()
+        root = root or obj
+        children, vote_records = [], []
+        for key, value in data.items():
+            if isinstance(value, str) and value.startswith('$'):
+                value = self.resolve(value[1:], root, parent)
+            if key == 'target_class':
+                continue
+            elif key == 'vote_records':
+                vote_records = value
+            elif isinstance(value, list):
+                children += value
+            elif key == 'created_on':
+                obj.created_on = make_aware(datetime.fromtimestamp(value))
+            elif key == 'parent' and not isinstance(value, Comment):
+                obj.parent = None
+            elif key != 'updated_on':
+                setattr(obj, key, value)
+        # The creator's own upvote, then the recorded votes of other users on top of it
+        user_votes = {obj.user_id: Votable.VOTE_TYPE_UPVOTE}
+        obj.score += 1
+        obj.votes += 1
+        for record in vote_records:
+            user_id = self.resolve(record['user_id'][1:], root, parent)
+            if user_votes.get(user_id) != record['type']:
+                _, vote_change, score_change = Votable.resolve_vote(user_votes.get(user_id), record['type'])
+                obj.votes += vote_change
+                obj.score += score_change
+                user_votes[user_id] = record['type']
+        obj.updated_on = self.now
+        if obj.created_on is None:
+            obj.created_on = self.now
+        obj.hot_rank = obj.calculate_hot_rank(now=self.now, created_on=obj.created_on)
+        if isinstance(obj, Post):
+            Post.create_slug(sender=Post, instance=obj)
+        else:
+            obj.child_comment_count = 0
+            obj.best_rank = obj.calculate_best_rank()
+            obj.controversial_rank = obj.calculate_controversial_rank()
+        self.pending_objects += 1
+        return ImportedObject(obj, [], user_votes), children
+
+    def resolve(self, placeholder, root, parent):
+        if placeholder == 'root':
+            return root
+        elif placeholder == 'parent':
+            return parent
+        try:
+            return self.context[placeholder]
+        except KeyError:
+            raise ValueError(f'No value for the ${placeholder} placeholder')
+
+    def count_descendants(self, node):
+        count, stack = 0, list(node.children)
+        while stack:
+            child = stack.pop()
+            count += 1
+            stack += child.children
+        return count
+
+    def flush(self):
+        if not self.pending:
+            return
+        with transaction.atomic():
+            level = self.pending
+            for node in level:
+                node.obj.comment_count = self.count_descendants(node)
+            votes, karma = [], {}
+            while level:
+                model = type(level[0].obj)
+                objs = [node.obj for node in level]
+                # bulk_create stamps created_on with the current time, the imported times are written back after it
+                created_on = [obj.created_on for obj in objs]
+                model.objects.bulk_create(objs)
+                for obj, value in zip(objs, created_on):
+                    obj.created_on = value
+                model.objects.bulk_update(objs, ['created_on'])
+                votes += [Vote(user_id=user_id, target_type=node.obj.type_code, target=node.obj.id, type=type)
+                    for node in level for user_id, type in node.user_votes.items()]
+                for node in level:
+                    karma[node.obj.user_id] = karma.get(node.obj.user_id, 0) + node.obj.score
+                self.imported[model] += len(level)
+                level = [child for node in level for child in node.children]
+            Vote.objects.bulk_create(votes)
+            for user_id, change in karma.items():
+                User.add_karma(user_id, change)
+            transaction.on_commit(bump_listing_version)
+        self.pending, self.pending_objects = [], 0
@@ -0,0 +1,175 @@
+from bisect import bisect_left
+from contextlib import contextmanager
+from contextvars import ContextVar
+from threading import Lock
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from time import perf_counter
+from django.db import connections
+from django.db.backends.signals import connection_created
+from django.dispatch import receiver
+
+# Upper bounds of the histogram buckets, durations in milliseconds
+DURATION_BUCKETS = (1, 2, 5, 10, 25, 50, 100, 250, 500, 1000, 2500)
+QUERY_BUCKETS = (1, 2, 3, 5, 10, 20, 50, 100)
+
+current_timings = ContextVar('reddit_request_timings', default=None)
+
+class RequestTimings:
+    """Time spent per phase of one request in seconds, plus the number of SQL queries"""
+
+    def __init__(self):
+        self.queries = 0
+        self.durations = {'total': 0.0, 'view': 0.0, 'db': 0.0, 'serializer': 0.0}
+        self.active = set()
+
+    def get_server_timing(self):
+        return ', '.join(f'{name};dur={duration * 1000:.2f}' + (f';desc="{self.queries} queries"' if name == 'db' else '')
+            for name, duration in self.durations.items())
+
+"""Adds the time spent in the block to the current request's timings for name, nested blocks for
+the same name (like a serializer's nested serializers) are only counted once"""
+@contextmanager
+def timed(name):
+    timings = current_timings.get()
+    if timings is None or name in timings.active:
+        yield
+        return
+    timings.active.add(name)
+    start = perf_counter()
+    try:
+        yield
+    finally:
+        timings.durations[name] += perf_counter() - start
+        timings.active.discard(name)
+
+"""Database execute wrapper counting the queries and their time for the current request"""
+def record_query(execute, sql, params, many, context):
+    timings = current_timings.get()
+    if timings is None:
+        return execute(sql, params, many, context)
+    start = perf_counter()
+    try:
+        return execute(sql, params, many, context)
+    finally:
+        timings.queries += 1
+        timings.durations['db'] += perf_counter() - start
+
+def add_query_recorder(connection):
+    if record_query not in connection.execute_wrappers:
+        connection.execute_wrappers.append(record_query)
+
+"""Every thread has its own connections, the ORM work of async views runs on sync_to_async's thread rather
+than the one running the middleware, so the recorder is added to each connection when it's opened"""
+@receiver(connection_created)
+def on_connection_created(sender, connection, **kwargs):
+    add_query_recorder(connection)
+
+"""Covers the connections of the current thread opened before this module was imported"""
+def install_query_recorder():
+    for connection in connections.all():
+        add_query_recorder(connection)
+
+class Histogram:
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0
+        self.max = 0
+
+    def add(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.max = max(self.max, value)
+
+    def as_dict(self):
+        labels = [f'<={bound}' for bound in self.buckets] + [f'>{self.buckets[-1]}']
+        return {'sum': round(self.sum, 3), 'max': round(self.max, 3), 'buckets': dict(zip(labels, self.counts))}
+
+class EndpointStats:
+    """Per endpoint histograms of the request timings, kept per process like the vote buffer"""
+
+    def __init__(self):
+        self.lock = Lock()
+        self.endpoints = {}
+
+    def add(self, endpoint, timings):
+        with self.lock:
+            histograms = self.endpoints.get(endpoint)
+            if histograms is None:
+                histograms = self.endpoints[endpoint] = {'queries': Histogram(QUERY_BUCKETS),
+                    **{name: Histogram(DURATION_BUCKETS) for name in timings.durations}}
+            histograms['queries'].add(timings.queries)
+            for name, duration in timings.durations.items():
+                histograms[name].add(duration * 1000)
+
+    def as_dict(self):
+        with self.lock:
+            return {endpoint: {'requests': sum(histograms['queries'].counts), **{name: histogram.as_dict() for name, histogram in histograms.items()}}
+                for endpoint, histograms in self.endpoints.items()}
+
+    def clear(self):
+        with self.lock:
+            self.endpoints = {}
+
+endpoint_stats = EndpointStats()
+
+"""Endpoints are grouped by method and URL name, e.g. GET reddit:Post-detail"""
+def get_endpoint(request):
+    match = getattr(request, 'resolver_match', None)
+    return f'{request.method} {(match.view_name or match.route) if match else "<unresolved>"}'
+
+class TimingMiddleware:
+    """Records the query count, database, serializer, view and total time of every request. They are
+    sent back as a Server-Timing header, attached to the request as request.timings and added to the
+    per endpoint histograms shown by the stats endpoint. Goes first in MIDDLEWARE so total covers
+    the other middleware too, and supports async so it doesn't force async views back onto a thread."""
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if iscoroutinefunction(get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        timings, token, start = self.start(request)
+        try:
+            response = self.get_response(request)
+        finally:
+            current_timings.reset(token)
+        return self.finish(request, response, timings, start)
+
+    async def __acall__(self, request):
+        timings, token, start = self.start(request)
+        try:
+            response = await self.get_response(request)
+        finally:
+            current_timings.reset(token)
+        return self.finish(request, response, timings, start)
+
+    def start(self, request):
+        install_query_recorder()
+        request.timings = timings = RequestTimings()
+        return timings, current_timings.set(timings), perf_counter()
+
+    def finish(self, request, response, timings, start):
+        end = perf_counter()
+        timings.durations['total'] = end - start
+        if hasattr(request, 'view_started'):
+            timings.durations['view'] = end - request.view_started
+        response['Server-Timing'] = timings.get_server_timing()
+        endpoint_stats.add(get_endpoint(request), timings)
+        return response
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        request.view_started = perf_counter()
+
+class TimedSerializerMixin:
+    """Counts the serializer's to_representation towards the request's serializer time"""
+
+    def to_representation(self, instance):
+        with timed('serializer'):
+            return super().to_representation(instance)
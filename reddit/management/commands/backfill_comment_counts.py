@@ -0,0 +1,25 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import Count, OuterRef, Subquery
+from django.db.models.functions import Coalesce
+from reddit.models import Post, Comment
+
+
+class Command(BaseCommand):
+    help = 'Recomputes Post.comment_count from the comments table, in chunks of posts so the database is never locked for long'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--chunk-size', type=int, default=10000)
+
+    def handle(self, *args, chunk_size, **options):
+        counts = Comment.objects.filter(post=OuterRef('id')).values('post').annotate(count=Count('id')).values('count')
+        post_ids = Post.objects.order_by('id').values_list('id', flat=True)
+        last_id, updated = 0, 0
+        while True:
+            chunk = list(post_ids.filter(id__gt=last_id)[:chunk_size])
+            if not chunk:
+                break
+            with transaction.atomic():
+                updated += Post.objects.filter(id__gte=chunk[0], id__lte=chunk[-1]).update(comment_count=Coalesce(Subquery(counts), 0))
+            last_id = chunk[-1]
+        self.stdout.write(f'Recounted comments of {updated} posts')
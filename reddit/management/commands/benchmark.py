@@ -0,0 +1,76 @@
+import json
+import platform
+import sqlite3
+import subprocess
+import django
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.test.utils import setup_test_environment, teardown_test_environment
+from reddit.benchmarks import BENCHMARKS
+
+
+"""Identifies a result by its non-timing values, e.g. benchmark, scale and sort mode"""
+def get_result_key(result):
+    return tuple((key, value) for key, value in result.items() if not isinstance(value, float))
+
+def get_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def format_result(result):
+    return ' '.join(f'{key}={value:.2f}' if isinstance(value, float) else f'{key}={value}' for key, value in result.items())
+
+
+class Command(BaseCommand):
+    help = 'Runs the given benchmarks (all of them by default) against a throwaway test database'
+
+    def add_arguments(self, parser):
+        parser.add_argument('names', nargs='*', help=f'Any of: {", ".join(BENCHMARKS)}')
+        parser.add_argument('--scale', type=int, action='append', dest='scales', help='Dataset size, may be repeated')
+        parser.add_argument('--output', help='Also write the results with the commit and versions to this JSON file')
+        parser.add_argument('--compare', help='JSON file of an earlier run, prints each timing relative to it')
+
+    def handle(self, *args, names, scales, output, compare, **options):
+        unknown = set(names) - set(BENCHMARKS)
+        if unknown:
+            raise CommandError(f'Unknown benchmarks: {", ".join(sorted(unknown))}')
+        baseline = {}
+        if compare:
+            try:
+                with open(compare) as f:
+                    baseline = {get_result_key(result): result for result in json.load(f)['results']}
+            except (OSError, ValueError, KeyError) as e:
+                raise CommandError(f'Cannot read {compare}: {e}')
+        kwargs = {'scales': scales} if scales else {}
+        results = []
+        setup_test_environment()
+        try:
+            for name in names or BENCHMARKS:
+                old_name = connection.creation.create_test_db(verbosity=0, autoclobber=True)
+                try:
+                    for result in BENCHMARKS[name](**kwargs):
+                        results.append(result)
+                        self.stdout.write(format_result(result) + self.format_comparison(result, baseline))
+                finally:
+                    connection.creation.destroy_test_db(old_name, verbosity=0)
+        finally:
+            teardown_test_environment()
+        if output:
+            with open(output, 'w') as f:
+                json.dump({
+                    'commit': get_commit(),
+                    'python': platform.python_version(),
+                    'django': django.get_version(),
+                    'sqlite': sqlite3.sqlite_version,
+                    'results': results,
+                }, f, indent=2)
+
+    def format_comparison(self, result, baseline):
+        previous = baseline.get(get_result_key(result))
+        if previous is None:
+            return ''
+        ratios = [f'{key}={value / previous[key]:.2f}x' for key, value in result.items()
+            if isinstance(value, float) and previous.get(key)]
+        return f' (vs baseline: {" ".join(ratios)})' if ratios else ''
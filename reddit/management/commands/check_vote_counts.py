@@ -0,0 +1,27 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from reddit.models import Post, Comment
+
+
+class Command(BaseCommand):
+    help = 'Compares the cached votes and score of posts and comments with their vote rows, e.g. to verify write-behind flushes'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--fix', action='store_true', help='Overwrite inconsistent totals with the counted ones')
+
+    def handle(self, *args, fix, **options):
+        inconsistent = 0
+        for model in (Post, Comment):
+            rows = list(model.objects.with_inconsistent_vote_counts().values('id', 'votes', 'score', 'counted_votes', 'counted_score'))
+            inconsistent += len(rows)
+            for row in rows:
+                self.stdout.write(f'{model._meta.model_name} {row["id"]}: votes {row["votes"]} (counted {row["counted_votes"]}), score {row["score"]} (counted {row["counted_score"]})')
+            if fix and rows:
+                with transaction.atomic():
+                    # Applied as the missing vote changes, so hot_rank and the comment sort ranks follow
+                    for row in rows:
+                        model.objects.filter(id=row['id']).update(**model.get_vote_count_updates(
+                            row['counted_votes'] - row['votes'], row['counted_score'] - row['score']))
+        if inconsistent and not fix:
+            raise CommandError(f'{inconsistent} inconsistent vote counts')
+        self.stdout.write(f'{inconsistent} inconsistent vote counts{" fixed" if inconsistent else ""}')
@@ -0,0 +1,42 @@
+from django.core.management.base import BaseCommand, CommandError
+from reddit.importer import PostImporter
+from reddit.models import Comment, LeaderboardEntry, Post, User
+
+
+class UserPlaceholders(dict):
+    """Resolves $user_<n> placeholders to users named <prefix><n>, creating them on first use"""
+
+    def __init__(self, prefix, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.prefix = prefix
+
+    def __missing__(self, key):
+        if not key.startswith('user_') or self.prefix is None:
+            raise KeyError(key)
+        self[key] = User.objects.get_or_create(username=f'{self.prefix}{key[5:]}')[0].id
+        return self[key]
+
+
+class Command(BaseCommand):
+    help = 'Bulk imports posts and comment trees from a JSON file written by tools/generate-posts-for-tests.py'
+
+    def add_arguments(self, parser):
+        parser.add_argument('file')
+        parser.add_argument('--user', help='Username the $user_id placeholders refer to')
+        parser.add_argument('--user-prefix', help='$user_<n> placeholders refer to (and create) users named <prefix><n>')
+        parser.add_argument('--chunk-size', type=int, default=10000, help='Objects inserted per transaction')
+
+    def handle(self, *args, file, user, user_prefix, chunk_size, **options):
+        context = UserPlaceholders(user_prefix)
+        if user:
+            try:
+                context['user_id'] = User.objects.get(username=user).id
+            except User.DoesNotExist:
+                raise CommandError(f'User {user} does not exist')
+        with open(file) as f:
+            try:
+                imported = PostImporter(context=context, chunk_size=chunk_size).import_file(f)
+            except ValueError as e:
+                raise CommandError(e)
+        LeaderboardEntry.refresh()
+        self.stdout.write(f'Imported {imported[Post]} posts and {imported[Comment]} comments')
@@ -0,0 +1,19 @@
+from django.core.management.base import BaseCommand, CommandError
+from reddit.search import SEARCH_INDEXES
+
+
+class Command(BaseCommand):
+    help = 'Rebuilds the full text search indexes from the posts and comments tables, then merges their segments'
+
+    def add_arguments(self, parser):
+        parser.add_argument('types', nargs='*', help=f'Any of: {", ".join(SEARCH_INDEXES)}, all by default')
+
+    def handle(self, *args, types, **options):
+        unknown = set(types) - set(SEARCH_INDEXES)
+        if unknown:
+            raise CommandError(f'Unknown search indexes: {", ".join(sorted(unknown))}')
+        for name in types or SEARCH_INDEXES:
+            index = SEARCH_INDEXES[name]
+            index.rebuild()
+            index.optimize()
+            self.stdout.write(f'Rebuilt the {name} search index')
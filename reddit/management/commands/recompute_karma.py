@@ -0,0 +1,26 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import OuterRef, Subquery, Sum
+from django.db.models.functions import Coalesce
+from reddit.models import Comment, Post, User
+
+
+class Command(BaseCommand):
+    help = 'Recomputes User.karma as the total score of their posts and comments, in chunks of users so the database is never locked for long'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--chunk-size', type=int, default=1000)
+
+    def handle(self, *args, chunk_size, **options):
+        scores = [Coalesce(Subquery(model.objects.filter(user=OuterRef('id')).values('user').annotate(total=Sum('score')).values('total')), 0)
+            for model in (Post, Comment)]
+        user_ids = User.objects.order_by('id').values_list('id', flat=True)
+        last_id, updated = 0, 0
+        while True:
+            chunk = list(user_ids.filter(id__gt=last_id)[:chunk_size])
+            if not chunk:
+                break
+            with transaction.atomic():
+                updated += User.objects.filter(id__gte=chunk[0], id__lte=chunk[-1]).update(karma=scores[0] + scores[1])
+            last_id = chunk[-1]
+        self.stdout.write(f'Recomputed the karma of {updated} users')
@@ -0,0 +1,13 @@
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+from reddit.models import Post, Comment
+
+
+class Command(BaseCommand):
+    help = 'Ages the stored hot_rank of posts and comments, run it periodically (e.g. from cron every few minutes)'
+
+    def handle(self, *args, **options):
+        now = timezone.now()
+        for model in (Post, Comment):
+            updated = model.objects.refresh_hot_ranks(now=now)
+            self.stdout.write(f'Refreshed hot rank of {updated} {model._meta.verbose_name_plural}')
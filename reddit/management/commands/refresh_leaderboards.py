@@ -0,0 +1,10 @@
+from django.core.management.base import BaseCommand
+from reddit.models import LeaderboardEntry
+
+
+class Command(BaseCommand):
+    help = 'Recomputes the top past day/week/month/year leaderboards, run it periodically (e.g. from cron every few minutes) so aged out posts are replaced'
+
+    def handle(self, *args, **options):
+        LeaderboardEntry.refresh()
+        self.stdout.write(f'Refreshed leaderboards with {LeaderboardEntry.objects.count()} entries')
@@ -0,0 +1,52 @@
+# Generated by Django 4.2.30 on 2026-10-18 17:49
+
+from django.db import migrations, models
+from django.db.models import Case, ExpressionWrapper, F, When
+from django.db.models.lookups import LessThan
+from django.utils import timezone
+
+
+"""VotableManager.hot_rank_expression() as of this migration: the score divided by (or for negative scores
+multiplied by) the age in 8 hour buckets"""
+def hot_rank_expression():
+    timesince = ExpressionWrapper(timezone.now() - F('created_on'), output_field=models.BigIntegerField())
+    timecompare = timesince / 1000000 / 3600 / 8 + 1
+    return Case(
+        When(LessThan(F('score'), 0), then=F('score') * timecompare),
+        default=F('score') / timecompare,
+        output_field=models.BigIntegerField())
+
+
+def populate_hot_rank(apps, schema_editor):
+    for model_name in ('Post', 'Comment'):
+        model = apps.get_model('reddit', model_name)
+        model.objects.update(hot_rank=hot_rank_expression())
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('reddit', '0003_comment_child_comment_count'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='comment',
+            name='hot_rank',
+            field=models.BigIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='post',
+            name='hot_rank',
+            field=models.BigIntegerField(default=0),
+        ),
+        migrations.AddIndex(
+            model_name='comment',
+            index=models.Index(fields=['-hot_rank', 'id'], name='reddit_comment_hot_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='post',
+            index=models.Index(fields=['-hot_rank', 'id'], name='reddit_post_hot_idx'),
+        ),
+        migrations.RunPython(populate_hot_rank, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,29 @@
+# Generated by Django 4.2.30 on 2026-10-18 17:50
+
+from django.db import migrations, models
+from django.db.models import Count, Max
+
+
+def remove_duplicate_votes(apps, schema_editor):
+    Vote = apps.get_model('reddit', 'Vote')
+    duplicates = (Vote.objects.values('user', 'target_type', 'target')
+        .annotate(vote_count=Count('id'), latest_id=Max('id'))
+        .filter(vote_count__gt=1))
+    for duplicate in duplicates:
+        # Keep the most recent vote, it is the one the user cast last
+        Vote.objects.filter(user=duplicate['user'], target_type=duplicate['target_type'], target=duplicate['target']).exclude(id=duplicate['latest_id']).delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('reddit', '0004_votable_hot_rank'),
+    ]
+
+    operations = [
+        migrations.RunPython(remove_duplicate_votes, migrations.RunPython.noop),
+        migrations.AddConstraint(
+            model_name='vote',
+            constraint=models.UniqueConstraint(fields=('user', 'target_type', 'target'), name='reddit_vote_unique_user_target'),
+        ),
+    ]
@@ -0,0 +1,28 @@
+# Generated by Django 4.2.30 on 2026-10-18 17:55
+
+from django.db import migrations, models
+from django.db.models import Count, OuterRef, Subquery
+from django.db.models.functions import Coalesce
+
+
+def populate_comment_count(apps, schema_editor):
+    Post = apps.get_model('reddit', 'Post')
+    Comment = apps.get_model('reddit', 'Comment')
+    counts = Comment.objects.filter(post=OuterRef('id')).values('post').annotate(count=Count('id')).values('count')
+    Post.objects.update(comment_count=Coalesce(Subquery(counts), 0))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('reddit', '0005_vote_unique_user_target'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='post',
+            name='comment_count',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.RunPython(populate_comment_count, migrations.RunPython.noop),
+    ]
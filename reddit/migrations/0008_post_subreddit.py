@@ -0,0 +1,35 @@
+# Generated by Django 4.2.30 on 2026-10-18 18:29
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('reddit', '0007_votable_sort_indexes'),
+    ]
+
+    operations = [
+        migrations.RemoveField(
+            model_name='subreddit',
+            name='posts',
+        ),
+        migrations.AddField(
+            model_name='post',
+            name='subreddit',
+            field=models.ForeignKey(blank=True, db_index=False, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='posts', to='reddit.subreddit'),
+        ),
+        migrations.AddIndex(
+            model_name='post',
+            index=models.Index(fields=['subreddit', '-hot_rank', 'id'], name='reddit_post_subreddit_hot_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='post',
+            index=models.Index(fields=['subreddit', '-score', 'id', 'created_on'], name='reddit_post_subreddit_top_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='post',
+            index=models.Index(fields=['subreddit', 'created_on', 'id'], name='reddit_post_subreddit_new_idx'),
+        ),
+    ]
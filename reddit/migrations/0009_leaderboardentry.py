@@ -0,0 +1,48 @@
+# Generated by Django 4.2.30 on 2026-10-18 18:31
+
+from django.db import migrations, models
+import django.db.models.deletion
+from datetime import timedelta
+from django.utils import timezone
+
+# LeaderboardEntry.SIZE + LeaderboardEntry.SLACK and VotableManager.TOP_WINDOWS as of this migration
+CAPACITY = 1000 + 200
+TOP_WINDOWS = {
+    'top-past-year': timedelta(days=365),
+    'top-past-month': timedelta(days=31),
+    'top-past-week': timedelta(days=7),
+    'top-past-day': timedelta(days=1),
+}
+
+
+def populate_leaderboards(apps, schema_editor):
+    Post = apps.get_model('reddit', 'Post')
+    LeaderboardEntry = apps.get_model('reddit', 'LeaderboardEntry')
+    now = timezone.now()
+    for window, span in TOP_WINDOWS.items():
+        posts = Post.objects.filter(created_on__gte=now - span).order_by('-score', 'id').values_list('id', 'created_on')[:CAPACITY]
+        LeaderboardEntry.objects.bulk_create([LeaderboardEntry(window=window, post_id=id, created_on=created_on) for id, created_on in posts])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('reddit', '0008_post_subreddit'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='LeaderboardEntry',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('window', models.CharField(max_length=16)),
+                ('created_on', models.DateTimeField()),
+                ('post', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='leaderboard_entries', to='reddit.post')),
+            ],
+        ),
+        migrations.AddConstraint(
+            model_name='leaderboardentry',
+            constraint=models.UniqueConstraint(fields=('window', 'post'), name='reddit_leaderboardentry_unique_window_post'),
+        ),
+        migrations.RunPython(populate_leaderboards, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,17 @@
+# Generated by Django 4.2.30 on 2026-10-18 18:37
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('reddit', '0009_leaderboardentry'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='comment',
+            index=models.Index(fields=['post', 'updated_on'], name='reddit_comment_updated_idx'),
+        ),
+    ]
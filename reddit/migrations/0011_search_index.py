@@ -0,0 +1,46 @@
+from django.db import migrations
+
+"""Copy of reddit.search.get_search_trigger_sql as of this migration: the triggers keeping the index of columns
+of table in sync with every insert, delete and change of the indexed columns, and the SQL dropping them"""
+def get_search_trigger_sql(table, columns):
+    index = f'{table}_search'
+    names = ', '.join(columns)
+    new = ', '.join(f'new.{column}' for column in columns)
+    old = ', '.join(f'old.{column}' for column in columns)
+    changed = ' OR '.join(f'old.{column} IS NOT new.{column}' for column in columns)
+    insert = f'INSERT INTO {index}(rowid, {names}) VALUES (new.id, {new});'
+    delete = f"INSERT INTO {index}({index}, rowid, {names}) VALUES ('delete', old.id, {old});"
+    return [
+        f'CREATE TRIGGER IF NOT EXISTS {index}_insert AFTER INSERT ON {table} BEGIN {insert} END',
+        f'CREATE TRIGGER IF NOT EXISTS {index}_delete AFTER DELETE ON {table} BEGIN {delete} END',
+        f'CREATE TRIGGER IF NOT EXISTS {index}_update AFTER UPDATE OF {names} ON {table} WHEN {changed} BEGIN {delete} {insert} END',
+    ], [
+        f'DROP TRIGGER {index}_update',
+        f'DROP TRIGGER {index}_delete',
+        f'DROP TRIGGER {index}_insert',
+    ]
+
+"""FTS5 external content index over columns of table, kept in sync by triggers"""
+def create_search_index(table, columns):
+    index = f'{table}_search'
+    create_triggers, drop_triggers = get_search_trigger_sql(table, columns)
+    return migrations.RunSQL([
+        f"CREATE VIRTUAL TABLE {index} USING fts5({', '.join(columns)}, content='{table}', content_rowid='id', tokenize='porter unicode61 remove_diacritics 2')",
+        *create_triggers,
+        f"INSERT INTO {index}({index}) VALUES ('rebuild')",
+    ], [
+        *drop_triggers,
+        f'DROP TABLE {index}',
+    ])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('reddit', '0010_comment_updated_index'),
+    ]
+
+    operations = [
+        create_search_index('reddit_post', ['title', 'text']),
+        create_search_index('reddit_comment', ['text']),
+    ]
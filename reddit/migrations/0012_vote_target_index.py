@@ -0,0 +1,17 @@
+# Generated by Django 4.2.30 on 2026-10-18 19:18
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('reddit', '0011_search_index'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='vote',
+            index=models.Index(fields=['target_type', 'target'], name='reddit_vote_target_idx'),
+        ),
+    ]
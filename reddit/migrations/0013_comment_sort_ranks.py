@@ -0,0 +1,80 @@
+# Generated by Django 4.2.30 on 2026-10-18 19:27
+
+from django.db import migrations, models
+from django.db.models import Case, F, FloatField, Value, When
+from django.db.models.functions import Abs, Cast, Power, Sqrt
+from django.db.models.lookups import GreaterThan, LessThan
+
+# Copies of CommentManager.best_rank_expression and controversial_rank_expression as of this migration
+WILSON_Z = 1.281551565545
+
+
+def best_rank_expression():
+    z = WILSON_Z
+    votes, score = F('votes'), F('score')
+    n = Cast(votes, FloatField())
+    p = (n + score) / (2 * n)
+    return Case(
+        When(GreaterThan(votes, 0), then=(p + z * z / (2 * n) - z * Sqrt(p * (1 - p) / n + z * z / (4 * n * n))) / (1 + z * z / n)),
+        default=Value(0.0),
+        output_field=FloatField())
+
+
+def controversial_rank_expression():
+    votes, score = F('votes'), F('score')
+    n = Cast(votes, FloatField())
+    return Case(
+        When(LessThan(Abs(score), votes), then=Power(n, (n - Abs(score)) / (n + Abs(score)))),
+        default=Value(0.0),
+        output_field=FloatField())
+
+
+def populate_sort_ranks(apps, schema_editor):
+    apps.get_model('reddit', 'Comment').objects.update(
+        best_rank=best_rank_expression(), controversial_rank=controversial_rank_expression())
+
+# The comment search index triggers of 0011_search_index
+create_search_triggers = [
+    "CREATE TRIGGER IF NOT EXISTS reddit_comment_search_insert AFTER INSERT ON reddit_comment BEGIN INSERT INTO reddit_comment_search(rowid, text) VALUES (new.id, new.text); END",
+    "CREATE TRIGGER IF NOT EXISTS reddit_comment_search_delete AFTER DELETE ON reddit_comment BEGIN INSERT INTO reddit_comment_search(reddit_comment_search, rowid, text) VALUES ('delete', old.id, old.text); END",
+    "CREATE TRIGGER IF NOT EXISTS reddit_comment_search_update AFTER UPDATE OF text ON reddit_comment WHEN old.text IS NOT new.text BEGIN INSERT INTO reddit_comment_search(reddit_comment_search, rowid, text) VALUES ('delete', old.id, old.text); INSERT INTO reddit_comment_search(rowid, text) VALUES (new.id, new.text); END",
+]
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('reddit', '0012_vote_target_index'),
+    ]
+
+    operations = [
+        migrations.RunSQL(migrations.RunSQL.noop, create_search_triggers),
+        migrations.AddField(
+            model_name='comment',
+            name='best_rank',
+            field=models.FloatField(default=0),
+        ),
+        migrations.AddField(
+            model_name='comment',
+            name='controversial_rank',
+            field=models.FloatField(default=0),
+        ),
+        # Adding (and, depending on the SQLite version, removing) the columns remakes the table without the search index triggers
+        migrations.RunSQL(create_search_triggers, migrations.RunSQL.noop),
+        migrations.RunPython(populate_sort_ranks, migrations.RunPython.noop),
+        migrations.AddIndex(
+            model_name='comment',
+            index=models.Index(fields=['post', 'parent', '-best_rank', 'id'], name='reddit_comment_level_best_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='comment',
+            index=models.Index(fields=['post', 'parent', '-score', 'id'], name='reddit_comment_level_top_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='comment',
+            index=models.Index(fields=['post', 'parent', 'created_on', 'id'], name='reddit_comment_level_new_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='comment',
+            index=models.Index(fields=['post', 'parent', '-controversial_rank', 'id'], name='reddit_comment_level_contr_idx'),
+        ),
+    ]
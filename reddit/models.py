@@ -1,17 +1,24 @@
 from django.core.exceptions import ValidationError
-from django.db import models
+from django.db import models, router, transaction, IntegrityError
 from django.contrib.auth.models import AbstractUser
 from django.db.models.deletion import CASCADE
 from django.db.models.expressions import Value
-from django.db.models.fields import BigIntegerField, DecimalField
+from django.db.models.fields import BigIntegerField, DecimalField, FloatField
 from django.utils.translation import gettext_lazy as _
 from django.utils import timezone
 from datetime import timedelta
-from django.db.models import F, ExpressionWrapper
+from django.db.models import F, ExpressionWrapper, OuterRef, Subquery, Count, Min
+from django.core.cache import cache
+from django.db.models.functions import Abs, Cast, Coalesce, Power, Sqrt
 from django.dispatch import receiver
-from django.db.models.signals import post_save, pre_save, pre_delete
+from django.db.models.signals import post_save, pre_save, pre_delete, post_delete
 from django.template.defaultfilters import slugify
 from django.db.models import Case, When
+from django.db.models.lookups import GreaterThan, LessThan
+from .cache import bump_listing_version
+from .vote_buffer import get_vote_buffer
+from functools import partial
+from math import sqrt
 
 class Updateable(models.Model):
     created_on = models.DateTimeField(auto_now_add=True)
@@ -20,6 +27,31 @@ class Updateable(models.Model):
     class Meta:
         abstract = True
 
+class VotableQuerySet(models.QuerySet):
+
+    """Annotates every row with user_vote, the given user's vote ('u', 'd' or None), using one correlated subquery on the vote index"""
+    def with_user_vote(self, user):
+        if user is None or not user.is_authenticated:
+            return self.annotate(user_vote=Value(None, output_field=models.CharField()))
+        votes = Vote.objects.filter(user=user, target_type=self.model.type_code, target=OuterRef('id'))
+        return self.annotate(user_vote=Subquery(votes.values('type')[:1]))
+
+    """Recomputes hot_rank for every row whose rank has drifted, returns the number of rows updated"""
+    def refresh_hot_ranks(self, now=None):
+        expression = VotableManager.hot_rank_expression(now)
+        return self.exclude(hot_rank=expression).update(hot_rank=expression)
+
+    """Annotates counted_votes and counted_score, the totals recomputed from the vote rows"""
+    def with_counted_votes(self):
+        votes = Vote.objects.filter(target_type=self.model.type_code, target=OuterRef('id')).order_by().values('target')
+        def count(type):
+            return Coalesce(Subquery(votes.filter(type=type).annotate(count=Count('id')).values('count')), 0)
+        return self.annotate(counted_votes=count('u') + count('d'), counted_score=count('u') - count('d'))
+
+    """Rows whose cached votes or score disagree with their vote rows"""
+    def with_inconsistent_vote_counts(self):
+        return self.with_counted_votes().exclude(votes=F('counted_votes'), score=F('counted_score'))
+
 class VotableManager(models.Manager):
     
     TOP_ALL_TIME = 'top-all-time'
@@ -30,30 +62,100 @@ class VotableManager(models.Manager):
     NEWEST = 'newest'
     OLDEST = 'oldest'
     HOT = 'hot'
-
+    TOP_WINDOWS = {
+        TOP_PAST_YEAR: timedelta(days=365),
+        TOP_PAST_MONTH: timedelta(days=31),
+        TOP_PAST_WEEK: timedelta(days=7),
+        TOP_PAST_DAY: timedelta(days=1),
+    }
+
+    def get_queryset(self):
+        return VotableQuerySet(self.model, using=self._db)
+
+    def with_user_vote(self, user):
+        return self.get_queryset().with_user_vote(user)
+
+    def with_inconsistent_vote_counts(self):
+        return self.get_queryset().with_inconsistent_vote_counts()
+
+    """Returns {id: 'u' or 'd'} for the ids the user has voted on"""
+    def get_user_votes(self, user, ids):
+        if user is None or not user.is_authenticated:
+            return {}
+        votes = Vote.objects.filter(user=user, target_type=self.model.type_code, target__in=ids)
+        return dict(votes.values_list('target', 'type'))
+
+    async def aget_user_votes(self, user, ids):
+        if user is None or not user.is_authenticated:
+            return {}
+        votes = Vote.objects.filter(user=user, target_type=self.model.type_code, target__in=ids)
+        return {target: type async for target, type in votes.values_list('target', 'type')}
+
+    """Every ordering ends with the id so it is total, which KeysetPagination relies on"""
     def sort(self, type=None):
         if type == VotableManager.TOP_ALL_TIME:
-            return self.order_by('-score')
-        elif type == VotableManager.TOP_PAST_YEAR:
-            
-            return self.order_by('-score').filter(created_on__gte = timezone.now() - timedelta(days=365))
-        elif type == VotableManager.TOP_PAST_MONTH:
-            return self.order_by('-score').filter(created_on__gte = timezone.now() - timedelta(days=31))
-        elif type == VotableManager.TOP_PAST_WEEK:
-            return self.order_by('-score').filter(created_on__gte = timezone.now() - timedelta(days=7))
-        elif type == VotableManager.TOP_PAST_DAY:
-            return self.order_by('-score').filter(created_on__gte = timezone.now() - timedelta(days=1))
+            return self.order_by('-score', 'id')
+        elif type in VotableManager.TOP_WINDOWS:
+            return self.order_by('-score', 'id').filter(created_on__gte = timezone.now() - VotableManager.TOP_WINDOWS[type])
         elif type == VotableManager.NEWEST:
-            return self.order_by('-created_on')
+            return self.order_by('-created_on', '-id')
         elif type == VotableManager.OLDEST:
-            return self.order_by('created_on')
+            return self.order_by('created_on', 'id')
         else:
-            query = self.annotate(timesince = ExpressionWrapper(timezone.now() - F('created_on'), output_field=BigIntegerField()))
-            query = query.annotate(timecompare=F('timesince') / 1000000 / 3600 / 8 + 1)
-            return query.annotate(rating=Case(
-                When(score__lt=0, then=F('score') * F('timecompare')), 
-                default=F('score') / F('timecompare'),
-                output_field=BigIntegerField())).order_by('-rating')
+            return self.order_by('-hot_rank', 'id')
+
+    """Database side version of Votable.calculate_hot_rank, used to age the stored hot_rank column"""
+    @staticmethod
+    def hot_rank_expression(now=None, score=F('score')):
+        timesince = ExpressionWrapper((now or timezone.now()) - F('created_on'), output_field=BigIntegerField())
+        timecompare = timesince / 1000000 / 3600 / 8 + 1
+        return Case(
+            When(LessThan(score, 0), then=score * timecompare),
+            default=score / timecompare,
+            output_field=BigIntegerField())
+
+    def refresh_hot_ranks(self, now=None):
+        return self.get_queryset().refresh_hot_ranks(now)
+
+class CommentManager(VotableManager):
+
+    BEST = 'best'
+    TOP = 'top'
+    CONTROVERSIAL = 'controversial'
+    # Orderings of the replies to a post or comment, each one served by a (post, parent, ...) index of Comment
+    THREAD_ORDERINGS = {
+        BEST: ('-best_rank', 'id'),
+        TOP: ('-score', 'id'),
+        VotableManager.NEWEST: ('-created_on', '-id'),
+        VotableManager.OLDEST: ('created_on', 'id'),
+        CONTROVERSIAL: ('-controversial_rank', 'id'),
+    }
+    # The 80% confidence level reddit uses for its best sort
+    WILSON_Z = 1.281551565545
+
+    """Returns the ordering of a level of the comment tree, best for unknown types"""
+    def get_thread_ordering(self, type=None):
+        return CommentManager.THREAD_ORDERINGS.get(type, CommentManager.THREAD_ORDERINGS[CommentManager.BEST])
+
+    """Database side version of Comment.calculate_best_rank, score and votes may be expressions of the new totals"""
+    @staticmethod
+    def best_rank_expression(votes=F('votes'), score=F('score')):
+        z = CommentManager.WILSON_Z
+        n = Cast(votes, FloatField())
+        p = (n + score) / (2 * n)
+        return Case(
+            When(GreaterThan(votes, 0), then=(p + z * z / (2 * n) - z * Sqrt(p * (1 - p) / n + z * z / (4 * n * n))) / (1 + z * z / n)),
+            default=Value(0.0),
+            output_field=FloatField())
+
+    """Database side version of Comment.calculate_controversial_rank"""
+    @staticmethod
+    def controversial_rank_expression(votes=F('votes'), score=F('score')):
+        n = Cast(votes, FloatField())
+        return Case(
+            When(LessThan(Abs(score), votes), then=Power(n, (n - Abs(score)) / (n + Abs(score)))),
+            default=Value(0.0),
+            output_field=FloatField())
 
 
 class Votable(Updateable):
@@ -62,16 +164,36 @@ class Votable(Updateable):
     
     score = models.IntegerField(default=0)
     votes = models.IntegerField(default=0)
+    hot_rank = models.BigIntegerField(default=0)
     user = models.ForeignKey('User', on_delete=CASCADE)
 
     objects = VotableManager()
 
+    # The columns get_vote_count_updates() changes
+    VOTE_COUNT_FIELDS = ['votes', 'score', 'hot_rank', 'updated_on']
+
     class Meta:
         abstract = True
+        indexes = [
+            models.Index(fields=['-hot_rank', 'id'], name='%(app_label)s_%(class)s_hot_idx'),
+            models.Index(fields=['-score', 'id'], name='%(app_label)s_%(class)s_top_idx'),
+            models.Index(fields=['created_on', 'id'], name='%(app_label)s_%(class)s_new_idx'),
+        ]
 
     def get_votable_type_code(self):
         return type(self).type_code
 
+    """Score divided by (or for negative scores multiplied by) the age of the votable in 8 hour buckets"""
+    def calculate_hot_rank(self, now=None, created_on=None):
+        now = now or timezone.now()
+        if created_on is None:
+            # Saving a new row sets created_on to now
+            created_on = now if self._state.adding else self.created_on
+        timecompare = (now - created_on) // timedelta(hours=8) + 1
+        if self.score < 0:
+            return self.score * timecompare
+        return self.score // timecompare
+
     """Returns 'u' for upvotes, 'd' for downvotes None if the user hasn't voted"""
     def get_vote(self, user):
         votable_type = self.get_votable_type_code()
@@ -80,51 +202,95 @@ class Votable(Updateable):
         except Vote.DoesNotExist:
             return None
 
+    """Returns the vote a user is left with after voting `type` on top of `current_vote`, along with the resulting change to votes and score"""
+    @staticmethod
+    def resolve_vote(current_vote, type):
+        direction = 1 if type == Votable.VOTE_TYPE_UPVOTE else -1
+        if current_vote == type:
+            return None, -1, -direction
+        elif current_vote:
+            return type, 0, 2 * direction
+        return type, 1, direction
+
+    """Update expressions applying a vote's change to the cached totals, evaluated by the database so concurrent votes can't overwrite each other"""
+    @classmethod
+    def get_vote_count_updates(cls, vote_change, score_change):
+        score = F('score') + score_change
+        return {
+            'votes': F('votes') + vote_change,
+            'score': score,
+            'hot_rank': VotableManager.hot_rank_expression(score=score),
+            'updated_on': timezone.now(),
+        }
+
+    """Toggles the user's vote in a single transaction, the vote row is written first so
+    concurrent votes are serialized on it and the totals, like the author's karma, are only ever changed with relative updates.
+    In write-behind mode the totals are left to the vote buffer and only this instance is updated."""
     def vote(self, user, type):
         votable_type = self.get_votable_type_code()
-        current_vote = self.get_vote(user)
-        vote_change, score_change = 0, 0
-        if type=='u':
-            if current_vote == 'u':
-                self.remove_vote(user, 'u')
-                vote_change = -1
-                score_change = -1
+        user_votes = Vote.objects.filter(user=user, target_type=votable_type, target=self.id)
+        with transaction.atomic():
+            if user_votes.filter(type=type).delete()[0]:
+                current_vote = type
+            elif user_votes.update(type=type):
+                current_vote = Votable.VOTE_TYPE_DOWNVOTE if type == Votable.VOTE_TYPE_UPVOTE else Votable.VOTE_TYPE_UPVOTE
             else:
-                self.remove_vote(user, 'd')
-                self.add_vote(user, 'u')
-                vote_change += 0 if current_vote == 'd' else 1
-                score_change += 2 if current_vote == 'd' else 1
-
-        if type=='d':
-            if current_vote == 'd':
-                self.remove_vote(user, 'd')
-                vote_change = -1
-                score_change = 1
+                try:
+                    with transaction.atomic():
+                        Vote.objects.create(user=user, target_type=votable_type, target=self.id, type=type)
+                except IntegrityError:
+                    # A concurrent request from the same user cast this vote first
+                    return
+                current_vote = None
+            _, vote_change, score_change = Votable.resolve_vote(current_vote, type)
+            vote_buffer = get_vote_buffer()
+            if vote_buffer is None:
+                self._meta.model.objects.filter(id=self.id).update(**self.get_vote_count_updates(vote_change, score_change))
+                User.add_karma(self.user_id, score_change)
             else:
-                self.remove_vote(user, 'u')
-                self.add_vote(user, 'd')
-                vote_change += 0 if current_vote == 'u' else 1
-                score_change -= 2 if current_vote == 'u' else 1
-
-        if vote_change or score_change:
+                transaction.on_commit(partial(vote_buffer.add, self._meta.model, self.id, vote_change, score_change, author_id=self.user_id))
+        if vote_buffer is None:
+            self.refresh_from_db(fields=self.VOTE_COUNT_FIELDS)
+        else:
             self.votes += vote_change
             self.score += score_change
-            self.save()
 
-    """Add a vote to the votes table does not affect cached scores or totals or check if a vote for this user already exists"""
+    """Add a vote to the votes table replacing any existing vote by this user, does not affect cached scores or totals"""
     def add_vote(self, user, type):
         votable_type = self.get_votable_type_code()
-        return Vote.objects.create(user=user, target_type=votable_type, target=self.id, type=type)
+        return Vote.objects.update_or_create(user=user, target_type=votable_type, target=self.id, defaults={'type': type})[0]
 
     def remove_vote(self, user, type):
         votable_type = self.get_votable_type_code()
         return Vote.objects.filter(user=user, target_type=votable_type, target=self.id, type=type).delete()[0]
 
+    @receiver(pre_save)
+    def update_hot_rank(sender, instance, **kwargs):
+        if issubclass(sender, Votable):
+            instance.hot_rank = instance.calculate_hot_rank()
+
+    """Karma is the total score of the user's posts and comments, so a row created with a score (an imported
+    one for instance) adds it before the creator's own upvote"""
     @receiver(post_save)
     def add_creator_vote_to_post(sender, instance, created, **kwargs):
         if issubclass(sender, Votable) and created:
+            User.add_karma(instance.user_id, instance.score)
             instance.vote(instance.user, 'u')
 
+    """Karma is the total score of the posts and comments a user currently has. Connected per model
+    so deleting other models, votes in particular, keeps Django's signal free fast delete."""
+    @receiver(post_delete, sender='reddit.Post')
+    @receiver(post_delete, sender='reddit.Comment')
+    def remove_karma_of_deleted_votable(sender, instance, **kwargs):
+        User.add_karma(instance.user_id, -instance.score)
+
+    """Votes only reference their target by id, nothing cascades to them. Queryset and admin deletes come
+    through here, Post.delete() and Comment.delete() purge them in bulk."""
+    @receiver(post_delete, sender='reddit.Post')
+    @receiver(post_delete, sender='reddit.Comment')
+    def purge_votes_of_deleted_votable(sender, instance, using, **kwargs):
+        Vote.objects.using(using).filter(target_type=instance.type_code, target=instance.id).delete()
+
 class Vote(models.Model):
 
     VOTE_TYPE = (
@@ -136,8 +302,25 @@ class Vote(models.Model):
     target_type = models.CharField(max_length=1)
     user = models.ForeignKey('reddit.User', on_delete=models.CASCADE)
 
+    class Meta:
+        constraints = [
+            # A user has at most one vote per target, the backing index also serves every per user vote lookup
+            models.UniqueConstraint(fields=['user', 'target_type', 'target'], name='reddit_vote_unique_user_target'),
+        ]
+        indexes = [
+            # Every vote on a target, read when recounting its totals and when deleting it
+            models.Index(fields=['target_type', 'target'], name='reddit_vote_target_idx'),
+        ]
+
 class User(AbstractUser):
+    # Total score of the user's posts and comments, kept current by Votable.vote()
     karma = models.IntegerField(default=0)
+
+    """Changes a user's karma with a relative update, so concurrent votes can't overwrite each other"""
+    @classmethod
+    def add_karma(cls, id, change):
+        if change:
+            cls.objects.filter(id=id).update(karma=F('karma') + change)
     
     def get_absolute_url():
         return '/'
@@ -155,10 +338,20 @@ class Subreddit(Updateable):
     hidden = models.BooleanField(default=False)
     moderators = models.ManyToManyField(to=User, related_name='moderator')
     subscribers = models.ManyToManyField(to=User, related_name='subscriber')
-    posts = models.ForeignKey(to='Post', on_delete=CASCADE)
 
 
 
+class PostManager(VotableManager):
+
+    """Like VotableManager.sort() but reads the top past day/week/month/year listings from the
+    precomputed leaderboards, pass use_leaderboard=False for the exact (and slow) window query,
+    e.g. to further filter it"""
+    def sort(self, type=None, use_leaderboard=True):
+        if use_leaderboard and type in VotableManager.TOP_WINDOWS:
+            since = timezone.now() - VotableManager.TOP_WINDOWS[type]
+            return self.order_by('-score', 'id').filter(leaderboard_entries__window=type, leaderboard_entries__created_on__gte=since)
+        return super().sort(type)
+
 class Post(Votable):
     type_code = 'p'
 
@@ -166,8 +359,18 @@ class Post(Votable):
     slug = models.SlugField(max_length=256)
     text = models.TextField(max_length=10000, null=True, blank=True)
     link = models.CharField(max_length=256, null=True, blank=True)
+    comment_count = models.IntegerField(default=0)
+    # Not indexed on its own, the subreddit listing indexes below all start with it
+    subreddit = models.ForeignKey(Subreddit, on_delete=CASCADE, null=True, blank=True, related_name='posts', db_index=False)
 
-    objects = VotableManager()
+    objects = PostManager()
+
+    class Meta(Votable.Meta):
+        indexes = Votable.Meta.indexes + [
+            models.Index(fields=['subreddit', '-hot_rank', 'id'], name='reddit_post_subreddit_hot_idx'),
+            models.Index(fields=['subreddit', '-score', 'id', 'created_on'], name='reddit_post_subreddit_top_idx'),
+            models.Index(fields=['subreddit', 'created_on', 'id'], name='reddit_post_subreddit_new_idx'),
+        ]
 
     def is_text_post(self):
         return self.text != None
@@ -182,14 +385,109 @@ class Post(Votable):
             raise ValidationError(_('A post must contain either a link or text content'))
         super().clean(*args, **kwargs)
 
+    """Deletes the post with its comments, votes and leaderboard entries through delete_posts, a few statements
+    instead of the comment signals once per comment"""
+    def delete(self, using=None, keep_parents=False):
+        from .deletion import delete_posts
+        using = using or router.db_for_write(Post, instance=self)
+        result = delete_posts(Post.objects.using(using).filter(id=self.id), using=using)
+        self.id = None
+        return result
+
     @receiver(pre_save, sender='reddit.Post')
     def create_slug(sender, instance, **kwargs):
         instance.slug = slugify(instance.title[0:100])
 
+    def vote(self, user, type):
+        score = self.score
+        super().vote(user, type)
+        transaction.on_commit(bump_listing_version)
+        if self.score > score:
+            transaction.on_commit(partial(LeaderboardEntry.add_post, self.id, self.score, self.created_on))
+
+    @receiver(post_save, sender='reddit.Post')
+    @receiver(post_delete, sender='reddit.Post')
+    def invalidate_listings(sender, **kwargs):
+        transaction.on_commit(bump_listing_version)
+
     def __str__(self):
         return str(self.score)
     
 
+class LeaderboardEntry(models.Model):
+    """Membership of a post in the top posts of one of the TOP_PAST_* windows. A leaderboard holds the
+    SIZE best scoring posts of its window as of the last refresh(), plus SLACK more so members whose
+    score drops don't leave holes in the listing. Upvoted posts join as soon as they beat the lowest
+    member, entries are read in live score order and ignored once their post is too old, and refresh()
+    (run periodically by manage.py refresh_leaderboards) recomputes them, refilling what aged out."""
+    SIZE = 1000
+    SLACK = 200
+    THRESHOLDS_KEY = 'reddit:leaderboard-thresholds'
+    # Other processes keep their cached thresholds until this expires, reset_thresholds only clears the local copy
+    THRESHOLDS_TTL = 30
+
+    window = models.CharField(max_length=16)
+    post = models.ForeignKey(Post, on_delete=CASCADE, related_name='leaderboard_entries')
+    # Copied from the post, so aged out entries can be skipped without joining
+    created_on = models.DateTimeField()
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['window', 'post'], name='reddit_leaderboardentry_unique_window_post'),
+        ]
+
+    @classmethod
+    def refresh(cls):
+        with transaction.atomic():
+            cls.objects.all().delete()
+            for window in VotableManager.TOP_WINDOWS:
+                posts = Post.objects.sort(type=window, use_leaderboard=False)
+                cls.objects.bulk_create([cls(window=window, post_id=id, created_on=created_on)
+                    for id, created_on in posts.values_list('id', 'created_on')[:cls.SIZE + cls.SLACK]])
+            transaction.on_commit(cls.reset_thresholds)
+            transaction.on_commit(bump_listing_version)
+
+    """The score a post needs to join each full leaderboard, None for leaderboards with room left. Aged out
+    entries don't count, they are only kept until the next refresh() or add_post() to the leaderboard."""
+    @classmethod
+    def get_thresholds(cls):
+        thresholds = cache.get(cls.THRESHOLDS_KEY)
+        if thresholds is None:
+            now = timezone.now()
+            thresholds = {}
+            for window, span in VotableManager.TOP_WINDOWS.items():
+                entries = cls.objects.filter(window=window, created_on__gte=now - span).aggregate(members=Count('id'), lowest=Min('post__score'))
+                thresholds[window] = entries['lowest'] if entries['members'] >= cls.SIZE + cls.SLACK else None
+            cache.set(cls.THRESHOLDS_KEY, thresholds, timeout=cls.THRESHOLDS_TTL)
+        return thresholds
+
+    @classmethod
+    def reset_thresholds(cls):
+        cache.delete(cls.THRESHOLDS_KEY)
+
+    """Adds a post whose score went up to the leaderboards it now belongs on, dropping their aged out entries and
+    the lowest members of full ones"""
+    @classmethod
+    def add_post(cls, post_id, score, created_on):
+        now = timezone.now()
+        thresholds = cls.get_thresholds()
+        windows = [window for window, span in VotableManager.TOP_WINDOWS.items()
+            if created_on >= now - span and (thresholds[window] is None or score > thresholds[window])]
+        if not windows:
+            return
+        with transaction.atomic():
+            members = set(cls.objects.filter(post_id=post_id, window__in=windows).values_list('window', flat=True))
+            joined = [window for window in windows if window not in members]
+            if not joined:
+                return
+            cls.objects.bulk_create([cls(window=window, post_id=post_id, created_on=created_on) for window in joined], ignore_conflicts=True)
+            for window in joined:
+                cls.objects.filter(window=window, created_on__lt=now - VotableManager.TOP_WINDOWS[window]).delete()
+                if thresholds[window] is not None:
+                    lowest = cls.objects.filter(window=window).order_by('-post__score', 'post_id').values_list('id', flat=True)[cls.SIZE + cls.SLACK:]
+                    cls.objects.filter(id__in=list(lowest)).delete()
+            transaction.on_commit(cls.reset_thresholds)
+
 class Comment(Votable):
     type_code = 'c'
 
@@ -198,15 +496,95 @@ class Comment(Votable):
     text = models.TextField(max_length=10000)
     deleted = models.BooleanField(default=False)
     child_comment_count = models.IntegerField(default=0)
+    # Sort keys of the best and controversial thread orderings, kept current by Votable.vote()
+    best_rank = models.FloatField(default=0)
+    controversial_rank = models.FloatField(default=0)
+
+    objects = CommentManager()
+
+    VOTE_COUNT_FIELDS = Votable.VOTE_COUNT_FIELDS + ['best_rank', 'controversial_rank']
+
+    class Meta(Votable.Meta):
+        indexes = Votable.Meta.indexes + [
+            # The latest change to a post's comments, part of the post detail ETag
+            models.Index(fields=['post', 'updated_on'], name='reddit_comment_updated_idx'),
+            # A level of the comment tree in each of CommentManager.THREAD_ORDERINGS, read already sorted and truncated
+            models.Index(fields=['post', 'parent', '-best_rank', 'id'], name='reddit_comment_level_best_idx'),
+            models.Index(fields=['post', 'parent', '-score', 'id'], name='reddit_comment_level_top_idx'),
+            models.Index(fields=['post', 'parent', 'created_on', 'id'], name='reddit_comment_level_new_idx'),
+            models.Index(fields=['post', 'parent', '-controversial_rank', 'id'], name='reddit_comment_level_contr_idx'),
+        ]
+
+    """Lower bound of the Wilson score interval of the share of upvotes, so a comment with few votes ranks below
+    one with the same share and more votes"""
+    def calculate_best_rank(self):
+        if self.votes <= 0:
+            return 0.0
+        z, n = CommentManager.WILSON_Z, self.votes
+        p = (n + self.score) / (2 * n)
+        return (p + z * z / (2 * n) - z * sqrt(p * (1 - p) / n + z * z / (4 * n * n))) / (1 + z * z / n)
+
+    """The number of votes raised to the power of the ratio of the minority to the majority vote type,
+    0 unless the comment has both up and downvotes"""
+    def calculate_controversial_rank(self):
+        if abs(self.score) >= self.votes:
+            return 0.0
+        return self.votes ** ((self.votes - abs(self.score)) / (self.votes + abs(self.score)))
+
+    @classmethod
+    def get_vote_count_updates(cls, vote_change, score_change):
+        votes, score = F('votes') + vote_change, F('score') + score_change
+        return {
+            **super().get_vote_count_updates(vote_change, score_change),
+            'best_rank': CommentManager.best_rank_expression(votes, score),
+            'controversial_rank': CommentManager.controversial_rank_expression(votes, score),
+        }
+
+    @receiver(pre_save, sender='reddit.Comment')
+    def update_sort_ranks(sender, instance, **kwargs):
+        instance.best_rank = instance.calculate_best_rank()
+        instance.controversial_rank = instance.calculate_controversial_rank()
 
     @receiver(post_save, sender='reddit.Comment')
     def on_comment_added(sender, instance, created, **kwargs):
-        if instance.parent and created:
-            instance.parent.child_comment_count += 1
-            instance.parent.save()
+        if created:
+            instance.update_post_comment_count(1)
+        if instance.parent_id and created:
+            instance.update_parent_child_count(1)
+
+    """Deletes the comment with all its replies through delete_comment_subtrees, a few statements however large
+    the subtree instead of the signals below once per reply. Queryset deletes still go through the signals.
+    The cached parent and post are updated like the signals would."""
+    def delete(self, using=None, keep_parents=False):
+        from .deletion import delete_comment_subtrees
+        using = using or router.db_for_write(Comment, instance=self)
+        count, counts = delete_comment_subtrees(Comment.objects.using(using).filter(id=self.id), using=using)
+        if counts[Comment._meta.label]:
+            if self.parent_id and Comment.parent.is_cached(self) and self.parent is not None:
+                self.parent.child_comment_count -= 1
+            if Comment.post.is_cached(self):
+                self.post.comment_count -= counts[Comment._meta.label]
+        self.id = None
+        return count, counts
 
     @receiver(pre_delete, sender='reddit.Comment')
     def on_comment_removed(sender, instance, **kwargs):
-        if instance.parent:
-            instance.parent.child_comment_count -= 1
-            instance.parent.save()
+        instance.update_post_comment_count(-1)
+        if instance.parent_id:
+            instance.update_parent_child_count(-1)
+
+    """Relative update like update_post_comment_count, saving a possibly stale parent instance would overwrite
+    the votes it got meanwhile. A reply counts as a change to the parent, which the post detail ETag follows."""
+    def update_parent_child_count(self, change):
+        Comment.objects.filter(id=self.parent_id).update(child_comment_count=F('child_comment_count') + change, updated_on=timezone.now())
+        if Comment.parent.is_cached(self) and self.parent is not None:
+            self.parent.child_comment_count += change
+
+    """Like replies to a comment, added and deleted comments count as an update of their post"""
+    def update_post_comment_count(self, change):
+        now = timezone.now()
+        Post.objects.filter(id=self.post_id).update(comment_count=F('comment_count') + change, updated_on=now)
+        if Comment.post.is_cached(self):
+            self.post.comment_count += change
+            self.post.updated_on = now
+        transaction.on_commit(bump_listing_version)
@@ -0,0 +1,155 @@
+import heapq
+import json
+from base64 import urlsafe_b64decode, urlsafe_b64encode
+from binascii import Error as Base64Error
+from datetime import datetime, timedelta, timezone
+from itertools import islice
+from django.core.exceptions import ValidationError
+from django.db.models import Q
+from rest_framework.exceptions import NotFound
+from rest_framework.pagination import BasePagination
+from rest_framework.response import Response
+from rest_framework.utils.urls import replace_query_param
+
+EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
+
+"""Rows strictly after the position in the ordering, (field name, descending) pairs: the first differing field
+decides, like a tuple comparison. The redundant inclusive bound on the leading field lets the database turn it
+into an index range."""
+def get_keyset_filter(ordering, position):
+    keyset_filter = Q()
+    for i, ((name, descending), value) in enumerate(zip(ordering, position)):
+        after = Q(**{f'{name}__lt' if descending else f'{name}__gt': value})
+        equal = Q(**{name: value for (name, _), value in zip(ordering[:i], position[:i])})
+        keyset_filter |= equal & after
+    (name, descending), value = ordering[0], position[0]
+    return Q(**{f'{name}__lte' if descending else f'{name}__gte': value}) & keyset_filter
+
+class KeysetPagination(BasePagination):
+    """Cursor pagination that follows whatever ordering the queryset already has (VotableManager.sort
+    always ends its ordering with the id), the cursor holds the ordering values of the last row of
+    the page, so fetching any page is a range read on the sort index no matter how deep it is."""
+
+    page_size = 25
+    max_page_size = 100
+    cursor_query_param = 'cursor'
+    page_size_query_param = 'page_size'
+    invalid_cursor_message = 'Invalid cursor'
+
+    def get_page_size(self, request):
+        try:
+            return max(1, min(int(request.query_params[self.page_size_query_param]), self.max_page_size))
+        except (KeyError, ValueError):
+            return self.page_size
+
+    """Returns (field name, descending) for every field the queryset is ordered by"""
+    def get_ordering(self, queryset):
+        ordering = queryset.query.order_by or ('id',)
+        return [(field.lstrip('-'), field.startswith('-')) for field in ordering]
+
+    """Rows are model instances or, for values() querysets, dicts"""
+    def get_value(self, row, name):
+        return row[name] if isinstance(row, dict) else getattr(row, name)
+
+    """The position is written like Field.value_to_string() would"""
+    def encode_cursor(self, queryset, row):
+        values = [self.get_value(row, name) for name, _ in self.ordering]
+        position = [value.isoformat() if isinstance(value, datetime) else str(value) for value in values]
+        return urlsafe_b64encode(json.dumps(position).encode()).decode()
+
+    def decode_cursor(self, queryset, cursor):
+        try:
+            position = json.loads(urlsafe_b64decode(cursor.encode()))
+            if not isinstance(position, list) or len(position) != len(self.ordering):
+                raise ValueError
+            return [queryset.model._meta.get_field(name).to_python(value) for (name, _), value in zip(self.ordering, position)]
+        except (Base64Error, ValueError, TypeError, ValidationError):
+            raise NotFound(self.invalid_cursor_message)
+
+    """Returns the queryset of the requested page with one extra row, which tells whether there is a next page"""
+    def get_page_queryset(self, queryset, request):
+        self.request = request
+        self.ordering = self.get_ordering(queryset)
+        if not queryset.query.order_by:
+            queryset = queryset.order_by('id')
+        cursor = request.query_params.get(self.cursor_query_param)
+        if cursor:
+            queryset = queryset.filter(get_keyset_filter(self.ordering, self.decode_cursor(queryset, cursor)))
+        self.current_page_size = self.get_page_size(request)
+        return queryset[:self.current_page_size + 1]
+
+    def get_page(self, queryset, rows):
+        self.next_cursor = self.encode_cursor(queryset, rows[self.current_page_size - 1]) if len(rows) > self.current_page_size else None
+        return rows[:self.current_page_size]
+
+    def paginate_queryset(self, queryset, request, view=None):
+        queryset = self.get_page_queryset(queryset, request)
+        return self.get_page(queryset, list(queryset))
+
+    async def apaginate_queryset(self, queryset, request):
+        queryset = self.get_page_queryset(queryset, request)
+        return self.get_page(queryset, [row async for row in queryset])
+
+    """Paginates the union of querysets with the same ordering, like one per subreddit, without making the
+    database sort the union: every queryset's page is a range read on its own index and the pages are merged"""
+    def paginate_querysets(self, querysets, request):
+        pages = [self.get_page_queryset(queryset, request) for queryset in querysets]
+        if not pages:
+            self.next_cursor = None
+            return []
+        rows = list(islice(heapq.merge(*pages, key=self.get_sort_key), self.current_page_size + 1))
+        return self.get_page(pages[0], rows)
+
+    """Key that sorts rows in the queryset's ordering, descending fields are negated"""
+    def get_sort_key(self, row):
+        key = []
+        for name, descending in self.ordering:
+            value = self.get_value(row, name)
+            if isinstance(value, datetime):
+                value = (value - EPOCH) // timedelta(microseconds=1)
+            key.append(-value if descending else value)
+        return key
+
+    def get_next_link(self):
+        if self.next_cursor is None:
+            return None
+        return replace_query_param(self.request.build_absolute_uri(), self.cursor_query_param, self.next_cursor)
+
+    def get_paginated_response(self, data):
+        return Response({'next': self.get_next_link(), 'results': data})
+
+    def get_paginated_response_schema(self, schema):
+        return {
+            'type': 'object',
+            'properties': {
+                'next': {'type': 'string', 'nullable': True},
+                'results': schema,
+            },
+        }
+
+class SearchPagination(KeysetPagination):
+    """Keyset pagination of SearchIndex results, which are ordered by (rank, id) rather than by model fields.
+    Ranks depend on the whole index, so pages fetched across writes may skip or repeat a result."""
+
+    def decode_cursor(self, queryset, cursor):
+        try:
+            position = json.loads(urlsafe_b64decode(cursor.encode()))
+            rank, id = position
+            if not isinstance(rank, (int, float)) or not isinstance(id, int):
+                raise ValueError
+            return rank, id
+        except (Base64Error, ValueError, TypeError):
+            raise NotFound(self.invalid_cursor_message)
+
+    """Returns one page of (id, rank) results of the search for text in index"""
+    def paginate_search(self, index, text, request):
+        self.request = request
+        self.current_page_size = self.get_page_size(request)
+        cursor = request.query_params.get(self.cursor_query_param)
+        rows = index.search(text, self.decode_cursor(None, cursor) if cursor else None, self.current_page_size + 1)
+        if len(rows) > self.current_page_size:
+            id, rank = rows[self.current_page_size - 1]
+            self.next_cursor = urlsafe_b64encode(json.dumps([rank, id]).encode()).decode()
+        else:
+            self.next_cursor = None
+        return rows[:self.current_page_size]
@@ -0,0 +1,71 @@
+from contextvars import ContextVar
+from django.conf import settings
+from django.core import checks
+from django.core.cache import caches
+from django.core.cache.backends.dummy import DummyCache
+from django.core.cache.backends.locmem import LocMemCache
+from django.db import DEFAULT_DB_ALIAS
+from django.db.backends.signals import connection_created
+from django.dispatch import receiver
+
+# Alias the current request reads from, set by ReplicaReadsMixin
+read_database = ContextVar('reddit_read_database', default=None)
+
+class ReplicaRouter:
+    """Sends the reads of views using ReplicaReadsMixin to settings.REDDIT_READ_REPLICA and everything else,
+    writes in particular, to the primary. Writes are routed explicitly because Django would otherwise
+    save an instance to the database it was read from."""
+
+    def db_for_read(self, model, **hints):
+        return read_database.get()
+
+    def db_for_write(self, model, **hints):
+        return DEFAULT_DB_ALIAS
+
+    """The replica holds the same rows as the primary"""
+    def allow_relation(self, obj1, obj2, **hints):
+        return True
+
+    """The replica gets its schema with the rows it copies from the primary, migrating it would write to it"""
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        if db == getattr(settings, 'REDDIT_READ_REPLICA', None):
+            return False
+        return None
+
+def get_sticky_key(user):
+    return f'reddit:read-primary:{user.pk}'
+
+"""The cache holding the stickiness flags, shared by every worker process since the write and the next reads
+may be served by different ones"""
+def get_sticky_cache():
+    return caches[settings.REDDIT_REPLICA_CACHE]
+
+"""Keeps the user's reads on the primary until the replica has caught up with their write"""
+def stick_to_primary(user):
+    get_sticky_cache().set(get_sticky_key(user), True, timeout=settings.REDDIT_REPLICA_STICKINESS)
+
+"""The alias the user's reads go to, None for the primary"""
+def get_read_database(user):
+    replica = getattr(settings, 'REDDIT_READ_REPLICA', None)
+    if replica is None or (user.is_authenticated and get_sticky_cache().get(get_sticky_key(user))):
+        return None
+    return replica
+
+@checks.register(checks.Tags.caches)
+def check_sticky_cache(app_configs, **kwargs):
+    if getattr(settings, 'REDDIT_READ_REPLICA', None) is None:
+        return []
+    if isinstance(get_sticky_cache(), (LocMemCache, DummyCache)):
+        return [checks.Error(
+            f'REDDIT_REPLICA_CACHE ({settings.REDDIT_REPLICA_CACHE!r}) has to be shared between worker processes to read from a replica.',
+            hint='Point REDDIT_REPLICA_CACHE to a cache server or a FileBasedCache.',
+            id='reddit.E001')]
+    return []
+
+@receiver(connection_created)
+def set_sqlite_pragmas(sender, connection, **kwargs):
+    # The replica's file belongs to the replication tool, switching its journal mode would write to it
+    if connection.vendor == 'sqlite' and connection.alias != getattr(settings, 'REDDIT_READ_REPLICA', None):
+        with connection.cursor() as cursor:
+            for name, value in getattr(settings, 'REDDIT_SQLITE_PRAGMAS', {}).items():
+                cursor.execute(f'PRAGMA {name} = {value}')
@@ -0,0 +1,86 @@
+import re
+from django.db import connection
+from .models import Comment, Post
+
+"""SQL creating the triggers that keep the FTS5 index <table>_search of columns in sync on every insert, delete
+and change of the indexed columns, and the SQL dropping them. Triggers rather than signals, so bulk_create(),
+update() and raw deletes are covered. Migrations that make SQLite remake the table drop its triggers, they
+have to create them again."""
+def get_search_trigger_sql(table, columns):
+    index = f'{table}_search'
+    names = ', '.join(columns)
+    new = ', '.join(f'new.{column}' for column in columns)
+    old = ', '.join(f'old.{column}' for column in columns)
+    changed = ' OR '.join(f'old.{column} IS NOT new.{column}' for column in columns)
+    insert = f'INSERT INTO {index}(rowid, {names}) VALUES (new.id, {new});'
+    delete = f"INSERT INTO {index}({index}, rowid, {names}) VALUES ('delete', old.id, {old});"
+    return [
+        f'CREATE TRIGGER IF NOT EXISTS {index}_insert AFTER INSERT ON {table} BEGIN {insert} END',
+        f'CREATE TRIGGER IF NOT EXISTS {index}_delete AFTER DELETE ON {table} BEGIN {delete} END',
+        # save() writes every column, only actual changes of the indexed ones are reindexed
+        f'CREATE TRIGGER IF NOT EXISTS {index}_update AFTER UPDATE OF {names} ON {table} WHEN {changed} BEGIN {delete} {insert} END',
+    ], [
+        f'DROP TRIGGER {index}_update',
+        f'DROP TRIGGER {index}_delete',
+        f'DROP TRIGGER {index}_insert',
+    ]
+
+class SearchIndex:
+    """SQLite FTS5 index <db_table>_search over text columns of a model, reading their content from the model's table.
+    Triggers created by the migrations keep it in sync with every insert, update and delete, including
+    bulk ones that skip the model signals. Results are ranked by bm25 with the columns weighted as given,
+    boosted by the logarithm of the score so that of two equally relevant rows the better voted comes first."""
+
+    # Ranks are multiplied by 1 + SCORE_WEIGHT * ln(1 + score), e.g. by about 1.7 for a score of 1000
+    SCORE_WEIGHT = 0.1
+
+    def __init__(self, model, weights, condition='1'):
+        self.model = model
+        self.content_table = model._meta.db_table
+        self.table = f'{self.content_table}_search'
+        self.weights = weights
+        # SQL condition on the model's row t, leaves out rows that aren't shown like deleted comments
+        self.condition = condition
+
+    """FTS5 query matching rows containing every word of text, None when text has no words. The words are
+    quoted so that nothing the user types is read as FTS5 query syntax."""
+    def get_match_query(self, text):
+        words = re.findall(r'\w+', text)
+        return ' '.join(f'"{word}"' for word in words) or None
+
+    """Returns (id, rank) of up to limit rows matching text in rank order (lower is better), starting after
+    the (rank, id) position of the last row of the previous page if given"""
+    def search(self, text, after=None, limit=25):
+        match = self.get_match_query(text)
+        if match is None:
+            return []
+        weights = ', '.join(str(weight) for weight in self.weights.values())
+        # bm25() is negative, more so for better matches, so the boost multiplies it
+        sql = f'''SELECT id, rank FROM (
+            SELECT t.id AS id, bm25({self.table}, {weights}) * (1 + %s * LN(1 + MAX(t.score, 0))) AS rank
+            FROM {self.table} JOIN {self.content_table} t ON t.id = {self.table}.rowid
+            WHERE {self.table} MATCH %s AND {self.condition}
+        )'''
+        params = [self.SCORE_WEIGHT, match]
+        if after is not None:
+            sql += ' WHERE rank > %s OR (rank = %s AND id > %s)'
+            params += [after[0], after[0], after[1]]
+        with connection.cursor() as cursor:
+            cursor.execute(sql + ' ORDER BY rank, id LIMIT %s', params + [limit])
+            return cursor.fetchall()
+
+    """Rebuilds the index from the content table, for when the triggers were bypassed or the index got corrupted"""
+    def rebuild(self):
+        with connection.cursor() as cursor:
+            cursor.execute(f"INSERT INTO {self.table}({self.table}) VALUES ('rebuild')")
+
+    """Merges the index segments, which makes queries faster after many small writes"""
+    def optimize(self):
+        with connection.cursor() as cursor:
+            cursor.execute(f"INSERT INTO {self.table}({self.table}) VALUES ('optimize')")
+
+# Titles count four times as much as text
+SEARCH_INDEXES = {
+    'posts': SearchIndex(Post, {'title': 4.0, 'text': 1.0}),
+    'comments': SearchIndex(Comment, {'text': 1.0}, condition='NOT t.deleted'),
+}
@@ -0,0 +1,40 @@
+import json
+from itertools import islice
+from rest_framework.utils.encoders import JSONEncoder
+
+# Rows fetched per database round trip and serialized per batch, the most a streamed response holds at once
+CHUNK_SIZE = 500
+
+def dumps(data):
+    return json.dumps(data, cls=JSONEncoder, ensure_ascii=False, separators=(',', ':'))
+
+"""Yields the lists of up to size items of iterable"""
+def batched(iterable, size):
+    iterator = iter(iterable)
+    while batch := list(islice(iterator, size)):
+        yield batch
+
+"""Rows of queryset read CHUNK_SIZE at a time, without filling the queryset's result cache"""
+def iterate_chunked(queryset):
+    return queryset.iterator(chunk_size=CHUNK_SIZE)
+
+"""Serialized rows of queryset, read through a chunked iterator and serialized a chunk at a time"""
+def serialize_chunks(queryset, serializer_class, context=None):
+    for rows in batched(iterate_chunked(queryset), CHUNK_SIZE):
+        yield from serializer_class(rows, many=True, context=context or {}).data
+
+"""Yields the JSON of data with its key name holding the list of items, written a chunk of items at a time"""
+def stream_json_object(data, name, items):
+    head = dumps({**data, name: []})
+    # Cut off the ']}' closing the empty list, the items go after its '['
+    yield head[:-2]
+    separator = ''
+    for batch in batched(items, CHUNK_SIZE):
+        yield separator + ','.join(dumps(item) for item in batch)
+        separator = ','
+    yield ']}'
+
+"""Newline delimited JSON, one line per item"""
+def stream_ndjson(items):
+    for batch in batched(items, CHUNK_SIZE):
+        yield ''.join(dumps(item) + '\n' for item in batch)
@@ -1,11 +1,39 @@
-from django.test import TestCase
+import asyncio
+from django.test import AsyncClient, TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from threading import Thread
+import sys
+from unittest import mock, skipUnless
+from asgiref.sync import sync_to_async
+from rest_framework.test import APIClient
 from django.utils import timezone
-from .models import Post, User, VotableManager, Vote
-from json import load
+from django.core.management import call_command
+from django.core.management.base import CommandError
+from django.conf import settings
+from django.db import DatabaseError, IntegrityError, connection, connections, router, transaction
+from io import StringIO
+from django.core.cache import cache
+from .cache import LISTING_VERSION_KEY, bump_listing_version, get_listing_key, get_or_compute
+from .models import Comment, LeaderboardEntry, Post, Subreddit, User, VotableManager, Vote
+from .vote_buffer import get_vote_buffer
+from .voting import apply_votes
+from .importer import PostImporter, iter_json_array
+from .datagen import DatasetGenerator
+from .deletion import delete_comment_subtrees, delete_posts
+from .comment_tree import CommentTree
+from .instrumentation import endpoint_stats, get_endpoint
+from .serializers import POST_ROW_FIELDS, PostSerializer, serialize_post_rows
+from .throttling import CacheSlidingWindowLimiter, SlidingWindowLimiter
+from .views import VoteViewSet
+from .routers import check_sticky_cache, get_sticky_key
+from json import dumps, load, loads
 from os.path import join
+from tempfile import gettempdir
 from datetime import datetime, timedelta
 from django.utils.timezone import make_aware
 from pydoc import locate
+from random import Random
+from base64 import urlsafe_b64encode
 
 # Create your tests here.
 def load_objects_from_file(type, file, context={}):
@@ -34,6 +62,26 @@ def create_object_from_data(data, context={}, depth=0):
     obj.save()
     return obj
 
+class QueryBudgetMixin:
+    """Asserts responses stay within the query budget of their endpoint, counted by TimingMiddleware"""
+    QUERY_BUDGETS = {
+        # The page, plus the requesting user's votes on it
+        'GET reddit:Post-list': 2,
+        # The ETag validators, the post, plus one query per comment tree level
+        'GET reddit:Post-detail': 1 + 1 + CommentTree.DEFAULT_DEPTH,
+        # The async views only support session authentication, loading the session and its user takes two more
+        'GET reddit:async-post-list': 2 + 2,
+        'GET reddit:async-post-detail': 2 + 1 + CommentTree.DEFAULT_DEPTH,
+    }
+
+    def assertWithinQueryBudget(self, response, exactly=None):
+        request = response.wsgi_request if hasattr(response, 'wsgi_request') else response.asgi_request
+        endpoint = get_endpoint(request)
+        queries = request.timings.queries
+        self.assertLessEqual(queries, self.QUERY_BUDGETS[endpoint], f'{endpoint} made {queries} queries')
+        if exactly is not None:
+            self.assertEquals(queries, exactly, f'{endpoint} made {queries} queries')
+
 class PostVotableModelTest(TestCase):
 
     def setUp(self):
@@ -42,6 +90,8 @@ class PostVotableModelTest(TestCase):
         self.user3 = User.objects.create(username='test3', password='pjkwvb86hj')
         self.posts = load_objects_from_file(Post, 'posts.json', context={'user_id': self.user.id})
         self.post = self.posts[0]
+        # The loader backdates created_on after saving, the leaderboards only see that on a refresh
+        LeaderboardEntry.refresh()
 
     def test_sorting_by_hot_correctly_sorts_posts(self):
         db_sorted = Post.objects.sort()
@@ -54,6 +104,21 @@ class PostVotableModelTest(TestCase):
         py_sorted = sorted(self.posts, key=sort_function, reverse=True)
         self.assertQuerysetEqual(db_sorted, py_sorted)
 
+    def test_voting_updates_hot_rank(self):
+        post = Post.objects.create(title='test_new_post_title_hot', text='test_new_post_text', user=self.user)
+        self.assertEquals(post.hot_rank, 1)
+        post.vote(self.user2, 'd')
+        self.assertEquals(Post.objects.get(id=post.id).hot_rank, 0)
+        post.vote(self.user3, 'd')
+        self.assertEquals(Post.objects.get(id=post.id).hot_rank, -1)
+
+    def test_refresh_hot_ranks_ages_hot_rank(self):
+        Post.objects.filter(id=self.post.id).update(created_on=timezone.now() - timedelta(days=3), score=100)
+        call_command('refresh_hot_ranks', stdout=StringIO())
+        self.assertEquals(Post.objects.get(id=self.post.id).hot_rank, 100 // 10)
+        for post in Post.objects.all():
+            self.assertEquals(post.hot_rank, post.calculate_hot_rank())
+
     def test_sorting_by_newest_sorts_by_newest(self):
         db_sorted = Post.objects.sort(type=VotableManager.NEWEST)
         py_sorted = sorted(self.posts, key=lambda p: p.created_on, reverse=True)
@@ -97,14 +162,23 @@ class PostVotableModelTest(TestCase):
         self.post.add_vote(self.user2, 'u')
         self.assertEquals(Vote.objects.filter(user=self.user2, target=self.post.id, target_type=self.post.type_code, type='u').count(), 1)
 
-    def test_remove_vote_removes_the_correct_votes_and_returns_the_number_of_votes_removed(self):
+    def test_add_vote_replaces_an_existing_vote_by_the_same_user(self):
         self.post.add_vote(self.user2, 'u')
         self.post.add_vote(self.user2, 'u')
-        self.assertEquals(Vote.objects.filter(user=self.user2, target=self.post.id, target_type=self.post.type_code, type='u').count(), 2)
-        self.assertEquals(self.post.remove_vote(self.user2, 'u'), 2)
-        self.assertEquals(Vote.objects.filter(user=self.user2, target=self.post.id, target_type=self.post.type_code, type='u').count(), 0)
+        self.assertEquals(Vote.objects.filter(user=self.user2, target=self.post.id, target_type=self.post.type_code).count(), 1)
+        self.post.add_vote(self.user2, 'd')
+        self.assertEquals(Vote.objects.filter(user=self.user2, target=self.post.id, target_type=self.post.type_code).get().type, 'd')
+
+    def test_votes_are_unique_per_user_and_target(self):
+        Vote.objects.create(user=self.user2, target=self.post.id, target_type=self.post.type_code, type='u')
+        with self.assertRaises(IntegrityError), transaction.atomic():
+            Vote.objects.create(user=self.user2, target=self.post.id, target_type=self.post.type_code, type='d')
+
+    def test_remove_vote_removes_the_correct_votes_and_returns_the_number_of_votes_removed(self):
         self.post.add_vote(self.user2, 'u')
+        self.assertEquals(self.post.remove_vote(self.user2, 'd'), 0)
         self.assertEquals(self.post.remove_vote(self.user2, 'u'), 1)
+        self.assertEquals(Vote.objects.filter(user=self.user2, target=self.post.id, target_type=self.post.type_code, type='u').count(), 0)
         self.assertEquals(self.post.remove_vote(self.user2, 'u'), 0)
 
     def test_get_vote_correctly_returns_the_users_vote(self):
@@ -146,6 +220,1176 @@ class PostVotableModelTest(TestCase):
         self.assertEquals(post.votes, 1)
         self.assertEquals(post.get_vote(self.user2), None)
 
+    def test_vote_uses_a_bounded_number_of_queries_and_does_not_rewrite_the_post(self):
+        post = Post.objects.create(title='test_new_post_title_vote', text='test_new_post_text', user=self.user)
+        for type in ('u', 'd', 'd'):
+            with CaptureQueriesContext(connection) as context:
+                post.vote(self.user2, type)
+            queries = [query['sql'] for query in context.captured_queries if 'SAVEPOINT' not in query['sql']]
+            # Vote row changes, the post's totals, the author's karma and the refresh
+            self.assertLessEqual(len(queries), 6)
+            self.assertFalse([sql for sql in queries if sql.startswith('UPDATE "reddit_post"') and '"text"' in sql])
+
+    def test_votes_cast_through_stale_instances_are_not_lost(self):
+        first = Post.objects.get(id=self.post.id)
+        second = Post.objects.get(id=self.post.id)
+        first.vote(self.user2, 'u')
+        second.vote(self.user3, 'u')
+        first.vote(self.user3, 'd')
+        post = Post.objects.get(id=self.post.id)
+        self.assertEquals(post.score, self.post.score + 2 - 2)
+        self.assertEquals(post.votes, self.post.votes + 2)
+        self.assertEquals(first.score, post.score)
+
+class ConcurrentVoteTest(TransactionTestCase):
+
+    def test_concurrent_votes_keep_counters_exact(self):
+        users = [User.objects.create(username=f'voter{i}') for i in range(8)]
+        post = Post.objects.create(title='test_concurrent_votes', text='test_new_post_text', user=users[0])
+        # Every user ends on an upvote after an odd number of clicks per worker
+        clicks = ['u', 'd', 'u', 'u', 'u']
+        errors = []
+
+        def worker(user):
+            try:
+                instance = Post.objects.get(id=post.id)
+                for type in clicks:
+                    instance.vote(user, type)
+            except Exception as e:
+                errors.append(e)
+            finally:
+                connection.close()
+
+        threads = [Thread(target=worker, args=(user,)) for user in users[1:]]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEquals(errors, [])
+        post.refresh_from_db()
+        self.assertEquals(post.score, Vote.objects.filter(target=post.id, target_type='p', type='u').count())
+        self.assertEquals(post.score, len(users))
+        self.assertEquals(post.votes, len(users))
+
+class PostApiTest(TestCase):
+
+    def setUp(self):
+        self.user = User.objects.create(username='test1', password='pjkwvb86hj')
+        self.user2 = User.objects.create(username='test2', password='pjkwvb86hj')
+        self.posts = [Post.objects.create(title=f'test_api_post_{i}', text='test_new_post_text', user=self.user) for i in range(5)]
+        self.client = APIClient()
+        self.client.force_authenticate(self.user2)
+        cache.clear()
+
+    def get_vote_queries(self, context):
+        return [query['sql'] for query in context.captured_queries if query['sql'].startswith('SELECT "reddit_vote"')]
+
+    def test_post_list_includes_the_requesting_users_vote_without_extra_queries(self):
+        self.posts[0].vote(self.user2, 'u')
+        self.posts[1].vote(self.user2, 'd')
+        with CaptureQueriesContext(connection) as context:
+            response = self.client.get('/posts/')
+        votes = {post['id']: post['vote'] for post in response.json()['results']}
+        self.assertEquals(votes, {self.posts[0].id: 'u', self.posts[1].id: 'd', **{post.id: None for post in self.posts[2:]}})
+        # One query for the whole page, added on top of the cached listing
+        self.assertEquals(len(self.get_vote_queries(context)), 1)
+
+    def test_post_detail_includes_the_requesting_users_vote_on_comments_without_extra_queries(self):
+        post = self.posts[0]
+        comments = [post.comment_set.create(user=self.user, text=f'comment_text_{i}') for i in range(3)]
+        comments[0].vote(self.user2, 'd')
+        with CaptureQueriesContext(connection) as context:
+            response = self.client.get(f'/posts/{post.id}/')
+        votes = {comment['id']: comment['vote'] for comment in response.json()['comments']}
+        self.assertEquals(votes, {comments[0].id: 'd', comments[1].id: None, comments[2].id: None})
+        self.assertEquals(self.get_vote_queries(context), [])
+
+    def test_post_list_query_count_does_not_depend_on_the_page_size(self):
+        for post in self.posts:
+            post.comment_set.create(user=self.user, text='comment_text')
+        with CaptureQueriesContext(connection) as context:
+            response = self.client.get('/posts/', {'page_size': 5})
+        self.assertEquals([post['comment_count'] for post in response.json()['results']], [1] * len(self.posts))
+        self.posts += [Post.objects.create(title=f'test_api_post_extra_{i}', text='test_new_post_text', user=self.user) for i in range(5)]
+        with self.assertNumQueries(len(context.captured_queries)):
+            response = self.client.get('/posts/', {'page_size': 10})
+        self.assertEquals(len(response.json()['results']), len(self.posts))
+
+    def test_anonymous_users_have_no_vote(self):
+        response = APIClient().get('/posts/')
+        self.assertEquals({post['vote'] for post in response.json()['results']}, {None})
+
+    def get_all_pages(self, sort, page_size=2):
+        ids, response = [], self.client.get('/posts/', {'sort': sort, 'page_size': page_size}).json()
+        while True:
+            ids += [post['id'] for post in response['results']]
+            if not response['next']:
+                return ids
+            response = self.client.get(response['next']).json()
+
+    def test_paginating_through_every_sort_mode_returns_the_sorted_posts(self):
+        for i, post in enumerate(self.posts):
+            # Repeated scores and timestamps so the id tie breaker is exercised
+            Post.objects.filter(id=post.id).update(score=i % 2, hot_rank=i % 3, created_on=timezone.now() - timedelta(hours=i % 2))
+        sorts = [VotableManager.HOT, VotableManager.NEWEST, VotableManager.OLDEST, VotableManager.TOP_ALL_TIME, VotableManager.TOP_PAST_YEAR,
+            VotableManager.TOP_PAST_MONTH, VotableManager.TOP_PAST_WEEK, VotableManager.TOP_PAST_DAY]
+        for sort in sorts:
+            self.assertEquals(self.get_all_pages(sort), list(Post.objects.sort(type=sort).values_list('id', flat=True)))
+
+    def test_pages_stay_stable_when_scores_change_between_fetches(self):
+        for i, post in enumerate(self.posts):
+            Post.objects.filter(id=post.id).update(score=100 - i)
+        first_page = self.client.get('/posts/', {'sort': VotableManager.TOP_ALL_TIME, 'page_size': 2}).json()
+        self.assertEquals([post['id'] for post in first_page['results']], [post.id for post in self.posts[:2]])
+        # Posts voted past the cursor and new posts at the top would shift an OFFSET page, not a keyset page
+        self.posts[1].vote(self.user2, 'u')
+        self.posts[0].vote(self.user2, 'd')
+        new_post = Post.objects.create(title='test_api_post_new', text='test_new_post_text', user=self.user)
+        Post.objects.filter(id=new_post.id).update(score=1000)
+        second_page = self.client.get(first_page['next']).json()
+        self.assertEquals([post['id'] for post in second_page['results']], [post.id for post in self.posts[2:4]])
+
+    def test_invalid_cursors_are_rejected(self):
+        self.assertEquals(self.client.get('/posts/', {'cursor': 'not-a-cursor'}).status_code, 404)
+
+    def test_post_list_is_cached_until_votes_change_the_ranking(self):
+        self.client.get('/posts/', {'sort': VotableManager.TOP_ALL_TIME})
+        with self.assertNumQueries(1):
+            # Only the requesting user's votes are loaded
+            response = self.client.get('/posts/', {'sort': VotableManager.TOP_ALL_TIME})
+        self.assertEquals(response.json()['results'][0]['id'], self.posts[0].id)
+        with self.captureOnCommitCallbacks(execute=True):
+            self.posts[4].vote(self.user2, 'u')
+        response = self.client.get('/posts/', {'sort': VotableManager.TOP_ALL_TIME})
+        self.assertEquals(response.json()['results'][0]['id'], self.posts[4].id)
+        self.assertEquals(response.json()['results'][0]['vote'], 'u')
+
+    def test_cached_post_lists_include_each_users_own_votes(self):
+        self.posts[0].vote(self.user2, 'd')
+        self.client.get('/posts/')
+        client = APIClient()
+        client.force_authenticate(self.user)
+        votes = {post['id']: post['vote'] for post in client.get('/posts/').json()['results']}
+        self.assertEquals(votes, {post.id: 'u' for post in self.posts})
+
+    def test_listing_rows_serialize_exactly_like_post_serializer(self):
+        subreddit = Subreddit.objects.create(slug='sub', name='sub', owner=self.user)
+        Post.objects.filter(id=self.posts[0].id).update(link='https://example.com/', subreddit=subreddit)
+        self.posts[1].vote(self.user2, 'd')
+        queryset = Post.objects.sort(type=VotableManager.NEWEST).with_user_vote(self.user2)
+        expected = [dict(post) for post in PostSerializer(queryset, many=True).data]
+        self.assertEquals(serialize_post_rows(queryset.values(*POST_ROW_FIELDS)), expected)
+        self.assertEquals(self.client.get('/posts/', {'sort': VotableManager.NEWEST}).json()['results'], expected)
+
+class SubredditFeedTest(TestCase):
+
+    def setUp(self):
+        self.user = User.objects.create(username='test1', password='pjkwvb86hj')
+        self.reader = User.objects.create(username='test2', password='pjkwvb86hj')
+        self.subreddits = [Subreddit.objects.create(slug=f'sub{i}', name=f'sub{i}', owner=self.user) for i in range(4)]
+        now = timezone.now()
+        for i in range(40):
+            post = Post.objects.create(title=f'test_feed_post_{i}', text='test_new_post_text', user=self.user, subreddit=self.subreddits[i % 4])
+            # Plenty of ties in every sort mode
+            Post.objects.filter(id=post.id).update(score=i % 5, hot_rank=i % 3, created_on=now - timedelta(hours=i % 7))
+        self.subreddits[0].subscribers.add(self.reader)
+        self.subreddits[2].subscribers.add(self.reader)
+        self.subreddits[3].subscribers.add(self.reader)
+        self.client = APIClient()
+        self.client.force_authenticate(self.reader)
+        cache.clear()
+
+    def get_all_pages(self, url, params):
+        ids, response = [], self.client.get(url, params).json()
+        while True:
+            ids += [post['id'] for post in response['results']]
+            if not response['next']:
+                return ids
+            response = self.client.get(response['next']).json()
+
+    def test_subreddit_listing_only_contains_the_subreddits_posts(self):
+        for sort in (VotableManager.HOT, VotableManager.TOP_ALL_TIME, VotableManager.TOP_PAST_WEEK, VotableManager.NEWEST):
+            ids = self.get_all_pages('/posts/', {'sort': sort, 'subreddit': 'sub1', 'page_size': 3})
+            expected = Post.objects.sort(type=sort, use_leaderboard=False).filter(subreddit='sub1').values_list('id', flat=True)
+            self.assertEquals(ids, list(expected))
+            self.assertEquals(self.client.get('/posts/', {'sort': sort, 'subreddit': 'sub1'}).json()['results'][0]['subreddit'], 'sub1')
+
+    def test_home_feed_merges_the_subscribed_subreddits_in_sort_order(self):
+        for sort in (VotableManager.HOT, VotableManager.TOP_ALL_TIME, VotableManager.TOP_PAST_DAY, VotableManager.NEWEST, VotableManager.OLDEST):
+            ids = self.get_all_pages('/posts/home/', {'sort': sort, 'page_size': 4})
+            expected = Post.objects.sort(type=sort, use_leaderboard=False).filter(subreddit__in=['sub0', 'sub2', 'sub3']).values_list('id', flat=True)
+            self.assertEquals(ids, list(expected))
+
+    def test_home_feed_reads_one_page_per_subreddit_and_requires_login(self):
+        with CaptureQueriesContext(connection) as context:
+            response = self.client.get('/posts/home/', {'page_size': 5})
+        self.assertEquals(len(response.json()['results']), 5)
+        # The subscriptions, then a page from each subscribed subreddit
+        self.assertEquals(len(context.captured_queries), 1 + 3)
+        self.client.force_authenticate(None)
+        self.assertIn(self.client.get('/posts/home/').status_code, (401, 403))
+
+class LeaderboardTest(TestCase):
+
+    def setUp(self):
+        for name, value in (('SIZE', 3), ('SLACK', 1)):
+            patcher = mock.patch.object(LeaderboardEntry, name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        cache.clear()
+        self.user = User.objects.create(username='test1', password='pjkwvb86hj')
+        self.voters = [User.objects.create(username=f'voter{i}', password='pjkwvb86hj') for i in range(5)]
+        with self.captureOnCommitCallbacks(execute=True):
+            self.posts = [Post.objects.create(title=f'test_top_post_{i}', text='test_new_post_text', user=self.user) for i in range(6)]
+        for post, votes in zip(self.posts, (5, 4, 3, 2, 1, 0)):
+            with self.captureOnCommitCallbacks(execute=True):
+                for voter in self.voters[:votes]:
+                    post.vote(voter, 'u')
+        LeaderboardEntry.refresh()
+
+    def get_top(self, window=VotableManager.TOP_PAST_DAY):
+        return list(Post.objects.sort(type=window).values_list('id', flat=True))
+
+    def test_leaderboards_hold_the_best_posts_of_every_window(self):
+        for window in VotableManager.TOP_WINDOWS:
+            self.assertEquals(self.get_top(window), [post.id for post in self.posts[:4]])
+            self.assertEquals(self.get_top(window), list(Post.objects.sort(type=window, use_leaderboard=False).values_list('id', flat=True)[:4]))
+
+    def test_upvoted_posts_join_when_they_beat_the_lowest_member(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            for voter in self.voters[:3]:
+                self.posts[5].vote(voter, 'u')
+        # Score 4 beats the lowest member (score 3), which is dropped to make room, and ties with posts[2]
+        self.assertEquals(self.get_top(), [self.posts[i].id for i in (0, 1, 2, 5)])
+        with self.captureOnCommitCallbacks(execute=True):
+            self.posts[4].vote(self.voters[1], 'u')
+        self.assertNotIn(self.posts[4].id, self.get_top())
+
+    def test_members_are_read_in_live_score_order(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            for voter in self.voters[:4]:
+                self.posts[0].vote(voter, 'u')
+        self.assertEquals(self.get_top(), [self.posts[i].id for i in (1, 2, 3, 0)])
+
+    def test_aged_out_posts_disappear_and_refresh_refills(self):
+        Post.objects.filter(id=self.posts[0].id).update(created_on=timezone.now() - timedelta(days=2))
+        LeaderboardEntry.objects.filter(post=self.posts[0]).update(created_on=timezone.now() - timedelta(days=2))
+        self.assertEquals(self.get_top(), [post.id for post in self.posts[1:4]])
+        self.assertIn(self.posts[0].id, self.get_top(VotableManager.TOP_PAST_WEEK))
+        call_command('refresh_leaderboards', stdout=StringIO())
+        self.assertEquals(self.get_top(), [post.id for post in self.posts[1:5]])
+
+    def test_aged_out_entries_leave_room_and_are_dropped_on_add(self):
+        LeaderboardEntry.objects.filter(post=self.posts[0]).update(created_on=timezone.now() - timedelta(days=2))
+        LeaderboardEntry.reset_thresholds()
+        self.assertIsNone(LeaderboardEntry.get_thresholds()[VotableManager.TOP_PAST_DAY])
+        with self.captureOnCommitCallbacks(execute=True):
+            self.posts[5].vote(self.voters[0], 'u')
+        self.assertEquals(self.get_top(), [self.posts[i].id for i in (1, 2, 3, 5)])
+        self.assertFalse(LeaderboardEntry.objects.filter(window=VotableManager.TOP_PAST_DAY, post=self.posts[0]).exists())
+
+    def test_top_listings_are_served_from_the_leaderboards(self):
+        response = APIClient().get('/posts/', {'sort': VotableManager.TOP_PAST_MONTH})
+        self.assertEquals([post['id'] for post in response.json()['results']], [post.id for post in self.posts[:4]])
+
+class ConditionalGetTest(TestCase):
+
+    def setUp(self):
+        self.user = User.objects.create(username='test1', password='pjkwvb86hj')
+        self.user2 = User.objects.create(username='test2', password='pjkwvb86hj')
+        self.post = Post.objects.create(title='test_new_post_title', text='test_new_post_text', user=self.user)
+        self.comment = self.post.comment_set.create(user=self.user, text='comment_text')
+        self.client = APIClient()
+        self.client.force_authenticate(self.user2)
+        cache.clear()
+
+    def assertNotModified(self, url, **headers):
+        with CaptureQueriesContext(connection) as context:
+            response = self.client.get(url, **headers)
+        self.assertEquals(response.status_code, 304)
+        # Only the validators are computed
+        self.assertLessEqual(len(context.captured_queries), 1)
+
+    def test_post_detail_is_not_modified_until_the_post_or_its_comments_change(self):
+        url = f'/posts/{self.post.id}/'
+        response = self.client.get(url)
+        etag, last_modified = response['ETag'], response['Last-Modified']
+        self.assertNotModified(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertNotModified(url, HTTP_IF_MODIFIED_SINCE=last_modified)
+        for change in (lambda: self.comment.vote(self.user2, 'u'), lambda: self.post.comment_set.create(user=self.user, text='reply', parent=self.comment)):
+            change()
+            response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+            self.assertEquals(response.status_code, 200)
+            self.assertNotEquals(response['ETag'], etag)
+            etag = response['ETag']
+
+    def test_invalid_post_ids_are_not_found(self):
+        for url in ('/posts/abc/', '/posts/abc/stream/'):
+            self.assertEquals(self.client.get(url).status_code, 404)
+
+    def test_last_modified_does_not_go_back_when_the_latest_comment_is_deleted(self):
+        url = f'/posts/{self.post.id}/'
+        Post.objects.filter(id=self.post.id).update(updated_on=timezone.now() - timedelta(days=1))
+        Comment.objects.filter(id=self.comment.id).update(updated_on=timezone.now() - timedelta(hours=1))
+        last_modified = self.client.get(url)['Last-Modified']
+        Comment.objects.get(id=self.comment.id).delete()
+        self.assertEquals(self.client.get(url, HTTP_IF_MODIFIED_SINCE=last_modified).status_code, 200)
+
+    def test_validators_differ_between_users_and_query_strings(self):
+        url = f'/posts/{self.post.id}/'
+        etag = self.client.get(url)['ETag']
+        self.assertEquals(self.client.get(url, {'depth': 1}, HTTP_IF_NONE_MATCH=etag).status_code, 200)
+        self.client.force_authenticate(self.user)
+        self.assertEquals(self.client.get(url, HTTP_IF_NONE_MATCH=etag).status_code, 200)
+
+    def test_post_listing_is_not_modified_until_the_listing_version_changes(self):
+        etag = self.client.get('/posts/')['ETag']
+        self.assertNotModified('/posts/', HTTP_IF_NONE_MATCH=etag)
+        with self.captureOnCommitCallbacks(execute=True):
+            self.post.vote(self.user2, 'd')
+        self.assertEquals(self.client.get('/posts/', HTTP_IF_NONE_MATCH=etag).status_code, 200)
+
+class ListingCacheTest(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.computed = 0
+
+    def compute(self):
+        self.computed += 1
+        return self.computed
+
+    def test_entries_are_computed_once_until_they_expire(self):
+        self.assertEquals(get_or_compute('key', self.compute, ttl=-1), 1)
+        self.assertEquals(get_or_compute('key', self.compute), 2)
+        self.assertEquals(get_or_compute('key', self.compute), 2)
+
+    def test_expired_entries_are_served_stale_while_another_worker_recomputes(self):
+        get_or_compute('key', self.compute, ttl=-1)
+        cache.add('key:lock', True)
+        self.assertEquals(get_or_compute('key', self.compute), 1)
+        self.assertEquals(self.computed, 1)
+
+    def test_bumping_the_version_changes_every_listing_key(self):
+        key = get_listing_key('/posts/')
+        self.assertEquals(get_listing_key('/posts/'), key)
+        bump_listing_version()
+        self.assertNotEquals(get_listing_key('/posts/'), key)
+        cache.delete(LISTING_VERSION_KEY)
+        self.assertNotEquals(get_listing_key('/posts/'), key)
+
+@override_settings(REDDIT_VOTE_WRITE_BEHIND={'flush_interval': 3600, 'flush_size': 3})
+class WriteBehindVoteTest(TestCase):
+
+    def setUp(self):
+        self.users = [User.objects.create(username=f'test{i}', password='pjkwvb86hj') for i in range(4)]
+        with self.captureOnCommitCallbacks(execute=True):
+            self.post = Post.objects.create(title='test_new_post_title', text='test_new_post_text', user=self.users[0])
+
+    def test_votes_are_recorded_immediately_and_totals_on_flush(self):
+        self.assertEquals(self.post.score, 1)
+        self.assertEquals(Post.objects.get(id=self.post.id).score, 0)
+        self.assertEquals(get_vote_buffer().flush(), 1)
+        self.assertEquals(Post.objects.get(id=self.post.id).score, 1)
+        with self.captureOnCommitCallbacks(execute=True):
+            self.post.vote(self.users[1], 'u')
+            self.post.vote(self.users[2], 'd')
+        self.assertEquals(self.post.get_vote(self.users[2]), 'd')
+        self.assertEquals(Post.objects.get(id=self.post.id).votes, 1)
+        with self.captureOnCommitCallbacks(execute=True):
+            # Reaches the flush size
+            self.post.vote(self.users[3], 'u')
+        post = Post.objects.get(id=self.post.id)
+        self.assertEquals((post.score, post.votes), (2, 4))
+        call_command('check_vote_counts', stdout=StringIO())
+
+    def test_check_vote_counts_reports_and_fixes_inconsistent_totals(self):
+        get_vote_buffer().flush()
+        Post.objects.filter(id=self.post.id).update(score=5)
+        with self.assertRaises(CommandError):
+            call_command('check_vote_counts', stdout=StringIO())
+        call_command('check_vote_counts', '--fix', stdout=StringIO())
+        self.assertEquals(Post.objects.get(id=self.post.id).score, 1)
+        call_command('check_vote_counts', stdout=StringIO())
+
+    def test_karma_changes_are_applied_on_flush(self):
+        get_vote_buffer().flush()
+        with self.captureOnCommitCallbacks(execute=True):
+            self.post.vote(self.users[1], 'd')
+            self.post.vote(self.users[2], 'd')
+        self.assertEquals(User.objects.get(id=self.users[0].id).karma, 1)
+        get_vote_buffer().flush()
+        self.assertEquals(User.objects.get(id=self.users[0].id).karma, -1)
+
+    def test_changes_of_a_failed_flush_are_kept_for_the_next_one(self):
+        buffer = get_vote_buffer()
+        with mock.patch.object(User, 'add_karma', side_effect=DatabaseError('unavailable')):
+            with self.assertRaises(DatabaseError):
+                buffer.flush()
+        self.assertEquals((buffer.pending_votes, len(buffer.pending), len(buffer.pending_karma)), (0, 1, 1))
+        self.assertEquals(buffer.flush(), 1)
+        self.assertEquals(Post.objects.get(id=self.post.id).score, 1)
+        self.assertEquals(User.objects.get(id=self.users[0].id).karma, 1)
+
+class VoteThrottleTest(TestCase):
+
+    def setUp(self):
+        self.users = [User.objects.create(username=f'test{i}', password='pjkwvb86hj') for i in range(3)]
+        self.posts = [Post.objects.create(title=f'test_vote_post_{i}', text='test_new_post_text', user=self.users[0]) for i in range(3)]
+        self.client = APIClient()
+        self.client.force_authenticate(self.users[1])
+
+    def vote(self, post, type='u'):
+        return self.client.post(f'/posts/{post.id}/vote/', {'type': type})
+
+    def test_vote_endpoint_toggles_the_users_vote(self):
+        response = self.vote(self.posts[0]).json()
+        self.assertEquals((response['score'], response['vote']), (2, 'u'))
+        response = self.vote(self.posts[0], 'd').json()
+        self.assertEquals((response['score'], response['vote']), (0, 'd'))
+        response = self.vote(self.posts[0], 'd').json()
+        self.assertEquals((response['score'], response['vote']), (1, None))
+        self.assertEquals(self.vote(self.posts[0], 'x').status_code, 400)
+        self.assertEquals(APIClient().post(f'/posts/{self.posts[0].id}/vote/', {'type': 'u'}).status_code, 403)
+
+    @override_settings(REDDIT_VOTE_THROTTLE={'user': '2/min', 'target': '2/min'})
+    def test_votes_over_the_limits_are_refused_before_any_query(self):
+        self.assertEquals([self.vote(post).status_code for post in self.posts[:2]], [200, 200])
+        with self.assertNumQueries(0):
+            response = self.vote(self.posts[2])
+        self.assertEquals(response.status_code, 429)
+        self.assertIn('Retry-After', response)
+        # Other users can still vote, until the post's own limit is reached
+        self.client.force_authenticate(self.users[0])
+        self.assertEquals(self.vote(self.posts[0]).status_code, 200)
+        self.client.force_authenticate(self.users[2])
+        self.assertEquals(self.vote(self.posts[0]).status_code, 429)
+        self.assertEquals(self.vote(self.posts[1]).status_code, 200)
+
+    def test_limiters_count_a_sliding_window(self):
+        for limiter in (SlidingWindowLimiter(10, 60), CacheSlidingWindowLimiter(10, 60, cache, 'test')):
+            cache.clear()
+            for i in range(10):
+                self.assertEquals(limiter.get_wait(['a'], now=i), 0)
+                limiter.add(['a'], now=i)
+            self.assertEquals(limiter.get_wait(['a'], now=59), 1)
+            self.assertEquals(limiter.get_wait(['b'], now=59), 0)
+            # Half way through the next window half of the previous window's hits still count
+            self.assertEquals(limiter.get_wait(['a'], hits=5, now=90), 0)
+            self.assertEquals(limiter.get_wait(['a'], hits=6, now=90), 6)
+            limiter.add(['a'], hits=5, now=90)
+            self.assertEquals(limiter.get_wait(['a'], now=90), 6)
+            self.assertEquals(limiter.get_wait(['a'], now=150), 0)
+
+    def test_concurrent_acquires_never_exceed_the_limit(self):
+        limiter = SlidingWindowLimiter(50, 60)
+        acquired = []
+        def acquire():
+            for _ in range(20):
+                if not limiter.try_acquire(['a', 'b'], now=30):
+                    acquired.append(1)
+        threads = [Thread(target=acquire) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEquals(len(acquired), 50)
+        self.assertEquals(limiter.try_acquire(['b'], now=30), 30)
+        self.assertEquals(limiter.try_acquire(['c'], now=30), 0)
+
+# The limiters live as long as the process and the users' ids repeat between tests, so only the tests
+# about the rate limits enable them
+@override_settings(REDDIT_VOTE_THROTTLE=None)
+class BatchVoteTest(TestCase):
+
+    def setUp(self):
+        self.users = [User.objects.create(username=f'test{i}', password='pjkwvb86hj') for i in range(3)]
+        self.posts = [Post.objects.create(title=f'test_batch_post_{i}', text='test_new_post_text', user=self.users[i % 2]) for i in range(3)]
+        self.comments = [self.posts[i % 2].comment_set.create(user=self.users[2 - i % 2], text=f'comment_text_{i}') for i in range(3)]
+        self.posts[0].vote(self.users[1], 'd')
+        self.comments[1].vote(self.users[1], 'u')
+        self.client = APIClient()
+        self.client.force_authenticate(self.users[1])
+        cache.clear()
+
+    def get_state(self):
+        return (sorted(Vote.objects.values_list('user_id', 'target_type', 'target', 'type')),
+            sorted(Post.objects.values_list('id', 'score', 'votes', 'hot_rank')),
+            sorted(Comment.objects.values_list('id', 'score', 'votes', 'hot_rank')),
+            sorted(User.objects.values_list('id', 'karma')))
+
+    def test_batch_has_the_same_outcome_as_voting_one_at_a_time(self):
+        random = Random(0)
+        targets = [('p', post.id) for post in self.posts] + [('c', comment.id) for comment in self.comments]
+        votes = [(*random.choice(targets), random.choice('ud')) for _ in range(40)]
+        try:
+            with transaction.atomic():
+                for type_code, id, type in votes:
+                    (Post if type_code == 'p' else Comment).objects.get(id=id).vote(self.users[1], type)
+                expected = self.get_state()
+                raise DatabaseError('roll back the sequential votes')
+        except DatabaseError:
+            pass
+        response = self.client.post('/votes/batch/', [{'target_type': type_code, 'target': id, 'type': type} for type_code, id, type in votes], format='json')
+        self.assertEquals(response.status_code, 200)
+        self.assertEquals(self.get_state(), expected)
+        results = {(result['target_type'], result['target']): result for result in response.json()}
+        self.assertEquals(set(results), set(targets))
+        for post in Post.objects.with_user_vote(self.users[1]):
+            self.assertEquals((results['p', post.id]['vote'], results['p', post.id]['score']), (post.user_vote, post.score))
+
+    def test_batch_queries_do_not_depend_on_the_number_of_votes(self):
+        posts = [Post.objects.create(title=f'test_batch_post_extra_{i}', text='test_new_post_text', user=self.users[0]) for i in range(8)]
+        get_votes = lambda posts: [{'target_type': 'p', 'target': post.id, 'type': type} for post in posts for type in 'dud']
+        with CaptureQueriesContext(connection) as context:
+            self.client.post('/votes/batch/', get_votes(posts[:2]), format='json')
+        with self.assertNumQueries(len(context.captured_queries)):
+            self.client.post('/votes/batch/', get_votes(posts[2:]), format='json')
+
+    def test_invalid_batches_are_rejected_without_any_vote(self):
+        state = self.get_state()
+        for votes in ([{'target_type': 'p', 'target': self.posts[0].id, 'type': 'x'}],
+                [{'target_type': 'p', 'target': self.posts[0].id, 'type': 'u'}, {'target_type': 'p', 'target': 0, 'type': 'u'}],
+                [{'target_type': 'p', 'target': self.posts[0].id, 'type': 'u'}] * (VoteViewSet.max_batch_size + 1)):
+            self.assertEquals(self.client.post('/votes/batch/', votes, format='json').status_code, 400)
+        self.assertEquals(self.get_state(), state)
+
+    @override_settings(REDDIT_VOTE_THROTTLE={'user': '3/min', 'target': '100/min'})
+    def test_every_vote_of_a_batch_counts_towards_the_rate_limit(self):
+        votes = [{'target_type': 'p', 'target': post.id, 'type': 'u'} for post in self.posts]
+        self.assertEquals(self.client.post('/votes/batch/', votes, format='json').status_code, 200)
+        self.assertEquals(self.client.post('/votes/batch/', votes[:1], format='json').status_code, 429)
+
+    @override_settings(REDDIT_VOTE_THROTTLE={'user': '3/min', 'target': '100/min'})
+    def test_repeated_votes_on_one_target_count_one_by_one(self):
+        votes = [{'target_type': 'p', 'target': self.posts[0].id, 'type': type} for type in 'udud']
+        self.assertEquals(self.client.post('/votes/batch/', votes, format='json').status_code, 429)
+        self.assertEquals(self.client.post('/votes/batch/', votes[:3], format='json').status_code, 200)
+        self.assertEquals(self.client.post('/votes/batch/', votes[:1], format='json').status_code, 429)
+
+class BulkDeleteTest(TestCase):
+
+    def setUp(self):
+        self.users = [User.objects.create(username=f'test{i}', password='pjkwvb86hj') for i in range(3)]
+        self.posts = [Post.objects.create(title=f'test_delete_post_{i}', text='test_new_post_text', user=self.users[i]) for i in range(3)]
+        # Three levels under each post, the first comment of a post is the parent of the next two
+        self.comments = []
+        for i in range(9):
+            post = self.posts[i % 3]
+            parent = self.comments[i - 3] if i >= 3 else None
+            self.comments.append(post.comment_set.create(user=self.users[(i + 1) % 3], text=f'comment_text_{i}', parent=parent))
+        for i, comment in enumerate(self.comments):
+            comment.vote(self.users[i % 3], 'd')
+        self.posts[0].vote(self.users[1], 'u')
+        LeaderboardEntry.refresh()
+
+    def get_state(self):
+        return (sorted(Post.objects.values_list('id', 'comment_count')),
+            sorted(Comment.objects.values_list('id', 'parent_id', 'child_comment_count')),
+            sorted(User.objects.values_list('id', 'karma')),
+            sorted(LeaderboardEntry.objects.values_list('window', 'post_id')),
+            sorted(Vote.objects.values_list('target_type', 'target', 'user_id', 'type')))
+
+    """The state after deleting each instance the usual way, rolled back"""
+    def get_expected_state(self, instances):
+        try:
+            with transaction.atomic():
+                for instance in instances:
+                    # Queryset deletes go through the collector and the delete signals, one row at a time
+                    type(instance).objects.filter(id=instance.id).delete()
+                expected = self.get_state()
+                raise DatabaseError('roll back the deletes')
+        except DatabaseError:
+            return expected
+
+    def assert_votes_purged(self):
+        self.assertFalse(Vote.objects.filter(target_type='p').exclude(target__in=Post.objects.values('id')).exists())
+        self.assertFalse(Vote.objects.filter(target_type='c').exclude(target__in=Comment.objects.values('id')).exists())
+
+    def test_deleting_comment_subtrees_has_the_same_outcome_as_deleting_them_one_by_one(self):
+        # The second root is part of the first one's subtree
+        roots = [self.comments[0], self.comments[3], self.comments[4], self.comments[8]]
+        expected = self.get_expected_state(roots)
+        with self.captureOnCommitCallbacks(execute=True):
+            count, counts = delete_comment_subtrees(Comment.objects.filter(id__in=[root.id for root in roots]))
+        self.assertEquals(counts['reddit.Comment'], 6)
+        self.assertEquals(counts['reddit.Vote'], 12)
+        self.assertEquals(count, 18)
+        self.assertEquals(self.get_state(), expected)
+        self.assert_votes_purged()
+        self.assertEquals(Comment.objects.get(id=self.comments[1].id).child_comment_count, 0)
+
+    def test_deleting_posts_has_the_same_outcome_as_deleting_them_one_by_one(self):
+        expected = self.get_expected_state(self.posts[:2])
+        self.assertTrue(LeaderboardEntry.objects.filter(post__in=self.posts[:2]).exists())
+        with self.captureOnCommitCallbacks(execute=True):
+            _, counts = delete_posts(Post.objects.filter(id__in=[post.id for post in self.posts[:2]]))
+        self.assertEquals((counts['reddit.Post'], counts['reddit.Comment']), (2, 6))
+        self.assertEquals(self.get_state(), expected)
+        self.assert_votes_purged()
+
+    def test_deleting_a_thread_takes_the_same_queries_whatever_its_size(self):
+        # A chain of replies by the post's author, who loses the same karma for every comment
+        def create_thread(size):
+            post = Post.objects.create(title=f'test_delete_thread_{size}', text='test_new_post_text', user=self.users[0])
+            parent = None
+            for i in range(size):
+                parent = post.comment_set.create(user=self.users[0], text=f'reply_{i}', parent=parent)
+            return post
+        small, large = create_thread(2), create_thread(20)
+        for delete, threads in ((delete_comment_subtrees, [Comment.objects.filter(post=post, parent=None) for post in (small, large)]),
+                (delete_posts, [Post.objects.filter(id=post.id) for post in (small, large)])):
+            with CaptureQueriesContext(connection) as context:
+                delete(threads[0])
+            with self.assertNumQueries(len(context.captured_queries)):
+                delete(threads[1])
+
+    def test_instance_deletes_go_through_the_bulk_path(self):
+        expected = self.get_expected_state([self.posts[0], self.comments[1]])
+        with mock.patch('reddit.deletion.delete_posts', wraps=delete_posts) as bulk_delete_posts, \
+                mock.patch('reddit.deletion.delete_comment_subtrees', wraps=delete_comment_subtrees) as bulk_delete_comments:
+            Post.objects.get(id=self.posts[0].id).delete(using='default')
+            Comment.objects.get(id=self.comments[1].id).delete(using='default')
+        self.assertEquals((bulk_delete_posts.call_count, bulk_delete_comments.call_count), (1, 1))
+        self.assertEquals(self.get_state(), expected)
+
+    def test_queryset_deletes_purge_the_votes_too(self):
+        Comment.objects.filter(id=self.comments[2].id).delete()
+        Post.objects.filter(id=self.posts[1].id).delete()
+        self.assert_votes_purged()
+
+    def test_deleting_a_post_through_the_api_deletes_its_thread(self):
+        admin = User.objects.create(username='test_admin', is_superuser=True)
+        client = APIClient()
+        client.force_authenticate(admin)
+        self.assertEquals(client.delete(f'/posts/{self.posts[0].id}/').status_code, 204)
+        self.assertFalse(Comment.objects.filter(post_id=self.posts[0].id).exists())
+        self.assert_votes_purged()
+
+@skipUnless('replica' in settings.DATABASES, 'set REDDIT_REPLICA_DB to define the replica database')
+@override_settings(REDDIT_READ_REPLICA='replica')
+class ReplicaRoutingTest(TransactionTestCase):
+    databases = '__all__'
+
+    def setUp(self):
+        self.user = User.objects.create(username='test1', password='pjkwvb86hj')
+        self.reader = User.objects.create(username='test2', password='pjkwvb86hj')
+        self.post = Post.objects.create(title='test_replica_post', text='test_new_post_text', user=self.user)
+        self.client = APIClient()
+        self.client.force_authenticate(self.reader)
+        cache.clear()
+
+    """Copies the primary to the replica, like the replication tool would"""
+    def replicate(self):
+        connections['default'].ensure_connection()
+        connections['replica'].ensure_connection()
+        connections['default'].connection.backup(connections['replica'].connection)
+
+    def get_score(self, client):
+        return client.get(f'/posts/{self.post.id}/').json()['score']
+
+    def test_post_reads_go_to_the_replica_and_writes_to_the_primary(self):
+        self.replicate()
+        unreplicated = Post.objects.create(title='test_unreplicated_post', text='test_new_post_text', user=self.user)
+        self.assertEquals(self.client.get(f'/posts/{unreplicated.id}/').status_code, 404)
+        self.assertEquals(self.get_score(self.client), 1)
+        replica_post = Post.objects.using('replica').get(id=self.post.id)
+        replica_post.title = 'test_replica_post_renamed'
+        replica_post.save()
+        self.assertEquals(Post.objects.using('default').get(id=self.post.id).title, 'test_replica_post_renamed')
+        with override_settings(REDDIT_READ_REPLICA=None):
+            self.assertEquals(self.client.get(f'/posts/{self.post.id}/').json()['title'], 'test_replica_post_renamed')
+
+    def test_users_never_get_a_listing_cached_from_the_replica_before_it_caught_up(self):
+        self.replicate()
+        voter = APIClient()
+        voter.force_authenticate(self.user)
+        self.assertEquals(voter.post(f'/posts/{self.post.id}/vote/', {'type': 'u'}).json()['score'], 0)
+        # Another reader caches the listing of the new version from the lagging replica first
+        self.assertEquals(self.client.get('/posts/').json()['results'][0]['score'], 1)
+        self.assertEquals(voter.get('/posts/').json()['results'][0]['score'], 0)
+
+    def test_users_read_their_own_votes_from_the_primary(self):
+        self.replicate()
+        voter = APIClient()
+        voter.force_authenticate(self.user)
+        self.assertEquals(voter.post(f'/posts/{self.post.id}/vote/', {'type': 'u'}).json()['score'], 0)
+        self.assertEquals(self.get_score(voter), 0)
+        # Until the replica catches up everyone else still sees the old score
+        self.assertEquals(self.get_score(self.client), 1)
+        cache.delete(get_sticky_key(self.user))
+        self.assertEquals(self.get_score(voter), 1)
+        self.replicate()
+        self.assertEquals(self.get_score(self.client), 0)
+
+@override_settings(REDDIT_READ_REPLICA='replica')
+class ReplicaSettingsTest(TestCase):
+
+    def test_the_replica_is_not_migrated(self):
+        self.assertFalse(router.allow_migrate('replica', 'reddit', model_name='post'))
+        self.assertTrue(router.allow_migrate('default', 'reddit', model_name='post'))
+
+    def test_a_process_local_sticky_cache_is_refused(self):
+        caches = {
+            'local': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'},
+            'shared': {'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache', 'LOCATION': join(gettempdir(), 'reddit-test-cache')},
+        }
+        with override_settings(CACHES={**settings.CACHES, **caches}, REDDIT_REPLICA_CACHE='local'):
+            self.assertEquals([error.id for error in check_sticky_cache(None)], ['reddit.E001'])
+        with override_settings(CACHES={**settings.CACHES, **caches}, REDDIT_REPLICA_CACHE='shared'):
+            self.assertEquals(check_sticky_cache(None), [])
+
+class SQLitePragmaTest(TransactionTestCase):
+    databases = '__all__'
+
+    def test_connections_use_wal_and_the_configured_pragmas(self):
+        for alias in connections:
+            with connections[alias].cursor() as cursor:
+                pragmas = [cursor.execute(f'PRAGMA {name}').fetchone()[0] for name in ('journal_mode', 'synchronous', 'busy_timeout')]
+            if alias == settings.REDDIT_READ_REPLICA:
+                # Left as the replication tool set it up, synchronous keeps SQLite's FULL default
+                self.assertEquals(pragmas[1], 2)
+            else:
+                self.assertEquals(pragmas, ['wal', 1, 5000])
+
+class UserKarmaTest(TestCase):
+
+    def setUp(self):
+        self.author = User.objects.create(username='test1', password='pjkwvb86hj')
+        self.voter = User.objects.create(username='test2', password='pjkwvb86hj')
+        self.post = Post.objects.create(title='test_new_post_title', text='test_new_post_text', user=self.author)
+        self.comment = self.post.comment_set.create(user=self.author, text='comment_text')
+
+    def get_karma(self, user):
+        return User.objects.get(id=user.id).karma
+
+    def test_votes_change_the_authors_karma(self):
+        # The creator's own upvotes
+        self.assertEquals(self.get_karma(self.author), 2)
+        self.post.vote(self.voter, 'u')
+        self.comment.vote(self.voter, 'd')
+        self.assertEquals(self.get_karma(self.author), 2)
+        self.comment.vote(self.voter, 'u')
+        self.assertEquals(self.get_karma(self.author), 4)
+        self.post.vote(self.voter, 'u')
+        self.assertEquals(self.get_karma(self.author), 3)
+        self.assertEquals(self.get_karma(self.voter), 0)
+
+    def test_deleting_a_post_removes_its_karma(self):
+        self.post.vote(self.voter, 'u')
+        self.post.delete()
+        self.assertEquals(self.get_karma(self.author), 0)
+
+    def test_recompute_karma_repairs_drifted_karma(self):
+        self.post.vote(self.voter, 'u')
+        User.objects.update(karma=100)
+        call_command('recompute_karma', chunk_size=1, stdout=StringIO())
+        self.assertEquals(self.get_karma(self.author), 3)
+        self.assertEquals(self.get_karma(self.voter), 0)
+
+class CommentTreeApiTest(TestCase):
+
+    def setUp(self):
+        self.user = User.objects.create(username='test1', password='pjkwvb86hj')
+        self.post = Post.objects.create(title='test_new_post_title', text='test_new_post_text', user=self.user)
+        self.client = APIClient()
+
+    def create_chain(self, length, parent=None):
+        comments = []
+        for i in range(length):
+            parent = self.post.comment_set.create(user=self.user, text=f'comment_text_{i}', parent=parent)
+            comments.append(parent)
+        return comments
+
+    def test_post_detail_nests_replies_under_their_parents(self):
+        root = self.post.comment_set.create(user=self.user, text='root')
+        children = [self.post.comment_set.create(user=self.user, text=f'child_{i}', parent=root) for i in range(2)]
+        grandchild = self.post.comment_set.create(user=self.user, text='grandchild', parent=children[1])
+        other_root = self.post.comment_set.create(user=self.user, text='other_root')
+        comments = self.client.get(f'/posts/{self.post.id}/').json()['comments']
+        self.assertEquals([comment['id'] for comment in comments], [root.id, other_root.id])
+        self.assertEquals([comment['id'] for comment in comments[0]['child_comments']], [child.id for child in children])
+        self.assertEquals([comment['id'] for comment in comments[0]['child_comments'][1]['child_comments']], [grandchild.id])
+        self.assertNotIn('child_comments', comments[1])
+        self.assertNotIn('more', comments[0])
+
+    def test_replies_below_the_max_depth_are_loaded_with_a_continuation_token(self):
+        chain = self.create_chain(4)
+        comment = self.client.get(f'/posts/{self.post.id}/?depth=2').json()['comments'][0]['child_comments'][0]
+        self.assertEquals(comment['id'], chain[1].id)
+        self.assertNotIn('child_comments', comment)
+        response = self.client.get(f'/posts/{self.post.id}/comments/', {'continue': comment['more'], 'depth': 2}).json()
+        self.assertEquals(response['comments'][0]['id'], chain[2].id)
+        self.assertEquals(response['comments'][0]['child_comments'][0]['id'], chain[3].id)
+        self.assertIsNone(response['more'])
+
+    def test_negative_depth_and_limit_load_a_single_comment(self):
+        chain = self.create_chain(2)
+        other_root = self.post.comment_set.create(user=self.user, text='other_root')
+        for url in (f'/posts/{self.post.id}/', f'/async/posts/{self.post.id}/'):
+            response = self.client.get(url, {'depth': -1, 'limit': -3})
+            self.assertEquals(response.status_code, 200)
+            self.assertEquals([comment['id'] for comment in response.json()['comments']], [chain[0].id])
+            self.assertNotIn('child_comments', response.json()['comments'][0])
+        more = response.json()['more_comments']
+        response = self.client.get(f'/posts/{self.post.id}/comments/', {'continue': more, 'limit': -3})
+        self.assertEquals([comment['id'] for comment in response.json()['comments']], [other_root.id])
+
+    def test_top_level_comments_are_paginated(self):
+        roots = [self.post.comment_set.create(user=self.user, text=f'root_{i}') for i in range(5)]
+        response = self.client.get(f'/posts/{self.post.id}/?limit=2').json()
+        self.assertEquals([comment['id'] for comment in response['comments']], [root.id for root in roots[:2]])
+        seen = [comment['id'] for comment in response['comments']]
+        more = response['more_comments']
+        while more:
+            response = self.client.get(f'/posts/{self.post.id}/comments/', {'continue': more, 'limit': 2}).json()
+            seen += [comment['id'] for comment in response['comments']]
+            more = response['more']
+        self.assertEquals(seen, [root.id for root in roots])
+
+    def test_query_count_does_not_depend_on_the_number_of_comments(self):
+        for i in range(3):
+            self.create_chain(3, parent=self.post.comment_set.create(user=self.user, text=f'root_{i}'))
+        with CaptureQueriesContext(connection) as context:
+            self.client.get(f'/posts/{self.post.id}/')
+        for i in range(3):
+            self.create_chain(3, parent=self.post.comment_set.create(user=self.user, text=f'extra_root_{i}'))
+        with self.assertNumQueries(len(context.captured_queries)):
+            self.client.get(f'/posts/{self.post.id}/')
+
+    def test_invalid_continuation_tokens_are_rejected(self):
+        response = self.client.get(f'/posts/{self.post.id}/comments/', {'continue': 'not-a-token'})
+        self.assertEquals(response.status_code, 400)
+        for token in ([None, 'hot', None], [None, 'best', ['x', 1]], [None, 'best', [1.0]]):
+            response = self.client.get(f'/posts/{self.post.id}/comments/', {'continue': urlsafe_b64encode(dumps(token).encode()).decode()})
+            self.assertEquals(response.status_code, 400)
+
+    """Four replies to parent, each upvoted by its author: one more with two upvotes, one with two up and two downvotes
+    and one with a single downvote"""
+    def create_voted_siblings(self, parent=None):
+        voters = [User.objects.get_or_create(username=f'voter{i}')[0] for i in range(3)]
+        siblings = [self.post.comment_set.create(user=self.user, text=f'sibling_{i}', parent=parent) for i in range(4)]
+        for voter in voters[:2]:
+            siblings[1].vote(voter, 'u')
+        for voter, type in zip(voters, 'udd'):
+            siblings[2].vote(voter, type)
+        siblings[3].vote(voters[0], 'd')
+        return siblings
+
+    def test_replies_come_in_the_requested_sort(self):
+        siblings = self.create_voted_siblings()
+        replies = self.create_voted_siblings(parent=siblings[0])
+        orders = {'best': [1, 0, 2, 3], 'top': [1, 0, 2, 3], 'newest': [3, 2, 1, 0], 'oldest': [0, 1, 2, 3], 'controversial': [2, 3, 0, 1]}
+        for sort, order in orders.items():
+            comments = self.client.get(f'/posts/{self.post.id}/', {'comment_sort': sort}).json()['comments']
+            self.assertEquals([comment['id'] for comment in comments], [siblings[i].id for i in order])
+            parent = next(comment for comment in comments if comment['id'] == siblings[0].id)
+            self.assertEquals([comment['id'] for comment in parent['child_comments']], [replies[i].id for i in order])
+        self.assertEquals(self.client.get(f'/posts/{self.post.id}/', {'comment_sort': 'unknown'}).json()['comments'][0]['id'], siblings[1].id)
+
+    @mock.patch.object(CommentTree, 'CHILDREN_LIMIT', 2)
+    def test_continuation_tokens_keep_the_sort(self):
+        siblings = self.create_voted_siblings()
+        replies = self.create_voted_siblings(parent=siblings[0])
+        for sort, order in (('controversial', [2, 3, 0, 1]), ('newest', [3, 2, 1, 0])):
+            response = self.client.get(f'/posts/{self.post.id}/', {'comment_sort': sort, 'limit': 1}).json()
+            seen, more = [comment['id'] for comment in response['comments']], response['more_comments']
+            while more:
+                response = self.client.get(f'/posts/{self.post.id}/comments/', {'continue': more, 'limit': 1}).json()
+                seen += [comment['id'] for comment in response['comments']]
+                more = response['more']
+            self.assertEquals(seen, [siblings[i].id for i in order])
+        # Only the two best replies are loaded, the rest follow from the token
+        parent = self.client.get(f'/posts/{self.post.id}/').json()['comments'][1]
+        self.assertEquals([comment['id'] for comment in parent['child_comments']], [replies[1].id, replies[0].id])
+        response = self.client.get(f'/posts/{self.post.id}/comments/', {'continue': parent['more']}).json()
+        self.assertEquals([comment['id'] for comment in response['comments']], [replies[2].id, replies[3].id])
+
+class SearchTest(TestCase):
+
+    def setUp(self):
+        self.user = User.objects.create(username='test1', password='pjkwvb86hj')
+        self.client = APIClient()
+
+    def create_post(self, title, text='test_new_post_text', score=0):
+        post = Post.objects.create(title=title, text=text, user=self.user)
+        Post.objects.filter(id=post.id).update(score=score)
+        return post
+
+    def search(self, q, **params):
+        return [result['id'] for result in self.client.get('/search/', {'q': q, **params}).json()['results']]
+
+    def test_results_are_ranked_by_relevance_then_score(self):
+        in_text = self.create_post('unrelated title', 'a story about a red fox')
+        low, high = self.create_post('red fox'), self.create_post('red fox', score=1000)
+        self.create_post('a red panda')
+        self.assertEquals(self.search('Red foxes!'), [high.id, low.id, in_text.id])
+        self.assertEquals(self.search('"fox" (red'), [high.id, low.id, in_text.id])
+        self.assertEquals(self.search('...'), [])
+
+    def test_index_follows_inserts_updates_and_deletes(self):
+        post = self.create_post('first title')
+        Post.objects.bulk_create([Post(title='bulk title', text='text', user=self.user)])
+        self.assertEquals(len(self.search('title')), 2)
+        Post.objects.filter(id=post.id).update(title='renamed')
+        self.assertEquals(self.search('renamed'), [post.id])
+        self.assertEquals(self.search('first'), [])
+        post.delete()
+        self.assertEquals(self.search('renamed'), [])
+        comment = Post.objects.get().comment_set.create(user=self.user, text='searchable comment')
+        comment.comment_set.create(user=self.user, text='reply', post_id=comment.post_id)
+        self.assertEquals(self.search('searchable', type='comments'), [comment.id])
+        Comment.objects.filter(id=comment.id).update(deleted=True)
+        self.assertEquals(self.search('searchable', type='comments'), [])
+
+    def test_results_are_paginated(self):
+        posts = [self.create_post(f'paged title {i}', score=i % 3) for i in range(7)]
+        ids, response = [], self.client.get('/search/', {'q': 'paged', 'page_size': 2}).json()
+        while True:
+            ids += [post['id'] for post in response['results']]
+            if not response['next']:
+                break
+            response = self.client.get(response['next']).json()
+        self.assertEquals(ids, self.search('paged', page_size=10))
+        self.assertEquals(sorted(ids), [post.id for post in posts])
+        self.assertEquals(self.client.get('/search/', {'q': 'paged', 'cursor': 'not-a-cursor'}).status_code, 404)
+        self.assertEquals(self.client.get('/search/').status_code, 400)
+        self.assertEquals(self.client.get('/search/', {'q': 'paged', 'type': 'users'}).status_code, 400)
+
+    def test_rebuild_search_index_restores_the_index(self):
+        post = self.create_post('lost title')
+        with connection.cursor() as cursor:
+            cursor.execute("INSERT INTO reddit_post_search(reddit_post_search) VALUES ('delete-all')")
+        self.assertEquals(self.search('lost'), [])
+        call_command('rebuild_search_index', stdout=StringIO())
+        self.assertEquals(self.search('lost'), [post.id])
+
+class StreamingResponseTest(TestCase):
+
+    def setUp(self):
+        self.user = User.objects.create(username='test1', password='pjkwvb86hj')
+        self.staff = User.objects.create(username='staff', password='pjkwvb86hj', is_staff=True)
+        self.posts = [Post.objects.create(title=f'test_stream_post_{i}', text='test_new_post_text', user=self.user) for i in range(3)]
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def get_content(self, response):
+        self.assertTrue(response.streaming)
+        return b''.join(response.streaming_content).decode()
+
+    @mock.patch('reddit.streaming.CHUNK_SIZE', 2)
+    def test_streamed_post_detail_contains_every_comment_with_the_users_votes(self):
+        post = self.posts[0]
+        roots = [post.comment_set.create(user=self.user, text=f'root_{i}') for i in range(3)]
+        replies = [post.comment_set.create(user=self.user, text=f'reply_{i}', parent=roots[0]) for i in range(2)]
+        roots[1].vote(self.user, 'd')
+        data = loads(self.get_content(self.client.get(f'/posts/{post.id}/stream/')))
+        detail = self.client.get(f'/posts/{post.id}/').json()
+        self.assertEquals({key: value for key, value in data.items() if key != 'comments'},
+            {key: value for key, value in detail.items() if key not in ('comments', 'more_comments')})
+        self.assertEquals([comment['id'] for comment in data['comments']], sorted(comment.id for comment in roots + replies))
+        self.assertEquals({comment['parent_id'] for comment in data['comments'] if comment['parent_id']}, {roots[0].id})
+        self.assertEquals({comment['id']: comment['vote'] for comment in data['comments']}[roots[1].id], 'd')
+        self.assertEquals(loads(self.get_content(self.client.get(f'/posts/{self.posts[1].id}/stream/')))['comments'], [])
+
+    @mock.patch('reddit.streaming.CHUNK_SIZE', 2)
+    def test_export_streams_one_row_per_line_for_staff_only(self):
+        self.assertEquals(self.client.get('/export/posts/').status_code, 403)
+        self.client.force_authenticate(self.staff)
+        self.posts[0].comment_set.create(user=self.user, text='comment_text')
+        response = self.client.get('/export/posts/')
+        self.assertEquals(response['Content-Type'], 'application/x-ndjson')
+        rows = [loads(line) for line in self.get_content(response).splitlines()]
+        self.assertEquals([row['id'] for row in rows], [post.id for post in self.posts])
+        self.assertEquals(rows[0]['text'], 'test_new_post_text')
+        self.assertEquals(rows[0]['comment_count'], 1)
+        rows = [loads(line) for line in self.get_content(self.client.get('/export/posts/', {'after': self.posts[0].id})).splitlines()]
+        self.assertEquals([row['id'] for row in rows], [post.id for post in self.posts[1:]])
+        self.assertEquals(len(self.get_content(self.client.get('/export/comments/')).splitlines()), 1)
+        self.assertEquals(self.client.get('/export/users/').status_code, 404)
+        self.assertEquals(self.client.get('/export/posts/', {'after': 'x'}).status_code, 400)
+
+class PostImporterTest(TestCase):
+
+    def setUp(self):
+        self.user = User.objects.create(username='test1', password='pjkwvb86hj')
+
+    def snapshot(self):
+        posts = sorted(Post.objects.values_list('title', 'slug', 'text', 'score', 'votes', 'hot_rank', 'comment_count', 'created_on'))
+        comments = sorted(Comment.objects.values_list('text', 'post__title', 'parent__text', 'score', 'votes', 'hot_rank', 'child_comment_count', 'created_on'))
+        titles = dict(Post.objects.values_list('id', 'title'))
+        texts = dict(Comment.objects.values_list('id', 'text'))
+        votes = sorted((vote.target_type, (titles if vote.target_type == Post.type_code else texts)[vote.target], vote.user_id, vote.type) for vote in Vote.objects.all())
+        karma = sorted(User.objects.values_list('username', 'karma'))
+        return posts, comments, votes, karma
+
+    def test_import_matches_saving_every_object(self):
+        load_objects_from_file(Post, 'posts.json', context={'user_id': self.user.id})
+        expected = self.snapshot()
+        Post.objects.all().delete()
+        Vote.objects.all().delete()
+        # Both paths start from no karma, rather than from what the deletes left
+        User.objects.update(karma=0)
+        with open(join('test-data', 'posts.json')) as f:
+            imported = PostImporter(context={'user_id': self.user.id}, chunk_size=5).import_file(f)
+        self.assertEquals(imported, {Post: len(expected[0]), Comment: len(expected[1])})
+        self.assertEquals(self.snapshot(), expected)
+
+    def test_import_posts_command_imports_the_file(self):
+        call_command('import_posts', join('test-data', 'posts.json'), user=self.user.username, stdout=StringIO())
+        self.assertTrue(Post.objects.exists())
+        self.assertFalse(Post.objects.with_inconsistent_vote_counts().filter(votes=1).exists())
+
+    def test_import_builds_threads_deeper_than_the_recursion_limit(self):
+        depth = sys.getrecursionlimit() + 100
+        post = {'target_class': 'reddit.models.Post', 'title': 'deep', 'text': '', 'score': 0, 'votes': 0, 'user_id': '$user_id', 'comments': []}
+        children = post['comments']
+        for i in range(depth):
+            comment = {'target_class': 'reddit.models.Comment', 'text': f'level_{i}', 'post': '$root', 'parent': '$parent' if i else None,
+                'score': 0, 'votes': 0, 'user_id': '$user_id', 'created_on': 1500000000, 'children': []}
+            children.append(comment)
+            children = comment['children']
+        importer = PostImporter(context={'user_id': self.user.id})
+        importer.add(post)
+        importer.flush()
+        self.assertEquals(Post.objects.get().comment_count, depth)
+        self.assertEquals(Comment.objects.filter(child_comment_count=1).count(), depth - 1)
+        self.assertEquals(Comment.objects.get(text='level_0').created_on, make_aware(datetime.fromtimestamp(1500000000)))
+
+    def test_large_elements_are_read_in_growing_blocks(self):
+        elements = [{'text': 'x' * 100000}, [1, 2], 'end']
+        file = StringIO(dumps(elements))
+        with mock.patch.object(file, 'read', wraps=file.read) as read:
+            self.assertEquals(list(iter_json_array(file, read_size=16)), elements)
+        self.assertLess(read.call_count, 30)
+
+    def test_generator_is_reproducible_and_respects_its_shape(self):
+        first = list(DatasetGenerator(posts=3, comments_per_post=30, depth=3, fan_out=2, seed=5))
+        self.assertEquals(first, list(DatasetGenerator(posts=3, comments_per_post=30, depth=3, fan_out=2, seed=5)))
+
+        def walk(comments, depth):
+            self.assertLessEqual(len(comments), 2 if depth > 1 else 30)
+            self.assertLessEqual(depth, 3 if comments else 4)
+            return sum(1 + walk(comment['children'], depth + 1) for comment in comments)
+        self.assertEquals([walk(post['comments'], 1) for post in first], [30, 30, 30])
+
+    def test_import_applies_recorded_votes_of_many_users(self):
+        users = {f'user_{i}': User.objects.create(username=f'voter{i}').id for i in range(5)}
+        posts = list(DatasetGenerator(posts=5, comments_per_post=0, users=5, votes_per_user=3, seed=3))
+        importer = PostImporter(context=users)
+        for data in posts:
+            importer.add(data)
+        importer.flush()
+        for data in posts:
+            expected = {users[data['user_id'][1:]]: 'u'}
+            for record in data.get('vote_records', []):
+                expected[users[record['user_id'][1:]]] = record['type']
+            post = Post.objects.get(title=data['title'])
+            self.assertEquals(dict(Vote.objects.filter(target_type=Post.type_code, target=post.id).values_list('user_id', 'type')), expected)
+            self.assertEquals(post.score, data['score'] + sum(1 if type == 'u' else -1 for type in expected.values()))
+        karma = dict(User.objects.values_list('id', 'karma'))
+        call_command('recompute_karma', stdout=StringIO())
+        self.assertEquals(dict(User.objects.values_list('id', 'karma')), karma)
+
+class RequestInstrumentationTest(QueryBudgetMixin, TestCase):
+
+    def setUp(self):
+        self.user = User.objects.create(username='test1', password='pjkwvb86hj')
+        self.staff = User.objects.create(username='staff', password='pjkwvb86hj', is_staff=True)
+        self.posts = [Post.objects.create(title=f'test_api_post_{i}', text='test_new_post_text', user=self.user) for i in range(30)]
+        parent = None
+        for i in range(2 * CommentTree.DEFAULT_DEPTH):
+            parent = self.posts[0].comment_set.create(user=self.user, text=f'comment_text_{i}', parent=parent)
+            for post in self.posts[1:]:
+                post.comment_set.create(user=self.user, text=f'comment_text_{i}')
+        self.client = APIClient()
+        cache.clear()
+        endpoint_stats.clear()
+
+    def test_post_endpoints_stay_within_their_query_budgets(self):
+        for user in (None, self.user):
+            self.client.force_authenticate(user)
+            cache.clear()
+            for sort in (VotableManager.HOT, VotableManager.NEWEST, VotableManager.TOP_PAST_DAY):
+                self.assertWithinQueryBudget(self.client.get('/posts/', {'sort': sort}))
+            for post in self.posts[:3]:
+                self.assertWithinQueryBudget(self.client.get(f'/posts/{post.id}/'))
+
+    def test_responses_carry_server_timing(self):
+        response = self.client.get(f'/posts/{self.posts[0].id}/')
+        timings = dict(entry.split(';')[0:2] for entry in response['Server-Timing'].split(', '))
+        self.assertEquals(set(timings), {'total', 'view', 'db', 'serializer'})
+        self.assertIn(f'desc="{response.wsgi_request.timings.queries} queries"', response['Server-Timing'])
+        self.assertGreater(response.wsgi_request.timings.durations['serializer'], 0)
+
+    def test_stats_are_aggregated_per_endpoint_for_staff_only(self):
+        for post in self.posts[:3]:
+            self.client.get(f'/posts/{post.id}/')
+        self.client.get('/posts/')
+        self.assertEquals(self.client.get('/stats/').status_code, 403)
+        self.client.force_authenticate(self.user)
+        self.assertEquals(self.client.get('/stats/').status_code, 403)
+        self.client.force_authenticate(self.staff)
+        stats = self.client.get('/stats/').json()
+        self.assertEquals(stats['GET reddit:Post-detail']['requests'], 3)
+        self.assertEquals(stats['GET reddit:Post-list']['requests'], 1)
+        self.assertEquals(sum(stats['GET reddit:Post-detail']['queries']['buckets'].values()), 3)
+        self.assertEquals(self.client.delete('/stats/').status_code, 204)
+        self.assertEquals(list(self.client.get('/stats/').json()), ['DELETE reddit:stats'])
+
+class AsyncPostViewTest(QueryBudgetMixin, TestCase):
+
+    def setUp(self):
+        self.user = User.objects.create(username='test1', password='pjkwvb86hj')
+        self.user2 = User.objects.create(username='test2', password='pjkwvb86hj')
+        self.posts = [Post.objects.create(title=f'test_api_post_{i}', text='test_new_post_text', user=self.user) for i in range(7)]
+        self.posts[3].vote(self.user2, 'd')
+        root = self.posts[0].comment_set.create(user=self.user, text='root')
+        for i in range(3):
+            self.posts[0].comment_set.create(user=self.user, text=f'child_{i}', parent=root)
+        root.vote(self.user2, 'u')
+        self.client.force_login(self.user2)
+        self.async_client.force_login(self.user2)
+        cache.clear()
+
+    async def test_async_list_matches_the_sync_list(self):
+        for sort in (VotableManager.HOT, VotableManager.NEWEST, VotableManager.TOP_ALL_TIME):
+            url, async_url = '/posts/', '/async/posts/'
+            params = {'sort': sort, 'page_size': 3}
+            while url:
+                expected = (await sync_to_async(self.client.get)(url, params)).json()
+                response = await self.async_client.get(async_url, params)
+                self.assertWithinQueryBudget(response, exactly=2 + 2)
+                self.assertEquals(response.json()['results'], expected['results'])
+                self.assertEquals(response.json()['next'] is None, expected['next'] is None)
+                url, async_url, params = expected['next'], response.json()['next'], {}
+
+    async def test_async_detail_matches_the_sync_detail(self):
+        # Only posts[0] has replies, the second level is read unless depth stops at the first
+        for post, params, levels in ((self.posts[0], {}, 2), (self.posts[0], {'depth': 1, 'limit': 1}, 1), (self.posts[3], {}, 1), (self.posts[3], {'depth': 1, 'limit': 1}, 1)):
+            expected = (await sync_to_async(self.client.get)(f'/posts/{post.id}/', params)).json()
+            response = await self.async_client.get(f'/async/posts/{post.id}/', params)
+            self.assertWithinQueryBudget(response, exactly=2 + 1 + levels)
+            self.assertEquals(response.json(), expected)
+
+    async def test_async_views_report_errors_like_the_sync_ones(self):
+        self.assertEquals((await self.async_client.get('/async/posts/', {'cursor': 'invalid'})).status_code, 404)
+        self.assertEquals((await self.async_client.get('/async/posts/0/')).status_code, 404)
+        self.assertEquals((await self.async_client.get(f'/async/posts/{self.posts[0].id}/', {'depth': 'x'})).status_code, 400)
+
+class AsyncQueryRecordingTest(TransactionTestCase):
+
+    """Runs the request on a new event loop like an ASGI server does, so the view's ORM work happens on
+    sync_to_async's own thread and its connection rather than the test's"""
+    def test_async_requests_record_the_queries_of_the_view_thread(self):
+        response = asyncio.run(AsyncClient().get('/async/posts/'))
+        # The same thread runs the view's sync code every time, its connections stay open otherwise
+        asyncio.run(sync_to_async(connections.close_all)())
+        queries = response.asgi_request.timings.queries
+        self.assertGreater(queries, 0)
+        self.assertIn(f'desc="{queries} queries"', response['Server-Timing'])
+        self.assertGreater(response.asgi_request.timings.durations['db'], 0)
+
 class CommentModelTest(TestCase):
 
     def setUp(self):
@@ -168,4 +1412,57 @@ class CommentModelTest(TestCase):
         child1.delete()
         self.assertEquals(comment.child_comment_count, 1)
         child2.delete()
-        self.assertEquals(comment.child_comment_count, 0)
\ No newline at end of file
+        self.assertEquals(comment.child_comment_count, 0)
+
+    def test_deleting_a_comment_deletes_its_replies_in_a_few_statements(self):
+        comment = self.post.comment_set.create(user=self.user, text='comment_text_1')
+        parent = comment
+        for i in range(10):
+            parent = self.post.comment_set.create(user=self.user, text=f'reply_{i}', parent=parent)
+        with CaptureQueriesContext(connection) as context:
+            count, counts = Comment.objects.get(id=comment.id).delete()
+        self.assertLess(len(context.captured_queries), 20)
+        self.assertEquals(counts['reddit.Comment'], 11)
+        self.assertFalse(Comment.objects.exists())
+        self.assertEquals(Post.objects.get(id=self.post.id).comment_count, 0)
+
+    def test_replies_through_a_stale_parent_keep_its_votes(self):
+        comment = self.post.comment_set.create(user=self.user, text='comment_text_1')
+        voter = User.objects.create(username='test2', password='pjkwvb86hj')
+        Comment.objects.get(id=comment.id).vote(voter, 'u')
+        child = self.post.comment_set.create(user=self.user, text='comment_text_2', parent=comment)
+        stored = Comment.objects.get(id=comment.id)
+        self.assertEquals((stored.score, stored.child_comment_count), (2, 1))
+        child.delete()
+        self.assertEquals(Comment.objects.get(id=comment.id).score, 2)
+        self.assertFalse(Comment.objects.with_inconsistent_vote_counts().exists())
+
+    def test_adding_and_removing_comments_updates_the_posts_comment_count(self):
+        comment = self.post.comment_set.create(user=self.user, text='comment_text_1')
+        child = Comment.objects.create(post_id=self.post.id, user=self.user, text='comment_text_2', parent=comment)
+        self.assertEquals(self.post.comment_count, 1)
+        self.assertEquals(Post.objects.get(id=self.post.id).comment_count, 2)
+        child.delete()
+        self.assertEquals(Post.objects.get(id=self.post.id).comment_count, 1)
+
+    def test_sort_ranks_follow_votes(self):
+        comment = self.post.comment_set.create(user=self.user, text='comment_text_1')
+        voters = [User.objects.create(username=f'voter{i}') for i in range(3)]
+        comment.vote(voters[0], 'd')
+        comment.vote(voters[1], 'd')
+        self.assertAlmostEqual(comment.best_rank, comment.calculate_best_rank())
+        apply_votes(voters[2], [('c', comment.id, 'u')])
+        comment = Comment.objects.get(id=comment.id)
+        self.assertEquals((comment.votes, comment.score), (4, 0))
+        self.assertAlmostEqual(comment.best_rank, comment.calculate_best_rank())
+        # Two upvotes and two downvotes, 4 ** (2 / 2)
+        self.assertAlmostEqual(comment.controversial_rank, 4.0)
+        # The same share of upvotes ranks higher with more votes
+        self.assertGreater(Comment(votes=10, score=10).calculate_best_rank(), Comment(votes=1, score=1).calculate_best_rank())
+        self.assertEquals(Comment(votes=3, score=3).calculate_controversial_rank(), 0)
+
+    def test_backfill_comment_counts_recounts_comments(self):
+        self.post.comment_set.create(user=self.user, text='comment_text_1')
+        Post.objects.update(comment_count=0)
+        call_command('backfill_comment_counts', stdout=StringIO())
+        self.assertEquals(Post.objects.get(id=self.post.id).comment_count, 1)
\ No newline at end of file
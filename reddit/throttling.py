@@ -0,0 +1,174 @@
+import time
+from threading import Lock
+from django.conf import settings
+from django.core.cache import caches
+from django.core.signals import setting_changed
+from django.dispatch import receiver
+from rest_framework.throttling import BaseThrottle
+
+PERIODS = {'s': 1, 'm': 60, 'h': 3600, 'd': 86400}
+
+"""Parses a DRF style rate like '30/min' into (limit, window in seconds)"""
+def parse_rate(rate):
+    limit, period = rate.split('/')
+    return int(limit), PERIODS[period[0]]
+
+class SlidingWindowLimiter:
+    """Sliding window rate limit kept in process: per key, the hits of the current and of the previous fixed
+    window, the latter weighted by how much of it the sliding window still covers. Constant memory per key and
+    a dict lookup per hit, at the cost of assuming the previous window's hits were evenly spread."""
+
+    def __init__(self, limit, window):
+        self.limit = limit
+        self.window = window
+        self.lock = Lock()
+        self.window_index = 0
+        # key: (window index, hits in that window, hits in the window before)
+        self.counts = {}
+
+    """Returns the index of the fixed window now falls in and how far into it it is, in seconds"""
+    def get_position(self, now):
+        index, elapsed = divmod(time.time() if now is None else now, self.window)
+        return int(index), elapsed
+
+    """Returns the (current, previous) window hits of every key"""
+    def get_counts(self, keys, index):
+        counts = []
+        for key in keys:
+            window_index, current, previous = self.counts.get(key, (index, 0, 0))
+            if window_index == index:
+                counts.append((current, previous))
+            else:
+                counts.append((0, current if window_index == index - 1 else 0))
+        return counts
+
+    """Seconds until every key allows the given number of hits, 0 if they are allowed now"""
+    def get_wait(self, keys, hits=1, now=None):
+        index, elapsed = self.get_position(now)
+        with self.lock:
+            counts = self.get_counts(keys, index)
+        return max(self.get_count_wait(current, previous, hits, elapsed) for current, previous in counts)
+
+    def add(self, keys, hits=1, now=None):
+        index, _ = self.get_position(now)
+        with self.lock:
+            self.count(keys, hits, index)
+
+    """Checks and counts the hits in one step, so concurrent requests can't both take the last hits left. Returns 0
+    when every key allowed them and they were counted, otherwise counts nothing and returns get_wait()'s wait."""
+    def try_acquire(self, keys, hits=1, now=None):
+        index, elapsed = self.get_position(now)
+        with self.lock:
+            wait = max(self.get_count_wait(current, previous, hits, elapsed) for current, previous in self.get_counts(keys, index))
+            if not wait:
+                self.count(keys, hits, index)
+        return wait
+
+    """Adds hits to the current window of every key, called with the lock held"""
+    def count(self, keys, hits, index):
+        if index != self.window_index:
+            # Keys not hit since the previous window have nothing left to count
+            self.counts = {key: counts for key, counts in self.counts.items() if counts[0] >= index - 1}
+            self.window_index = index
+        for key, (current, previous) in zip(keys, self.get_counts(keys, index)):
+            self.counts[key] = (index, current + hits, previous)
+
+    """How long until previous * weight + current + hits fits the limit, as the previous window's weight decays"""
+    def get_count_wait(self, current, previous, hits, elapsed):
+        if previous * (1 - elapsed / self.window) + current + hits <= self.limit:
+            return 0
+        if current + hits > self.limit or not previous:
+            # Only the next window helps
+            return self.window - elapsed
+        # The weight has to drop to (limit - current - hits) / previous
+        return max(self.window - elapsed - (self.limit - current - hits) / previous * self.window, 0.001)
+
+class CacheSlidingWindowLimiter(SlidingWindowLimiter):
+    """The same sliding window counted in a cache shared by the worker processes. Checking and counting are
+    separate cache operations, so concurrent requests can exceed the limit a little."""
+
+    def __init__(self, limit, window, cache, prefix):
+        super().__init__(limit, window)
+        self.cache = cache
+        self.prefix = prefix
+
+    def get_names(self, key, index):
+        return f'{self.prefix}:{key}:{index}', f'{self.prefix}:{key}:{index - 1}'
+
+    def get_wait(self, keys, hits=1, now=None):
+        index, elapsed = self.get_position(now)
+        names = [self.get_names(key, index) for key in keys]
+        stored = self.cache.get_many([name for pair in names for name in pair])
+        return max(self.get_count_wait(stored.get(current, 0), stored.get(previous, 0), hits, elapsed) for current, previous in names)
+
+    def add(self, keys, hits=1, now=None):
+        index, _ = self.get_position(now)
+        for key in keys:
+            current, _ = self.get_names(key, index)
+            # Kept for two windows, the next window reads it as its previous one
+            if not self.cache.add(current, hits, timeout=2 * self.window):
+                self.cache.incr(current, hits)
+
+    def try_acquire(self, keys, hits=1, now=None):
+        wait = self.get_wait(keys, hits, now)
+        if not wait:
+            self.add(keys, hits, now)
+        return wait
+
+_limiters = None
+_limiters_lock = Lock()
+
+"""Returns the per user and per target limiters configured by settings.REDDIT_VOTE_THROTTLE, None when it isn't set"""
+def get_vote_limiters():
+    global _limiters
+    options = getattr(settings, 'REDDIT_VOTE_THROTTLE', None)
+    if not options:
+        return None
+    if _limiters is None:
+        with _limiters_lock:
+            if _limiters is None:
+                limiters = {}
+                for scope in ('user', 'target'):
+                    limit, window = parse_rate(options[scope])
+                    if options.get('cache'):
+                        limiters[scope] = CacheSlidingWindowLimiter(limit, window, caches[options['cache']], f'reddit:vote-throttle:{scope}')
+                    else:
+                        limiters[scope] = SlidingWindowLimiter(limit, window)
+                _limiters = limiters
+    return _limiters
+
+@receiver(setting_changed)
+def reset_vote_limiters(setting, **kwargs):
+    global _limiters
+    if setting == 'REDDIT_VOTE_THROTTLE':
+        _limiters = None
+
+class VoteThrottle(BaseThrottle):
+    """Limits how often a user votes and how often a single post or comment is voted on, so vote bursts are
+    answered with 429 before they reach the database. The view lists the target of each of the request's votes
+    as (type code, id) pairs in get_vote_targets(). Every vote counts for the user, every target voted on once
+    per request."""
+
+    def allow_request(self, request, view):
+        limiters = get_vote_limiters()
+        if limiters is None:
+            return True
+        targets = view.get_vote_targets(request)
+        if not targets:
+            return True
+        keys = {'user': [request.user.pk], 'target': list(dict.fromkeys(f'{type}:{id}' for type, id in targets))}
+        hits = {'user': len(targets), 'target': 1}
+        now = time.time()
+        acquired = []
+        for scope, limiter in limiters.items():
+            self.wait_time = limiter.try_acquire(keys[scope], hits[scope], now)
+            if self.wait_time:
+                # The refused vote doesn't count against the limits that allowed it
+                for scope, limiter in acquired:
+                    limiter.add(keys[scope], -hits[scope], now)
+                return False
+            acquired.append((scope, limiter))
+        return True
+
+    def wait(self):
+        return self.wait_time
@@ -1,14 +1,21 @@
 from django.urls import path, include
-from .views import PostViewSet
+from .views import ExportView, PostViewSet, RequestStatsView, SearchView, VoteViewSet, async_post_detail, async_post_list
 from rest_framework import routers
 
 # Routers provide an easy way of automatically determining the URL conf.
 router = routers.DefaultRouter()
 router.register(r'posts', PostViewSet, basename='Post')
+router.register(r'votes', VoteViewSet, basename='Vote')
 
 # Wire up our API using automatic URL routing.
 # Additionally, we include login URLs for the browsable API.
 app_name = 'reddit'
 urlpatterns = [
     path('', include(router.urls)),
+    path('search/', SearchView.as_view(), name='search'),
+    path('stats/', RequestStatsView.as_view(), name='stats'),
+    path('export/<str:kind>/', ExportView.as_view(), name='export'),
+    # Read only async versions of the post list and detail, for ASGI servers
+    path('async/posts/', async_post_list, name='async-post-list'),
+    path('async/posts/<int:pk>/', async_post_detail, name='async-post-detail'),
 ]
\ No newline at end of file
@@ -1,24 +1,262 @@
+import asyncio
+from asgiref.sync import sync_to_async
+from django.core.exceptions import ObjectDoesNotExist
+from django.db import DEFAULT_DB_ALIAS
+from django.http import JsonResponse, StreamingHttpResponse
 from django.http.response import HttpResponse
 from django.shortcuts import render
+from django.utils.decorators import method_decorator
+from django.views.decorators.http import condition
 from django_registration.backends.one_step.views import RegistrationView as BaseRegistrationView
-from rest_framework import viewsets
-from .models import Post
-from .serializers import PostSerializer, PostDetailSerializer
+from rest_framework import permissions, viewsets
+from rest_framework.decorators import action
+from rest_framework.exceptions import APIException, NotFound, ValidationError
+from rest_framework.request import Request
+from rest_framework.response import Response
+from rest_framework.views import APIView
+from .cache import aget_or_compute, get_listing_key, get_or_compute
+from .conditional import get_listing_etag, get_post_etag, get_post_last_modified
+from .deletion import delete_posts
+from .instrumentation import endpoint_stats
+from .models import Comment, Post, Votable
+from .pagination import KeysetPagination, SearchPagination
+from .routers import get_read_database, read_database, stick_to_primary
+from .search import SEARCH_INDEXES
+from .streaming import iterate_chunked, serialize_chunks, stream_json_object, stream_ndjson
+from .serializers import POST_ROW_FIELDS, CommentSerializer, PostSerializer, PostDetailSerializer, VoteSerializer, get_comment_tree, serialize_post_rows
+from .throttling import VoteThrottle
+from .voting import apply_votes
 
 # Create your views here.
 
 class RegistrationView(BaseRegistrationView):
     success_url = '/'
 
-class PostViewSet(viewsets.ModelViewSet):
+"""Posts in the order the sort query parameter asks for, limited to one subreddit when the subreddit parameter is given"""
+def get_post_listing(params):
+    subreddit = params.get('subreddit')
+    # The leaderboards are site wide, subreddit listings use their own indexes instead
+    queryset = Post.objects.sort(type=params.get('sort', 'hot'), use_leaderboard=not subreddit)
+    return queryset.filter(subreddit=subreddit) if subreddit else queryset
+
+class ReplicaReadsMixin:
+    """Reads of safe requests go to the read replica (see reddit/routers.py), unless the user wrote something in
+    the last REDDIT_REPLICA_STICKINESS seconds and so has to read from the primary to see it. Authentication
+    and unsafe requests use the primary, and a successful unsafe request starts the user's stickiness."""
+
+    def dispatch(self, request, *args, **kwargs):
+        token = read_database.set(None)
+        try:
+            return super().dispatch(request, *args, **kwargs)
+        finally:
+            read_database.reset(token)
+
+    def initial(self, request, *args, **kwargs):
+        super().initial(request, *args, **kwargs)
+        if request.method in permissions.SAFE_METHODS:
+            read_database.set(get_read_database(request.user))
+
+    def finalize_response(self, request, response, *args, **kwargs):
+        if request.method not in permissions.SAFE_METHODS and response.status_code < 400 and request.user.is_authenticated:
+            stick_to_primary(request.user)
+        return super().finalize_response(request, response, *args, **kwargs)
+
+class PostViewSet(ReplicaReadsMixin, viewsets.ModelViewSet):
     serializer_class = PostDetailSerializer
+    pagination_class = KeysetPagination
 
     def get_serializer_class(self, *args, **kwargs):
-        print(self.action)
         if self.action == 'retrieve':
             return PostDetailSerializer
         else:
             return PostSerializer
     
     def get_queryset(self):
-        return Post.objects.sort(type=self.request.GET.get('sort', 'hot'))
\ No newline at end of file
+        queryset = get_post_listing(self.request.GET)
+        # Listings are cached for everyone, list() adds the user's own votes to the cached page
+        return queryset.with_user_vote(None if self.action == 'list' else self.request.user)
+
+    @method_decorator(condition(etag_func=get_post_etag, last_modified_func=get_post_last_modified))
+    def retrieve(self, request, *args, **kwargs):
+        return super().retrieve(request, *args, **kwargs)
+
+    """Pages read from the replica are cached apart from those read from the primary, a reader of a lagging replica
+    could otherwise fill the key of the current listing version for a user who must see their own write"""
+    @method_decorator(condition(etag_func=get_listing_etag))
+    def list(self, request, *args, **kwargs):
+        key = get_listing_key(read_database.get() or DEFAULT_DB_ALIAS, request.build_absolute_uri())
+        data = get_or_compute(key, self.get_listing)
+        votes = Post.objects.get_user_votes(request.user, [post['id'] for post in data['results']])
+        return Response({**data, 'results': [{**post, 'vote': votes.get(post['id'])} for post in data['results']]})
+
+    """A page of the listing as list() of a ModelViewSet outputs it, serialized from values() rows"""
+    def get_listing(self):
+        posts = self.paginate_queryset(self.filter_queryset(self.get_queryset()).values(*POST_ROW_FIELDS))
+        return self.get_paginated_response(serialize_post_rows(posts)).data
+
+    """Deletes the post and its whole comment thread with a few set based statements, see reddit/deletion.py"""
+    def perform_destroy(self, instance):
+        delete_posts(Post.objects.filter(id=instance.id))
+
+    """Merges the listings of the subreddits the user subscribes to, one index range read per subreddit"""
+    @action(detail=False, permission_classes=[permissions.IsAuthenticated])
+    def home(self, request):
+        slugs = request.user.subscriber.values_list('slug', flat=True)
+        queryset = Post.objects.sort(type=request.GET.get('sort', 'hot'), use_leaderboard=False).with_user_vote(request.user)
+        posts = self.paginator.paginate_querysets([queryset.filter(subreddit=slug).values(*POST_ROW_FIELDS) for slug in slugs], request)
+        return self.get_paginated_response(serialize_post_rows(posts))
+
+    """Toggles the user's vote on the post like Votable.vote(), the body's type is 'u' or 'd'. Returns the post
+    with its new totals and the user's resulting vote."""
+    @action(detail=True, methods=['post'], permission_classes=[permissions.IsAuthenticated], throttle_classes=[VoteThrottle])
+    def vote(self, request, pk=None):
+        type = request.data.get('type')
+        if type not in (Votable.VOTE_TYPE_UPVOTE, Votable.VOTE_TYPE_DOWNVOTE):
+            raise ValidationError({'type': 'Must be u or d.'})
+        post = self.get_object()
+        post.vote(request.user, type)
+        post.user_vote = Votable.resolve_vote(post.user_vote, type)[0]
+        return Response(PostSerializer(post, context=self.get_serializer_context()).data)
+
+    """Posts and comments a vote request is for, as one (type code, id) pair per vote, read by VoteThrottle"""
+    def get_vote_targets(self, request):
+        return [(Post.type_code, self.kwargs['pk'])]
+
+    """Loads more comments, either the next top level page or more replies to a comment, from a continuation token"""
+    @action(detail=True)
+    def comments(self, request, pk=None):
+        comments, more = get_comment_tree(self.get_object(), self.get_serializer_context()).build(request.query_params.get('continue'))
+        return Response({'comments': comments, 'more': more})
+
+    """The post with every one of its comments, unlike retrieve() which loads a bounded part of the tree. The
+    response is streamed while the comments are read in chunks, so memory doesn't grow with the thread size.
+    Comments are flat in id order (replies come after their parent), clients nest them by parent_id."""
+    @action(detail=True)
+    @method_decorator(condition(etag_func=get_post_etag, last_modified_func=get_post_last_modified))
+    def stream(self, request, pk=None):
+        post = self.get_object()
+        context = self.get_serializer_context()
+        comments = Comment.objects.filter(post=post).with_user_vote(request.user).order_by('id')
+        content = stream_json_object(PostSerializer(post, context=context).data, 'comments', serialize_chunks(comments, CommentSerializer, context))
+        return StreamingHttpResponse(content, content_type='application/json')
+
+class VoteViewSet(ReplicaReadsMixin, viewsets.ViewSet):
+    permission_classes = [permissions.IsAuthenticated]
+    # Batches count towards the user's vote rate limit vote by vote, so keep them below it
+    max_batch_size = 50
+
+    """Applies a list of {target_type, target, type} votes in order, with the same outcome as voting one at a time
+    through /posts/<id>/vote/ but in a single transaction. Returns every target's resulting vote and totals."""
+    @action(detail=False, methods=['post'], throttle_classes=[VoteThrottle])
+    def batch(self, request):
+        try:
+            results = apply_votes(request.user, self.get_votes(request))
+        except ObjectDoesNotExist as e:
+            raise ValidationError({'target': str(e)})
+        return Response([{'target_type': type_code, 'target': id, 'vote': vote, 'score': score, 'votes': votes}
+            for (type_code, id), (vote, score, votes) in results.items()])
+
+    """The request's votes as (target type code, target id, vote type), validated once for VoteThrottle and the view"""
+    def get_votes(self, request):
+        if not hasattr(self, 'votes'):
+            serializer = VoteSerializer(data=request.data, many=True, max_length=self.max_batch_size)
+            serializer.is_valid(raise_exception=True)
+            self.votes = [(vote['target_type'], vote['target'], vote['type']) for vote in serializer.validated_data]
+        return self.votes
+
+    def get_vote_targets(self, request):
+        return [(type_code, id) for type_code, id, _ in self.get_votes(request)]
+
+class ExportView(APIView):
+    """Newline delimited JSON export of every post or comment for data pipelines, one row per line in id order,
+    streamed while the rows are read in chunks. ?after=<id> resumes an interrupted export."""
+    permission_classes = [permissions.IsAdminUser]
+    models = {'posts': Post, 'comments': Comment}
+
+    def get(self, request, kind):
+        if kind not in self.models:
+            raise NotFound()
+        rows = self.models[kind].objects.order_by('id')
+        if request.query_params.get('after'):
+            try:
+                rows = rows.filter(id__gt=int(request.query_params['after']))
+            except ValueError:
+                raise ValidationError({'after': 'Must be an integer.'})
+        return StreamingHttpResponse(stream_ndjson(iterate_chunked(rows.values())), content_type='application/x-ndjson')
+
+class SearchView(APIView):
+    """Full text search of posts (?type=posts, the default) or comments for the words of ?q=, best matches first"""
+    permission_classes = [permissions.AllowAny]
+    serializer_classes = {Post: PostSerializer, Comment: CommentSerializer}
+
+    def get(self, request):
+        text = request.query_params.get('q', '').strip()
+        if not text:
+            raise ValidationError({'q': 'This parameter is required.'})
+        index = SEARCH_INDEXES.get(request.query_params.get('type', 'posts'))
+        if index is None:
+            raise ValidationError({'type': f'Must be one of: {", ".join(SEARCH_INDEXES)}.'})
+        paginator = SearchPagination()
+        ids = [id for id, _ in paginator.paginate_search(index, text, request)]
+        objects = index.model.objects.with_user_vote(request.user).in_bulk(ids)
+        serializer = self.serializer_classes[index.model]([objects[id] for id in ids if id in objects], many=True, context={'request': request})
+        return paginator.get_paginated_response(serializer.data)
+
+class RequestStatsView(APIView):
+    """Per endpoint histograms of query counts and timings recorded by TimingMiddleware in this process, DELETE resets them"""
+    permission_classes = [permissions.IsAdminUser]
+
+    def get(self, request):
+        return Response(endpoint_stats.as_dict())
+
+    def delete(self, request):
+        endpoint_stats.clear()
+        return Response(status=204)
+
+"""Loads request.user, which the session backend does through the sync ORM, so async code can read it"""
+async def aget_user(request):
+    await sync_to_async(lambda: request.user.is_authenticated)()
+    return request.user
+
+"""Wraps the request for the serializers and paginator, with the user already set so DRF doesn't authenticate again"""
+def get_api_request(request, user):
+    api_request = Request(request)
+    api_request.user = user
+    return api_request
+
+def get_error_response(error):
+    return JsonResponse(error.detail if isinstance(error.detail, dict) else {'detail': error.detail}, status=error.status_code)
+
+"""Async version of GET /posts/ for ASGI deployments, same output and listing cache as PostViewSet.list().
+Like any plain Django view it only knows session authentication."""
+async def async_post_list(request):
+    user = await aget_user(request)
+    api_request = get_api_request(request, user)
+
+    async def compute():
+        paginator = KeysetPagination()
+        queryset = get_post_listing(request.GET)
+        posts = await paginator.apaginate_queryset(queryset.with_user_vote(None).values(*POST_ROW_FIELDS), api_request)
+        return {'next': paginator.get_next_link(), 'results': serialize_post_rows(posts)}
+
+    try:
+        data = await aget_or_compute(await sync_to_async(get_listing_key)(DEFAULT_DB_ALIAS, request.build_absolute_uri()), compute)
+    except APIException as e:
+        return get_error_response(e)
+    votes = await Post.objects.aget_user_votes(user, [post['id'] for post in data['results']])
+    return JsonResponse({**data, 'results': [{**post, 'vote': votes.get(post['id'])} for post in data['results']]})
+
+"""Async version of GET /posts/<id>/, the post and its comment tree are loaded concurrently"""
+async def async_post_detail(request, pk):
+    user = await aget_user(request)
+    context = {'request': get_api_request(request, user)}
+    try:
+        tree = get_comment_tree(Post(id=pk), context)
+        post, (comments, more) = await asyncio.gather(Post.objects.with_user_vote(user).aget(id=pk), tree.abuild())
+    except Post.DoesNotExist:
+        return JsonResponse({'detail': 'Not found.'}, status=404)
+    except APIException as e:
+        return get_error_response(e)
+    data = PostSerializer(post, context=context).data
+    data['comments'], data['more_comments'] = comments, more
+    return JsonResponse(data)
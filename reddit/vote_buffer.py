@@ -0,0 +1,111 @@
+import atexit
+from threading import Lock, Timer
+from django.conf import settings
+from django.core.signals import setting_changed
+from django.db import connection, transaction
+from django.dispatch import receiver
+from .cache import bump_listing_version
+
+class VoteCountBuffer:
+    """Write-behind aggregation of vote counts. Votable.vote() still records every vote row right
+    away but hands its votes/score change to the buffer, which sums the changes per target and
+    applies them with one relative UPDATE per target every flush_interval seconds or flush_size votes,
+    so a popular post is written once per flush instead of once per vote. The authors' karma changes
+    are summed and applied the same way."""
+
+    def __init__(self, flush_interval=0.5, flush_size=500):
+        self.flush_interval = flush_interval
+        self.flush_size = flush_size
+        self.lock = Lock()
+        self.pending = {}
+        self.pending_karma = {}
+        self.pending_votes = 0
+        self.timer = None
+
+    def add(self, model, id, vote_change, score_change, author_id=None):
+        with self.lock:
+            changes = self.pending.setdefault((model, id), [0, 0])
+            changes[0] += vote_change
+            changes[1] += score_change
+            if author_id is not None:
+                self.add_karma(model._meta.get_field('user').related_model, author_id, score_change)
+            self.pending_votes += 1
+            full = self.pending_votes >= self.flush_size
+            if not full and self.timer is None:
+                self.timer = Timer(self.flush_interval, self.flush_from_timer)
+                self.timer.daemon = True
+                self.timer.start()
+        if full:
+            self.flush()
+
+    def add_karma(self, user_model, id, change):
+        key = (user_model, id)
+        self.pending_karma[key] = self.pending_karma.get(key, 0) + change
+
+    """Applies every pending change, returns the number of targets updated"""
+    def flush(self):
+        with self.lock:
+            pending, self.pending, self.pending_votes = self.pending, {}, 0
+            karma, self.pending_karma = self.pending_karma, {}
+            if self.timer is not None:
+                self.timer.cancel()
+                self.timer = None
+        changes = [(model, id, vote_change, score_change) for (model, id), (vote_change, score_change) in pending.items() if vote_change or score_change]
+        karma = [(user_model, id, change) for (user_model, id), change in karma.items() if change]
+        if not changes and not karma:
+            return 0
+        try:
+            with transaction.atomic():
+                for model, id, vote_change, score_change in changes:
+                    model.objects.filter(id=id).update(**model.get_vote_count_updates(vote_change, score_change))
+                for user_model, id, change in karma:
+                    user_model.add_karma(id, change)
+                transaction.on_commit(bump_listing_version)
+        except Exception:
+            self.restore(changes, karma)
+            raise
+        return len(changes)
+
+    """Merges the changes of a failed flush back into the pending ones, for the next flush to apply. They aren't
+    counted as new votes again, so restoring them can't start another flush while the failed one unwinds."""
+    def restore(self, changes, karma):
+        with self.lock:
+            for model, id, vote_change, score_change in changes:
+                pending = self.pending.setdefault((model, id), [0, 0])
+                pending[0] += vote_change
+                pending[1] += score_change
+            for user_model, id, change in karma:
+                self.add_karma(user_model, id, change)
+
+    def flush_from_timer(self):
+        try:
+            self.flush()
+        finally:
+            connection.close()
+
+_buffer = None
+_buffer_lock = Lock()
+
+"""Returns the process wide buffer when settings.REDDIT_VOTE_WRITE_BEHIND is set, None otherwise"""
+def get_vote_buffer():
+    global _buffer
+    options = getattr(settings, 'REDDIT_VOTE_WRITE_BEHIND', None)
+    if not options:
+        return None
+    if _buffer is None:
+        with _buffer_lock:
+            if _buffer is None:
+                _buffer = VoteCountBuffer(**options)
+    return _buffer
+
+@atexit.register
+def flush_vote_buffer():
+    if _buffer is not None:
+        _buffer.flush()
+
+@receiver(setting_changed)
+def reset_vote_buffer(setting, **kwargs):
+    global _buffer
+    if setting == 'REDDIT_VOTE_WRITE_BEHIND':
+        flush_vote_buffer()
+        _buffer = None
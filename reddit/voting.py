@@ -0,0 +1,84 @@
+from collections import defaultdict
+from functools import partial
+from django.core.exceptions import ObjectDoesNotExist
+from django.db import transaction
+from django.db.models import F, Q
+from .cache import bump_listing_version
+from .models import Comment, LeaderboardEntry, Post, User, Votable, Vote
+from .vote_buffer import get_vote_buffer
+
+VOTABLE_MODELS = {model.type_code: model for model in (Post, Comment)}
+
+"""Groups the keys of changes by their value, so changes sharing a few values take one statement per value"""
+def group_by_value(changes):
+    groups = defaultdict(list)
+    for key, value in changes.items():
+        groups[value].append(key)
+    return groups.items()
+
+"""Applies the user's votes, (target type code, target id, vote type) triples, in order with the same
+outcome as calling Votable.vote() for each of them in turn: the same vote rows, totals and karma. The
+user's existing votes on all the targets are read in one query, then the vote rows are written and the
+totals changed with a few bulk statements, all in one transaction. Returns (vote, score, votes) per
+(target type code, target id), raises ObjectDoesNotExist when a target doesn't exist."""
+def apply_votes(user, votes):
+    if not votes:
+        return {}
+    ids = defaultdict(set)
+    for type_code, id, _ in votes:
+        ids[type_code].add(id)
+    with transaction.atomic():
+        targets = {(type_code, id): (author_id, score, vote_count, created_on)
+            for type_code, model in VOTABLE_MODELS.items() if ids[type_code]
+            for id, author_id, score, vote_count, created_on in model.objects.filter(id__in=ids[type_code]).values_list('id', 'user_id', 'score', 'votes', 'created_on')}
+        missing = {(type_code, id) for type_code, type_ids in ids.items() for id in type_ids} - targets.keys()
+        if missing:
+            raise ObjectDoesNotExist(f'Unknown vote targets: {", ".join(f"{type_code}:{id}" for type_code, id in sorted(missing))}')
+        user_votes = Q()
+        for type_code, type_ids in ids.items():
+            user_votes |= Q(target_type=type_code, target__in=type_ids)
+        existing = {(vote.target_type, vote.target): vote for vote in Vote.objects.filter(user_votes, user=user)}
+
+        current = {key: vote.type for key, vote in existing.items()}
+        changes = defaultdict(lambda: [0, 0])
+        peak_scores = {}
+        for type_code, id, type in votes:
+            key = (type_code, id)
+            current[key], vote_change, score_change = Votable.resolve_vote(current.get(key), type)
+            changes[key][0] += vote_change
+            changes[key][1] += score_change
+            if score_change > 0:
+                peak_scores[key] = max(peak_scores.get(key, changes[key][1]), changes[key][1])
+
+        removed = [vote.id for key, vote in existing.items() if current[key] is None]
+        switched = {vote.id: current[key] for key, vote in existing.items() if current[key] not in (None, vote.type)}
+        created = [Vote(user=user, target_type=type_code, target=id, type=type)
+            for (type_code, id), type in current.items() if type is not None and (type_code, id) not in existing]
+        Vote.objects.filter(id__in=removed).delete()
+        for type, vote_ids in group_by_value(switched):
+            Vote.objects.filter(id__in=vote_ids).update(type=type)
+        Vote.objects.bulk_create(created)
+
+        vote_buffer = get_vote_buffer()
+        if vote_buffer is None:
+            for (type_code, vote_change, score_change), keys in group_by_value(
+                    {key: (key[0], *change) for key, change in changes.items() if any(change)}):
+                model = VOTABLE_MODELS[type_code]
+                model.objects.filter(id__in=[id for _, id in keys]).update(**model.get_vote_count_updates(vote_change, score_change))
+            karma = defaultdict(int)
+            for key, (_, score_change) in changes.items():
+                karma[targets[key][0]] += score_change
+            for change, author_ids in group_by_value({id: change for id, change in karma.items() if change}):
+                User.objects.filter(id__in=author_ids).update(karma=F('karma') + change)
+        else:
+            for (type_code, id), (vote_change, score_change) in changes.items():
+                transaction.on_commit(partial(vote_buffer.add, VOTABLE_MODELS[type_code], id, vote_change, score_change, author_id=targets[type_code, id][0]))
+
+        if ids[Post.type_code]:
+            transaction.on_commit(bump_listing_version)
+        # Like Post.vote(), posts whose score went up are offered to the leaderboards, at the best score they reached
+        for (type_code, id), peak in peak_scores.items():
+            if type_code == Post.type_code:
+                _, score, _, created_on = targets[type_code, id]
+                transaction.on_commit(partial(LeaderboardEntry.add_post, id, score + peak, created_on))
+    return {key: (current[key], score + changes[key][1], vote_count + changes[key][0]) for key, (_, score, vote_count, _) in targets.items()}
@@ -1,55 +1,39 @@
-from os import mkdir
-from os.path import exists, getsize, join
-from random import randint
-from json import dump
-from datetime import datetime, timedelta
+import sys
+from argparse import ArgumentParser
+from os import makedirs
+from datetime import datetime, timezone
+from os.path import abspath, dirname, getsize, join
+from json import dumps
 
-total_comments = 0
-def generate_comment(depth=0):
-    global total_comments
-    children = []
-    if randint(0,3) == 0 and depth < 10:
-        for i in range(randint(0,10)):
-            children.append(generate_comment(depth=depth+1))
-    total_comments += 1
-    upvotes = randint(0, 100000)
-    downvotes = randint(0, 100000)
-    return {
-                'target_class': 'reddit.models.Comment',
-                'text': f'post_comment_{total_comments - 1}',
-                'score': upvotes - downvotes,
-                'votes': upvotes + downvotes,
-                'user_id': '$user_id',
-                'post': '$root',
-                'parent': '$parent' if depth > 1 else None,
-                'children': children,
-                'created_on': (datetime.now() - timedelta(seconds=randint(0, 24*3600*366))).timestamp(),
-            }
-
-posts = []
-COUNT = 10
+sys.path.insert(0, dirname(dirname(abspath(__file__))))
+from reddit.datagen import DatasetGenerator
 
 TARGET_DIR = 'test-data'
 TARGET_FILE = 'posts.json'
 
-if not exists(TARGET_DIR):
-    mkdir(TARGET_DIR)
+parser = ArgumentParser(description='Generates posts with comment trees for the tests, benchmarks and manage.py import_posts')
+parser.add_argument('--posts', type=int, default=10)
+parser.add_argument('--comments-per-post', type=int, default=20)
+parser.add_argument('--depth', type=int, default=10, help='Maximum comment tree depth')
+parser.add_argument('--fan-out', type=int, default=10, help='Maximum replies per comment')
+parser.add_argument('--users', type=int, default=1, help='Authors are referenced as $user_id when 1, $user_<n> otherwise')
+parser.add_argument('--votes-per-user', type=int, default=0)
+parser.add_argument('--seed', type=int, help='Generate the same dataset every time')
+parser.add_argument('--now', type=float, default=DatasetGenerator.DEFAULT_NOW.timestamp(),
+    help='Unix time the creation times count back from, a fixed date by default so a seed gives the same file')
+parser.add_argument('--output', default=join(TARGET_DIR, TARGET_FILE))
+args = parser.parse_args()
 
-for i in range(COUNT):
-    upvotes = randint(0, 100000)
-    downvotes = randint(0, 100000)
-    posts.append({
-        'target_class': 'reddit.models.Post',
-        'title': f'post_title_{i}',
-        'text': f'post_text_{i}',
-        'score': upvotes - downvotes,
-        'votes': upvotes + downvotes,
-        'user_id': '$user_id',
-        'comments': [generate_comment()],
-        'created_on': (datetime.now() - timedelta(seconds=randint(0, 24*3600*366))).timestamp()
-    })
+generator = DatasetGenerator(posts=args.posts, comments_per_post=args.comments_per_post, depth=args.depth,
+    fan_out=args.fan_out, users=args.users, votes_per_user=args.votes_per_user, seed=args.seed,
+    now=datetime.fromtimestamp(args.now, timezone.utc))
 
-with open(join(TARGET_DIR, TARGET_FILE), 'w') as f:
-    dump(posts, f)
+makedirs(dirname(args.output) or '.', exist_ok=True)
+with open(args.output, 'w') as f:
+    # One post at a time so large datasets never have to fit in memory
+    f.write('[')
+    for i, post in enumerate(generator):
+        f.write((',\n' if i else '') + dumps(post))
+    f.write(']')
 
-print(f'Wrote {int(getsize(join(TARGET_DIR, TARGET_FILE))/1024)} KB to {join(TARGET_DIR, TARGET_FILE)}')
+print(f'Wrote {int(getsize(args.output)/1024)} KB to {args.output}')